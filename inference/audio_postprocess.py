@@ -0,0 +1,194 @@
+import math
+
+import numpy as np
+import torch
+
+
+class LowFreqEnergyMatcher(object):
+    r"""
+    Replace the band below `cutoff_freq` of a high-rate signal (vocoder output,
+    44.1 kHz) with the same band of a low-rate signal (xcodec reconstruction,
+    16 kHz), scaled so both low bands carry the same energy.
+
+    Both signals are analysed with STFTs whose hops cover the same duration, so
+    bin k of either spectrum sits at the same frequency and the low band can be
+    copied across without resampling. Frames are processed as one batched rfft
+    and resynthesised by weighted overlap-add.
+
+    Offline use:   matcher.run(low_wave, high_wave)
+    Streaming use: matcher.process(low_block, high_block) for every block, then
+                   matcher.flush(). The gain then follows the running energies
+                   seen so far instead of the energies of the whole song.
+    """
+
+    def __init__(
+        self,
+        low_sr=16000,
+        high_sr=44100,
+        cutoff_freq=5500.0,
+        hop_ms=20,
+        overlap=4,
+        eps=1e-10,
+    ):
+        if (low_sr * hop_ms) % 1000 or (high_sr * hop_ms) % 1000:
+            raise ValueError(
+                f"hop_ms={hop_ms} is not a whole number of samples at {low_sr} and {high_sr} Hz"
+            )
+        self.low_sr = low_sr
+        self.high_sr = high_sr
+        self.eps = eps
+        self.hop_low = low_sr * hop_ms // 1000
+        self.hop_high = high_sr * hop_ms // 1000
+        self.n_low = self.hop_low * overlap
+        self.n_high = self.hop_high * overlap
+        bin_hz = 1000.0 / (hop_ms * overlap)
+        self.cutoff_bin = min(
+            int(math.floor(cutoff_freq / bin_hz)), self.n_low // 2 + 1
+        )
+        self.win_low = torch.hann_window(self.n_low, dtype=torch.float64)
+        self.win_high = torch.hann_window(self.n_high, dtype=torch.float64)
+        # constant for a periodic hann window at 1/overlap hop
+        self.norm = float((self.win_high**2).sum()) / self.hop_high
+        self.reset()
+
+    def reset(self):
+        self._low_buf = None
+        self._high_buf = None
+        self._ola = None
+        self._energy_low = 0.0
+        self._energy_high = 0.0
+        self._pending_trim = self.n_high - self.hop_high
+        self._high_total = 0
+        self._emitted = 0
+
+    # ------------------------------------------------------------------ helpers
+    @staticmethod
+    def _as_tensor(wave):
+        if isinstance(wave, np.ndarray):
+            wave = torch.from_numpy(wave)
+        wave = wave.detach().to("cpu", torch.float64)
+        if wave.ndim == 1:
+            wave = wave.unsqueeze(0)
+        return wave
+
+    def _spectra(self, low, high, n_frames):
+        low_frames = low.unfold(-1, self.n_low, self.hop_low)[:, :n_frames]
+        high_frames = high.unfold(-1, self.n_high, self.hop_high)[:, :n_frames]
+        low_spec = torch.fft.rfft(low_frames * self.win_low, dim=-1)
+        high_spec = torch.fft.rfft(high_frames * self.win_high, dim=-1)
+        return low_spec, high_spec
+
+    def _band_energies(self, low_spec, high_spec):
+        k = self.cutoff_bin
+        energy_low = (low_spec[..., :k].abs() ** 2).sum(dim=(-1, -2))
+        energy_high = (high_spec[..., :k].abs() ** 2).sum(dim=(-1, -2))
+        return energy_low, energy_high
+
+    def _synthesize(self, low_spec, high_spec, gain):
+        k = self.cutoff_bin
+        high_spec[..., :k] = low_spec[..., :k] * gain.view(-1, 1, 1)
+        frames = torch.fft.irfft(high_spec, n=self.n_high, dim=-1) * self.win_high
+        n_frames = frames.shape[1]
+        length = (n_frames - 1) * self.hop_high + self.n_high
+        # overlap-add: frame f lands at f * hop
+        out = torch.nn.functional.fold(
+            frames.transpose(1, 2),
+            output_size=(1, length),
+            kernel_size=(1, self.n_high),
+            stride=(1, self.hop_high),
+        ).reshape(frames.shape[0], length)
+        return out / self.norm
+
+    def _frames_available(self, low, high):
+        n_low = (low.shape[-1] - self.n_low) // self.hop_low + 1
+        n_high = (high.shape[-1] - self.n_high) // self.hop_high + 1
+        return max(min(n_low, n_high), 0)
+
+    def _pad_front(self, low, high):
+        low = torch.nn.functional.pad(low, (self.n_low - self.hop_low, 0))
+        high = torch.nn.functional.pad(high, (self.n_high - self.hop_high, 0))
+        return low, high
+
+    def _pad_back(self, low, high):
+        # pad the high signal by one frame, and the low signal so that it spans at
+        # least as many frames, whichever of the two ended first
+        high = torch.nn.functional.pad(high, (0, self.n_high))
+        n_frames = (high.shape[-1] - self.n_high) // self.hop_high + 1
+        low_len = (n_frames - 1) * self.hop_low + self.n_low
+        low = torch.nn.functional.pad(low, (0, max(low_len - low.shape[-1], 0)))
+        return low, high
+
+    # ------------------------------------------------------------------ offline
+    def run(self, low_wave, high_wave):
+        """Process whole signals with a single gain per channel. Returns (C, N_high)."""
+        low, high = self._as_tensor(low_wave), self._as_tensor(high_wave)
+        out_len = high.shape[-1]
+        low, high = self._pad_back(*self._pad_front(low, high))
+        low = low[
+            :, : (self._frames_available(low, high) - 1) * self.hop_low + self.n_low
+        ]
+        n_frames = self._frames_available(low, high)
+        low_spec, high_spec = self._spectra(low, high, n_frames)
+        energy_low, energy_high = self._band_energies(low_spec, high_spec)
+        gain = torch.sqrt(energy_high / (energy_low + self.eps))
+        out = self._synthesize(low_spec, high_spec, gain)
+        start = self.n_high - self.hop_high
+        return out[:, start : start + out_len].float()
+
+    # ---------------------------------------------------------------- streaming
+    def process(self, low_block, high_block):
+        """Feed one block of each signal; returns the finished output samples."""
+        low, high = self._as_tensor(low_block), self._as_tensor(high_block)
+        self._high_total += high.shape[-1]
+        if self._low_buf is None:
+            low, high = self._pad_front(low, high)
+            self._ola = torch.zeros(low.shape[0], self.n_high - self.hop_high).double()
+        else:
+            low = torch.cat([self._low_buf, low], dim=-1)
+            high = torch.cat([self._high_buf, high], dim=-1)
+        return self._consume(low, high)
+
+    def flush(self):
+        """Drain the remaining samples once both signals have ended."""
+        if self._low_buf is None:
+            return torch.zeros(1, 0)
+        remaining = self._high_total - self._emitted
+        out = self._consume(*self._pad_back(self._low_buf, self._high_buf))
+        out = torch.cat([out, self._ola.float()], dim=-1)[:, :remaining]
+        self.reset()
+        return out
+
+    def _consume(self, low, high):
+        n_frames = self._frames_available(low, high)
+        if n_frames == 0:
+            self._low_buf, self._high_buf = low, high
+            return torch.zeros(low.shape[0], 0)
+        low_spec, high_spec = self._spectra(low, high, n_frames)
+        energy_low, energy_high = self._band_energies(low_spec, high_spec)
+        self._energy_low = self._energy_low + energy_low
+        self._energy_high = self._energy_high + energy_high
+        gain = torch.sqrt(self._energy_high / (self._energy_low + self.eps))
+        frames_out = self._synthesize(low_spec, high_spec, gain)
+        frames_out[:, : self._ola.shape[-1]] += self._ola
+        done = n_frames * self.hop_high
+        out = frames_out[:, :done]
+        self._ola = frames_out[:, done:]
+        self._low_buf = low[:, n_frames * self.hop_low :]
+        self._high_buf = high[:, done:]
+        # drop the zero padding written in front of the first block
+        trim = min(self._pending_trim, out.shape[-1])
+        self._pending_trim -= trim
+        out = out[:, trim:]
+        self._emitted += out.shape[-1]
+        return out.float()
+
+
+def replace_low_freq_with_energy_matched(
+    low_wave, high_wave, low_sr=16000, high_sr=44100, cutoff_freq=5500.0, eps=1e-10
+):
+    """
+    In-memory counterpart of post_process_audio.replace_low_freq_with_energy_matched.
+    low_wave: (C, N) at low_sr, high_wave: (C, M) at high_sr; returns (C, M) at high_sr.
+    """
+    matcher = LowFreqEnergyMatcher(low_sr, high_sr, cutoff_freq=cutoff_freq, eps=eps)
+    return matcher.run(low_wave, high_wave)
@@ -0,0 +1,266 @@
+import importlib.util
+import os
+import time
+
+import torch
+
+BACKEND_CHOICES = ("auto", "cuda", "cpu")
+ATTENTION_CHOICES = ("auto", "flash_attention_2", "sdpa", "eager")
+DTYPE_CHOICES = ("auto", "bfloat16", "float16", "float32")
+
+
+def _parse_cpulist(text):
+    """ "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-")
+            cpus.extend(range(int(a), int(b) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def numa_cpus(node):
+    """CPUs of a NUMA node (Linux sysfs), or None if it does not exist."""
+    text = _read(f"/sys/devices/system/node/node{node}/cpulist")
+    return None if text is None else _parse_cpulist(text)
+
+
+def physical_cpus(cpus):
+    """One logical CPU per physical core among `cpus` (hyper-threads dropped)."""
+    cores = []
+    seen = set()
+    for cpu in sorted(cpus):
+        siblings = _read(
+            f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        )
+        key = tuple(_parse_cpulist(siblings)) if siblings else (cpu,)
+        if key not in seen:
+            seen.add(key)
+            cores.append(cpu)
+    return cores
+
+
+def cpu_supports_bf16():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class Backend(object):
+    """
+    Where and how the stage-1/stage-2 LLMs run: device, weight dtype,
+    attention implementation and, on cpu, the thread setup.
+
+    On cuda the defaults are what the pipeline always used (bf16 weights,
+    flash-attention 2 when flash_attn is installed, sdpa otherwise). On cpu:
+    sdpa attention, bf16 weights when the cpu has bf16 instructions
+    (AVX512-BF16 / AMX) and float32 otherwise, one intra-op thread per
+    physical core and, with numa_node set, the process pinned to that node's
+    cores so its threads and (first-touch) allocations stay node local.
+    """
+
+    def __init__(
+        self,
+        name="auto",
+        cuda_idx=0,
+        dtype="auto",
+        attn_implementation="auto",
+        threads=0,
+        interop_threads=0,
+        numa_node=-1,
+    ):
+        if name == "auto":
+            name = "cuda" if torch.cuda.is_available() else "cpu"
+        if name == "cuda" and not torch.cuda.is_available():
+            raise ValueError("backend cuda requested but no cuda device is available")
+        self.name = name
+        self.device = torch.device(f"cuda:{cuda_idx}" if name == "cuda" else "cpu")
+
+        if dtype == "auto":
+            if name == "cuda":
+                dtype = "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+            else:
+                dtype = "bfloat16" if cpu_supports_bf16() else "float32"
+        self.dtype = getattr(torch, dtype)
+
+        if attn_implementation == "auto":
+            if name == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+                attn_implementation = "flash_attention_2"
+            elif hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+                attn_implementation = "sdpa"
+            else:
+                attn_implementation = "eager"
+        if attn_implementation == "flash_attention_2" and name != "cuda":
+            raise ValueError("flash_attention_2 needs the cuda backend")
+        self.attn_implementation = attn_implementation
+
+        self.cpus = None
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.numa_node = numa_node
+        if name == "cpu":
+            self._setup_cpu()
+
+    def _setup_cpu(self):
+        cpus = None
+        if self.numa_node >= 0:
+            cpus = numa_cpus(self.numa_node)
+            if cpus is None:
+                raise ValueError(f"no NUMA node {self.numa_node} on this host")
+            os.sched_setaffinity(0, cpus)
+        elif hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        if cpus is None:
+            cpus = list(range(os.cpu_count() or 1))
+        self.cpus = cpus
+        if not self.threads:
+            # hyper-threads share the vector units, matmuls do not gain from them
+            self.threads = len(physical_cpus(cpus))
+        torch.set_num_threads(self.threads)
+        if self.interop_threads:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError:
+                # only possible before the first inter-op parallel work
+                print("interop threads already initialised, keeping the default")
+        self.interop_threads = torch.get_num_interop_threads()
+
+    def model_kwargs(self):
+        """from_pretrained kwargs for the stage-1/stage-2 LLMs."""
+        return {
+            "torch_dtype": self.dtype,
+            "attn_implementation": self.attn_implementation,
+        }
+
+    def __repr__(self):
+        text = (
+            f"Backend({self.device}, {str(self.dtype).replace('torch.', '')}, "
+            f"{self.attn_implementation}"
+        )
+        if self.name == "cpu":
+            text += f", {self.threads} threads, {self.interop_threads} inter-op"
+            if self.numa_node >= 0:
+                text += f", NUMA node {self.numa_node}"
+        return text + ")"
+
+
+def backend_from_args(args):
+    return Backend(
+        args.backend,
+        args.cuda_idx,
+        dtype=args.dtype,
+        attn_implementation=args.attn_implementation,
+        threads=args.threads,
+        interop_threads=args.interop_threads,
+        numa_node=args.numa_node,
+    )
+
+
+def enable_compile_cache(folder):
+    """
+    Keep torch.compile artifacts (inductor graphs and kernels, AOT autograd
+    graphs, triton binaries) in `folder`, so a process compiling graphs an
+    earlier process compiled loads them instead of generating code again.
+    Dynamo still traces the python code, which is the part that remains.
+    """
+    folder = os.path.abspath(folder)
+    os.makedirs(folder, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = folder
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(folder, "triton"))
+    import torch._functorch.config
+    import torch._inductor.config
+
+    torch._inductor.config.fx_graph_cache = True
+    if hasattr(torch._functorch.config, "enable_autograd_cache"):
+        torch._functorch.config.enable_autograd_cache = True
+    return folder
+
+
+def scaled_down_models(backend, layers=4, vocab_size=83734):
+    """
+    Randomly initialised (stage 1, stage 2) LLaMAs for benchmarks: the 7B and
+    1B models scaled down alike, with the real vocabulary and head_dim.
+    """
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    models = []
+    for hidden in (512, 256):
+        config = LlamaConfig(
+            vocab_size=vocab_size,
+            hidden_size=hidden,
+            intermediate_size=hidden * 11 // 4,
+            num_hidden_layers=layers,
+            num_attention_heads=hidden // 128,
+            num_key_value_heads=hidden // 128,
+            attn_implementation=backend.attn_implementation,
+        )
+        model = LlamaForCausalLM(config).to(backend.device, backend.dtype)
+        models.append(model.eval())
+    return tuple(models)
+
+
+def stage1_tokens_per_second(model, context=1000, new_tokens=64):
+    """One stage-1 segment: prefill `context` tokens, then sample token by token."""
+    prompt = torch.randint(0, 32000, (1, context), device=model.device)
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        model.generate(
+            input_ids=prompt,
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=True,
+            top_k=None,
+            pad_token_id=0,
+        )
+    return new_tokens / (time.perf_counter() - t0)
+
+
+def stage2_tokens_per_second(model, batch=4, frames=8):
+    """The teacher-forced stage-2 loop of infer.py: 7 new tokens per codebook-0 frame."""
+    prompt = torch.randint(45334, 46358, (batch, 302), device=model.device)
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(frames):
+            prompt = torch.cat([prompt, prompt[:, -1:]], dim=1)
+            prompt = model.generate(
+                input_ids=prompt,
+                max_new_tokens=7,
+                min_new_tokens=7,
+                do_sample=False,
+                pad_token_id=0,
+            )
+    return batch * frames * 7 / (time.perf_counter() - t0)
+
+
+# benchmark: python backend.py [cpu|cuda] [threads]
+# tokens/s of scaled down stage-1 and stage-2 LLMs for each dtype/attention
+if __name__ == "__main__":
+    import sys
+
+    name = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    torch.manual_seed(0)
+    dtypes = ["float32", "bfloat16"] if name == "cpu" else ["bfloat16"]
+    attentions = ["sdpa", "eager"]
+    for dtype in dtypes:
+        for attention in attentions:
+            backend = Backend(
+                name, dtype=dtype, attn_implementation=attention, threads=threads
+            )
+            models = scaled_down_models(backend)
+            s1 = stage1_tokens_per_second(models[0])
+            s2 = stage2_tokens_per_second(models[1])
+            print(f"{backend}: stage 1 {s1:7.1f} tok/s, stage 2 {s2:7.1f} tok/s")
@@ -0,0 +1,102 @@
+import glob
+import os
+import re
+import shutil
+
+import numpy as np
+import torch
+
+from job_artifact import JobArtifact, narrow_codes, save_job
+
+_SEGMENT_RE = re.compile(r"segment_(\d+)\.yuejob$")
+
+
+def _rng_arrays(device):
+    state = {"rng/cpu": torch.get_rng_state().numpy()}
+    if device.type == "cuda":
+        state["rng/cuda"] = torch.cuda.get_rng_state(device).numpy()
+    return state
+
+
+def _restore_rng(job, device):
+    torch.set_rng_state(torch.from_numpy(np.array(job["rng/cpu"])))
+    if device.type == "cuda" and "rng/cuda" in job:
+        torch.cuda.set_rng_state(torch.from_numpy(np.array(job["rng/cuda"])), device)
+
+
+class JobCheckpoint(object):
+    """
+    Progress of one request on disk, so an interrupted job resumes where it
+    stopped instead of starting from zero.
+
+    root/stage1/segment_<i>.yuejob   token stream after lyric segment i and the
+                                     torch RNG state, so the remaining segments
+                                     sample exactly what an uninterrupted run
+                                     would have sampled
+    root/stage2/<key>/<track>_<start>_<end>.yuejob
+                                     stage-2 output of frames [start, end) of a
+                                     track; <key> pins the stage-2 settings
+
+    Every file is written atomically by save_job, so a crash while saving
+    leaves the previous checkpoint intact.
+    """
+
+    def __init__(self, root, stage2_key, device):
+        self.root = root
+        self.device = torch.device(device)
+        self.stage1_dir = os.path.join(root, "stage1")
+        self.stage2_dir = os.path.join(root, "stage2", stage2_key)
+        os.makedirs(self.stage1_dir, exist_ok=True)
+        os.makedirs(self.stage2_dir, exist_ok=True)
+
+    # ------------------------------------------------------------------ stage 1
+    def _segments(self):
+        found = []
+        for path in glob.glob(os.path.join(self.stage1_dir, "segment_*.yuejob")):
+            m = _SEGMENT_RE.search(path)
+            if m:
+                found.append((int(m.group(1)), path))
+        return sorted(found)
+
+    def save_segment(self, index, raw_output):
+        """raw_output: (1, L) token tensor after lyric segment `index`."""
+        arrays = {"raw_output": narrow_codes(raw_output[0])}
+        arrays.update(_rng_arrays(self.device))
+        path = os.path.join(self.stage1_dir, f"segment_{index}.yuejob")
+        save_job(path, arrays, metadata={"segment": index})
+        # only the latest segment is needed to resume
+        for other, other_path in self._segments():
+            if other != index:
+                os.remove(other_path)
+
+    def resume_segment(self):
+        """
+        (index, raw_output) of the last finished segment with the RNG restored,
+        or None if stage 1 has to start from the beginning.
+        """
+        segments = self._segments()
+        if not segments:
+            return None
+        index, path = segments[-1]
+        with JobArtifact(path) as job:
+            raw_output = torch.from_numpy(job["raw_output"].astype(np.int64))
+            _restore_rng(job, self.device)
+        return index, raw_output.unsqueeze(0).to(self.device)
+
+    # ------------------------------------------------------------------ stage 2
+    def _chunk_path(self, track, start, end):
+        return os.path.join(self.stage2_dir, f"{track}_{start}_{end}.yuejob")
+
+    def load_chunk(self, track, start, end):
+        path = self._chunk_path(track, start, end)
+        if not os.path.exists(path):
+            return None
+        with JobArtifact(path) as job:
+            codes = job["codes"].astype(np.int64)
+        return torch.from_numpy(codes).to(self.device)
+
+    def save_chunk(self, track, start, end, codes):
+        save_job(self._chunk_path(track, start, end), {"codes": narrow_codes(codes)})
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -1,6 +1,6 @@
 import json
 import numpy as np
-import einops
+import torch
 
 
 class CodecManipulator(object):
@@ -22,7 +22,11 @@ class CodecManipulator(object):
         visual: 64000, not included in v0.1
         semanticodec 100tps 16384: semantic=16384, 59158 - 75541, acoustic=8192, 75542 - 83733
     """
-    def __init__(self, codec_type, quantizer_begin=None, n_quantizer=None, teacher_forcing=False, data_feature="codec"):
+    def __init__(self, codec_type, quantizer_begin=None, n_quantizer=None, teacher_forcing=False, data_feature="codec", validate=True):
+        """
+        validate: run the range/shape asserts on every conversion. They cost a few
+            full-array scans per call and can be turned off once the pipeline is trusted.
+        """
         self.codec_type = codec_type
         self.mm_v0_2_cfg = {
             "dac16k": {"codebook_size": 1024, "num_codebooks": 4, "global_offset": 32022, "sep": ["<dac_16k>"], "fps": 50},
@@ -65,104 +69,152 @@ class CodecManipulator(object):
         self.n_quantizer = n_quantizer if n_quantizer is not None else self.num_codebooks  
         self.teacher_forcing = teacher_forcing 
         self.data_feature = data_feature
+        self.validate = validate
+        self._offset_cache = {}
 
-
-    def offset_tok_ids(self, x, global_offset=0, codebook_size=2048, num_codebooks=4):
+    def _offset_vector(self, global_offset, codebook_size):
         """
-        x: (K, T)
+        (n_quantizer, 1) uint32 offsets of codebooks quantizer_begin..quantizer_end-1,
+        broadcast against (K, T) codes.
         """
-        if isinstance(codebook_size, int):
-            assert x.max() < codebook_size, f"max(x)={x.max()}, codebook_size={codebook_size}"
-        elif isinstance(codebook_size, list):
-            for i, cs in enumerate(codebook_size):
-                assert x[i].max() < cs, f"max(x)={x[i].max()}, codebook_size={cs}, layer_id={i}"
-        else:
-            raise ValueError(f"codebook_size={codebook_size}")
-        assert x.min() >= 0, f"min(x)={x.min()}"
-        assert x.shape[0] == num_codebooks or x.shape[0] == self.n_quantizer, \
-            f"x.shape[0]={x.shape[0]}, num_codebooks={num_codebooks}, n_quantizer={self.n_quantizer}"
-
-        _x = x.copy()
-        _x = _x.astype(np.uint32)
-        cum_offset = 0
-        quantizer_begin = self.quantizer_begin
-        quantizer_end = quantizer_begin+self.n_quantizer
-        for k in range(self.quantizer_begin, quantizer_end): # k: quantizer_begin to quantizer_end - 1
+        key = (global_offset, codebook_size if isinstance(codebook_size, int) else tuple(codebook_size))
+        offsets = self._offset_cache.get(key)
+        if offsets is None:
+            ks = range(self.quantizer_begin, self.quantizer_begin + self.n_quantizer)
             if isinstance(codebook_size, int):
-                _x[k] += global_offset + k * codebook_size
+                offsets = [global_offset + k * codebook_size for k in ks]
             elif isinstance(codebook_size, list):
-                _x[k] += global_offset + cum_offset
-                cum_offset += codebook_size[k]
+                # as in the original loop, the cumulative offset starts at quantizer_begin
+                cum = np.cumsum([0] + [codebook_size[k] for k in ks][:-1])
+                offsets = [global_offset + int(c) for c in cum]
             else:
                 raise ValueError(f"codebook_size={codebook_size}")
-        return _x[quantizer_begin:quantizer_end]
+            offsets = np.asarray(offsets, dtype=np.uint32)[:, np.newaxis]
+            self._offset_cache[key] = offsets
+        return offsets
 
-    def unoffset_tok_ids(self, x, global_offset=0, codebook_size=2048, num_codebooks=4):
+    def _offset_tensor(self, global_offset, codebook_size, device):
+        """torch.long copy of _offset_vector, cached per device."""
+        key = (global_offset, codebook_size if isinstance(codebook_size, int) else tuple(codebook_size), str(device))
+        offsets = self._offset_cache.get(key)
+        if offsets is None:
+            offsets = torch.as_tensor(
+                self._offset_vector(global_offset, codebook_size).astype(np.int64), device=device)
+            self._offset_cache[key] = offsets
+        return offsets
+
+
+    def offset_tok_ids(self, x, global_offset=0, codebook_size=2048, num_codebooks=4, out=None):
         """
-        x: (K, T)
+        x: (K, T) np.ndarray, or torch.Tensor on any device
+        out: optional (n_quantizer, T) array to write the result into
+
+        numpy input gives uint32 ids, tensor input gives torch.long ids on x.device.
         """
-        if isinstance(codebook_size, int):
-            assert x.max() < global_offset + codebook_size * num_codebooks, f"max(x)={x.max()}, codebook_size={codebook_size}"
-        elif isinstance(codebook_size, list):
-            assert x.max() < global_offset + sum(codebook_size), f"max(x)={x.max()}, codebook_size={codebook_size}"
-        assert x.min() >= global_offset, f"min(x)={x.min()}, global_offset={global_offset}"
-        assert x.shape[0] == num_codebooks or x.shape[0] == self.n_quantizer, \
-            f"x.shape[0]={x.shape[0]}, num_codebooks={num_codebooks}, n_quantizer={self.n_quantizer}"
-        
-        _x = x.copy()
-        _x = _x.astype(np.uint32)
-        cum_offset = 0
-        quantizer_begin = self.quantizer_begin
-        quantizer_end = quantizer_begin+self.n_quantizer
-        for k in range(quantizer_begin, quantizer_end):
+        if self.validate:
             if isinstance(codebook_size, int):
-                _x[k-quantizer_begin] -= global_offset + k * codebook_size
+                assert x.max() < codebook_size, f"max(x)={x.max()}, codebook_size={codebook_size}"
             elif isinstance(codebook_size, list):
-                _x[k-quantizer_begin] -= global_offset + cum_offset
-                cum_offset += codebook_size[k]
+                for i, cs in enumerate(codebook_size):
+                    assert x[i].max() < cs, f"max(x)={x[i].max()}, codebook_size={cs}, layer_id={i}"
             else:
                 raise ValueError(f"codebook_size={codebook_size}")
-        return _x
+            assert x.min() >= 0, f"min(x)={x.min()}"
+            assert x.shape[0] == num_codebooks or x.shape[0] == self.n_quantizer, \
+                f"x.shape[0]={x.shape[0]}, num_codebooks={num_codebooks}, n_quantizer={self.n_quantizer}"
+
+        quantizer_begin = self.quantizer_begin
+        quantizer_end = quantizer_begin+self.n_quantizer
+        if torch.is_tensor(x):
+            offsets = self._offset_tensor(global_offset, codebook_size, x.device)
+            return torch.add(x[quantizer_begin:quantizer_end].long(), offsets, out=out)
+        offsets = self._offset_vector(global_offset, codebook_size)
+        # one fused cast+add in uint32 arithmetic, same wrap-around as astype(np.uint32) then +=
+        return np.add(x[quantizer_begin:quantizer_end], offsets, out=out, dtype=np.uint32, casting="unsafe")
+
+    def unoffset_tok_ids(self, x, global_offset=0, codebook_size=2048, num_codebooks=4, out=None):
+        """
+        x: (K, T) np.ndarray, or torch.Tensor on any device
+        out: optional array shaped like x; may be x itself for an in-place update
+
+        numpy input gives uint32 codes, tensor input gives torch.long codes on x.device.
+        """
+        if self.validate:
+            if isinstance(codebook_size, int):
+                assert x.max() < global_offset + codebook_size * num_codebooks, f"max(x)={x.max()}, codebook_size={codebook_size}"
+            elif isinstance(codebook_size, list):
+                assert x.max() < global_offset + sum(codebook_size), f"max(x)={x.max()}, codebook_size={codebook_size}"
+            assert x.min() >= global_offset, f"min(x)={x.min()}, global_offset={global_offset}"
+            assert x.shape[0] == num_codebooks or x.shape[0] == self.n_quantizer, \
+                f"x.shape[0]={x.shape[0]}, num_codebooks={num_codebooks}, n_quantizer={self.n_quantizer}"
+
+        n = self.n_quantizer
+        if torch.is_tensor(x):
+            offsets = self._offset_tensor(global_offset, codebook_size, x.device)
+            if out is None:
+                out = torch.empty(x.shape, dtype=torch.long, device=x.device)
+            torch.sub(x[:n].long(), offsets, out=out[:n])
+            if x.shape[0] > n:
+                out[n:] = x[n:]
+            return out
+        offsets = self._offset_vector(global_offset, codebook_size)
+        if out is None:
+            out = np.empty(x.shape, dtype=np.uint32)
+        np.subtract(x[:n], offsets, out=out[:n], dtype=np.uint32, casting="unsafe")
+        if x.shape[0] > n:
+            # rows past n_quantizer are returned unchanged, as before
+            out[n:] = x[n:]
+        return out
 
     def flatten(self, x):
         if len(x.shape) > 2:
             x = x.squeeze()
-        assert x.shape[0] == self.num_codebooks or x.shape[0] == self.n_quantizer, \
-            f"x.shape[0]={x.shape[0]}, num_codebooks={self.num_codebooks}, n_quantizer={self.n_quantizer}"
-        return einops.rearrange(x, 'K T -> (T K)')
+        if self.validate:
+            assert x.shape[0] == self.num_codebooks or x.shape[0] == self.n_quantizer, \
+                f"x.shape[0]={x.shape[0]}, num_codebooks={self.num_codebooks}, n_quantizer={self.n_quantizer}"
+        # 'K T -> (T K)' as a single column-major copy
+        if torch.is_tensor(x):
+            return x.t().reshape(-1)
+        return np.ravel(x, order='F')
 
     def unflatten(self, x, n_quantizer=None):
         if x.ndim > 1 and x.shape[0] == 1:
             x = x.squeeze(0)
-        assert len(x.shape) == 1
-        assert x.shape[0] % self.num_codebooks == 0 or x.shape[0] % self.n_quantizer == 0, \
-            f"x.shape[0]={x.shape[0]}, num_codebooks={self.num_codebooks}, n_quantizer={self.n_quantizer}"
-        if n_quantizer!=self.num_codebooks:
-            return einops.rearrange(x, '(T K) -> K T', K=n_quantizer)
-        return einops.rearrange(x, '(T K) -> K T', K=self.num_codebooks)
+        if self.validate:
+            assert len(x.shape) == 1
+            assert x.shape[0] % self.num_codebooks == 0 or x.shape[0] % self.n_quantizer == 0, \
+                f"x.shape[0]={x.shape[0]}, num_codebooks={self.num_codebooks}, n_quantizer={self.n_quantizer}"
+        K = n_quantizer if n_quantizer != self.num_codebooks else self.num_codebooks
+        # '(T K) -> K T', returned as a view
+        return x.reshape(-1, K).t() if torch.is_tensor(x) else x.reshape(-1, K).T
     
     # def check_codec_type_from_path(self, path):
     #     if self.codec_type == "hifi16k":
     #         assert "academicodec_hifi_16k_320d_large_uni" in path
     
     def get_codec_type_from_range(self, ids):
-        ids_range = [ids.min(), ids.max()]
+        ids_range = [int(ids.min()), int(ids.max())]
         codec_range = self.mm_v0_2_cfg["codec_range"]
         for codec_type, r in codec_range.items():
             if ids_range[0] >= r[0] and ids_range[1] <= r[1]:
                 return codec_type
         raise ValueError(f"ids_range={ids_range}, codec_range={codec_range}")
 
-    def npy2ids(self, npy):
+    def npy2ids(self, npy, as_list=True):
+        """
+        (K, T) codes -> flat token ids. A torch.Tensor input stays a tensor on its
+        device (as_list is ignored); numpy input gives a list, or an array with as_list=False.
+        """
         if isinstance(npy, str):
             data = np.load(npy)
-        elif isinstance(npy, np.ndarray):
+        elif isinstance(npy, np.ndarray) or torch.is_tensor(npy):
             data = npy
         else:
             raise ValueError(f"not supported type: {type(npy)}")
         # data = data.squeeze()
 
-        assert len(data.shape)==2,  f'data shape: {data.shape} is not (n_codebook, seq_len)'
+        if self.validate:
+            assert len(data.shape)==2,  f'data shape: {data.shape} is not (n_codebook, seq_len)'
         data = self.offset_tok_ids(
             data, 
             global_offset=self.global_offset, 
@@ -170,20 +222,24 @@ class CodecManipulator(object):
             num_codebooks=self.num_codebooks, 
         )
         data = self.flatten(data)
-        codec_range = self.get_codec_type_from_range(data)
-        assert codec_range == self.codec_type, f"get_codec_type_from_range(data)={codec_range}, self.codec_type={self.codec_type}"
-        data = data.tolist()
-        return data
+        if self.validate:
+            codec_range = self.get_codec_type_from_range(data)
+            assert codec_range == self.codec_type, f"get_codec_type_from_range(data)={codec_range}, self.codec_type={self.codec_type}"
+        if torch.is_tensor(data) or not as_list:
+            return data
+        return data.tolist()
     
     def ids2npy(self, token_ids):
+        """flat token ids -> (n_quantizer, T) codes; tensors stay tensors on their device."""
         # make sure token_ids starts with codebook 0
         if isinstance(self.codebook_size, int):
             codebook_0_range = (self.global_offset + self.quantizer_begin*self.codebook_size, self.global_offset + (self.quantizer_begin+1)*self.codebook_size)
         elif isinstance(self.codebook_size, list):
             codebook_0_range = (self.global_offset, self.global_offset + self.codebook_size[0])
-        assert token_ids[0] >= codebook_0_range[0] \
-            and token_ids[0] < codebook_0_range[1], f"token_ids[0]={token_ids[self.quantizer_begin]}, codebook_0_range={codebook_0_range}"
-        data = np.array(token_ids)
+        if self.validate:
+            assert token_ids[0] >= codebook_0_range[0] \
+                and token_ids[0] < codebook_0_range[1], f"token_ids[0]={token_ids[self.quantizer_begin]}, codebook_0_range={codebook_0_range}"
+        data = token_ids if torch.is_tensor(token_ids) else np.asarray(token_ids)
         data = self.unflatten(data, n_quantizer=self.n_quantizer)
         data = self.unoffset_tok_ids(
             data, 
@@ -202,3 +258,100 @@ class CodecManipulator(object):
     
     def sep_ids(self):
         return self.sep_ids
+
+
+# benchmark: python codecmanipulator.py [minutes]
+if __name__ == "__main__":
+    import sys
+    import time
+    import einops
+
+    # the pre-vectorization methods, asserts included
+    def ref_offset(self, x, global_offset, codebook_size, check=True):
+        if check:
+            if isinstance(codebook_size, int):
+                assert x.max() < codebook_size
+            else:
+                for i, cs in enumerate(codebook_size):
+                    assert x[i].max() < cs
+            assert x.min() >= 0
+        _x = x.copy().astype(np.uint32)
+        cum_offset = 0
+        for k in range(self.quantizer_begin, self.quantizer_begin + self.n_quantizer):
+            if isinstance(codebook_size, int):
+                _x[k] += global_offset + k * codebook_size
+            else:
+                _x[k] += global_offset + cum_offset
+                cum_offset += codebook_size[k]
+        return _x[self.quantizer_begin:self.quantizer_begin + self.n_quantizer]
+
+    def ref_unoffset(self, x, global_offset, codebook_size):
+        if isinstance(codebook_size, int):
+            assert x.max() < global_offset + codebook_size * self.num_codebooks
+        else:
+            assert x.max() < global_offset + sum(codebook_size)
+        assert x.min() >= global_offset
+        _x = x.copy().astype(np.uint32)
+        cum_offset = 0
+        for k in range(self.quantizer_begin, self.quantizer_begin + self.n_quantizer):
+            if isinstance(codebook_size, int):
+                _x[k - self.quantizer_begin] -= global_offset + k * codebook_size
+            else:
+                _x[k - self.quantizer_begin] -= global_offset + cum_offset
+                cum_offset += codebook_size[k]
+        return _x
+
+    def bench(fn, repeat=20):
+        fn()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - start) / repeat * 1e3
+
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = np.random.default_rng(0)
+    for codec_type, n_q in [("xcodec", 12), ("xcodec", 8), ("xcodec", 1), ("semanticodec", 2)]:
+        tool = CodecManipulator(codec_type, 0, n_q)
+        fast = CodecManipulator(codec_type, 0, n_q, validate=False)
+        cs = tool.codebook_size
+        T = int(minutes * 60 * (tool.fps or 50))
+        high = cs if isinstance(cs, int) else min(cs)
+        x = rng.integers(0, high, size=(tool.num_codebooks, T)).astype(np.int16)
+        args = (tool.global_offset, cs)
+
+        ref = ref_offset(tool, x, *args)
+        assert np.array_equal(tool.offset_tok_ids(x, *args, tool.num_codebooks), ref)
+        assert tool.offset_tok_ids(x, *args, tool.num_codebooks).dtype == ref.dtype
+        ids = einops.rearrange(ref, 'K T -> (T K)')
+        assert np.array_equal(tool.flatten(ref), ids)
+        assert np.array_equal(tool.npy2ids(x), ids.tolist())
+        back = tool.unflatten(ids, n_quantizer=n_q)
+        assert np.array_equal(back, einops.rearrange(ids, '(T K) -> K T', K=n_q))
+        assert np.array_equal(tool.unoffset_tok_ids(back, *args, tool.num_codebooks), ref_unoffset(tool, back, *args))
+        assert np.array_equal(tool.ids2npy(ids), x[:n_q])
+        # torch path: same values, long dtype, stays on the input device
+        xt = torch.from_numpy(x)
+        assert torch.equal(tool.npy2ids(xt), torch.from_numpy(ids.astype(np.int64)))
+        assert torch.equal(tool.ids2npy(tool.npy2ids(xt)), xt[:n_q].long())
+        # out-of-range values wrap exactly like the astype(np.uint32) path
+        bad = x.copy()
+        bad[0, :3] = [-1, -2, 32767]
+        assert np.array_equal(fast.offset_tok_ids(bad, *args, tool.num_codebooks), ref_offset(tool, bad, *args, check=False))
+
+        out = np.empty((n_q, T), dtype=np.uint32)
+        print(f"{codec_type} n_quantizer={n_q} ({tool.num_codebooks}, {T}):")
+        print(f"  offset    loop {bench(lambda: ref_offset(tool, x, *args)):7.2f} ms"
+              f" | vectorized {bench(lambda: tool.offset_tok_ids(x, *args, tool.num_codebooks)):7.2f} ms"
+              f" | no validate {bench(lambda: fast.offset_tok_ids(x, *args, tool.num_codebooks)):7.2f} ms"
+              f" | out= {bench(lambda: fast.offset_tok_ids(x, *args, tool.num_codebooks, out=out)):7.2f} ms")
+        print(f"  unoffset  loop {bench(lambda: ref_unoffset(tool, back, *args)):7.2f} ms"
+              f" | vectorized {bench(lambda: tool.unoffset_tok_ids(back, *args, tool.num_codebooks)):7.2f} ms"
+              f" | no validate {bench(lambda: fast.unoffset_tok_ids(back, *args, tool.num_codebooks)):7.2f} ms")
+        print(f"  flatten einops {bench(lambda: einops.rearrange(ref, 'K T -> (T K)')):7.2f} ms"
+              f" | ravel      {bench(lambda: tool.flatten(ref)):7.2f} ms")
+        xt = torch.from_numpy(x).to("cuda" if torch.cuda.is_available() else "cpu")
+        print(f"  torch ({xt.device.type}) npy2ids {bench(lambda: fast.npy2ids(xt)):7.2f} ms"
+              f" | ids2npy {bench(lambda: fast.ids2npy(fast.npy2ids(xt))):7.2f} ms")
+        print(f"  npy2ids        {bench(lambda: tool.npy2ids(x)):7.2f} ms"
+              f" | no validate {bench(lambda: fast.npy2ids(x)):7.2f} ms"
+              f" | as_list=False {bench(lambda: fast.npy2ids(x, as_list=False)):7.2f} ms")
@@ -72,6 +72,13 @@ def generate_music(
     return output_audio
 
 
+def default_stage2_batch_size():
+    # VRAM(GB)/6 on cuda; cpu-only hosts have no device properties to query
+    if not torch.cuda.is_available():
+        return 1
+    return round(torch.cuda.get_device_properties(0).total_memory / (1024 * 1024 * 1024)) / 6
+
+
 def load_tags():
     try:
         tags_file = Path(__file__).parent.parent / "top_200_tags.json"
@@ -270,11 +277,7 @@ with gr.Blocks(
                 with gr.Row():
                     stage2_batch_size = gr.Number(
                         label="Stage 2 Batch Size",
-                        value=round(
-                            torch.cuda.get_device_properties(0).total_memory
-                            / (1024 * 1024 * 1024)
-                        )
-                        / 6,
+                        value=default_stage2_batch_size(),
                         precision=0,
                         minimum=1,
                         maximum=10,
@@ -282,7 +285,8 @@ with gr.Blocks(
                     )
                     cuda_idx = gr.Radio(
                         label="CUDA Index",
-                        choices=[str(i) for i in range(torch.cuda.device_count())],
+                        choices=[str(i) for i in range(torch.cuda.device_count())]
+                        or ["0"],
                         value="0",
                         type="index",
                     )
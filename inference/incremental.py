@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+
+from result_cache import STAGE2_FIELDS
+
+# previous-job args that must match for its stage-1 tokens to be reused
+REUSE_FIELDS = (
+    "stage1_model",
+    "max_new_tokens",
+    "repetition_penalty",
+    "repetition_window",
+    "fused_cfg",
+    "cfg_tokens",
+    "restricted_sampler",
+    "long_context",
+    "kv_cache_dtype",
+    "backend",
+    "dtype",
+    "attn_implementation",
+    "quantize",
+    "quantize_group_size",
+    "use_audio_prompt",
+    "use_dual_tracks_prompt",
+    "audio_prompt_path",
+    "vocal_track_prompt_path",
+    "instrumental_track_prompt_path",
+    "prompt_start_time",
+    "prompt_end_time",
+    "profile",
+)
+# previous-job args that must match for its stage-2 codes to be reused: the
+# stage-2 cache key fields, and the settings of how the stage-2 model runs
+STAGE2_REUSE_FIELDS = STAGE2_FIELDS + (
+    "backend",
+    "dtype",
+    "attn_implementation",
+    "quantize",
+    "quantize_group_size",
+)
+
+
+def first_changed_segment(old_lyrics, new_lyrics):
+    """Index of the first lyric segment (split_lyrics output) that differs."""
+    for i, (old, new) in enumerate(zip(old_lyrics, new_lyrics)):
+        if old != new:
+            return i
+    return min(len(old_lyrics), len(new_lyrics))
+
+
+def reusable_stage1_prefix(job, args, genres, lyrics, old_header, new_header, tokenize):
+    """
+    Stage-1 tokens of a previous job that an edited request can keep.
+
+    job: JobArtifact of the previous job; old_header / new_header: the
+    instruction text (prompt_texts[0]) of the previous and the new request.
+
+    Segments before the first edited lyric segment are kept as generated. The
+    instruction block at the head of the stream lists the full lyrics, so it
+    is swapped for the new one; everything after it (reference audio, kept
+    segments) is reused token for token.
+
+    Returns (n_kept, raw_tokens) where n_kept is the number of kept lyric
+    segments and raw_tokens a 1-d int64 array, or None if nothing can be kept.
+    """
+    meta = job.metadata
+    old_args = meta.get("args", {})
+    if meta.get("genres") != genres:
+        return None
+    if any(old_args.get(f) != getattr(args, f, None) for f in REUSE_FIELDS):
+        return None
+
+    has_reference = old_args.get("use_audio_prompt") or old_args.get(
+        "use_dual_tracks_prompt"
+    )
+    offset = 1 if has_reference else 0
+    generated = len(meta["eoa_idx"]) - offset
+    n_kept = min(
+        first_changed_segment(meta["lyrics"], lyrics),
+        generated,
+        # prompt_texts[0] is the instruction, segments start at index 1
+        min(args.run_n_segments + 1, len(lyrics)) - 1,
+    )
+    if n_kept <= 0:
+        return None
+
+    raw = np.asarray(job["raw_tokens"], dtype=np.int64)
+    old_head = np.asarray(tokenize(old_header), dtype=np.int64)
+    if raw.shape[0] < old_head.shape[0] or not np.array_equal(
+        raw[: old_head.shape[0]], old_head
+    ):
+        return None
+    cut = meta["eoa_idx"][offset + n_kept - 1] + 1
+    new_head = np.asarray(tokenize(new_header), dtype=np.int64)
+    return n_kept, np.concatenate([new_head, raw[old_head.shape[0] : cut]])
+
+
+def stage2_reusable(job, args):
+    """Whether the stage-2 codes of a previous job were made as `args` would make them."""
+    old_args = job.metadata.get("args", {})
+    return all(old_args.get(f) == getattr(args, f, None) for f in STAGE2_REUSE_FIELDS)
+
+
+def unchanged_chunks(old_prompt, new_prompt, chunk=300):
+    """
+    Stage-2 chunks ([start, end) frame ranges, stage-2 chunking) of a track
+    whose stage-1 tokens are identical in the previous job, and which can take
+    the previous stage-2 codes. Full chunks must line up with full chunks of
+    the previous track, the trailing partial chunk only matches if the track
+    length did not change.
+    """
+    n_frames = new_prompt.shape[-1]
+    full = n_frames // chunk * chunk
+    old_full = old_prompt.shape[-1] // chunk * chunk
+    spans = [(a, a + chunk) for a in range(0, full, chunk)]
+    if full != n_frames:
+        spans.append((full, n_frames))
+    kept = []
+    for a, b in spans:
+        if b - a == chunk:
+            aligned = b <= old_full
+        else:
+            aligned = old_prompt.shape[-1] == n_frames
+        if aligned and torch.equal(old_prompt[:, a:b], new_prompt[:, a:b]):
+            kept.append((a, b))
+    return spans, kept
@@ -11,17 +11,15 @@ sys.path.append(current_dir)  # Add current directory to path
 
 import re
 import random
+import time
 import uuid
-import copy
 from tqdm import tqdm
-from collections import Counter
 import argparse
 import numpy as np
 import torch
 import torchaudio
 from torchaudio.transforms import Resample
 import soundfile as sf
-from einops import rearrange
 from transformers import (
     AutoModelForCausalLM,
     LogitsProcessor,
@@ -30,12 +28,44 @@ from transformers import (
 )
 from omegaconf import OmegaConf
 from codecmanipulator import CodecManipulator
-from mmtokenizer import _MMSentencePieceTokenizer
-import copy
-from collections import Counter
+from mmtokenizer import get_mm_tokenizer
 from models.soundstream_hubert_new import SoundStream
-from vocoder import build_codec_model, process_audio
-from post_process_audio import replace_low_freq_with_energy_matched
+from vocoder import build_codec_model
+from vocoder_stage import reconstruct_stems, decode_stems, mix_stems
+from audio_postprocess import replace_low_freq_with_energy_matched
+from output_writer import AudioWriter, SUPPORTED_FORMATS
+from job_artifact import save_job, narrow_codes, JobArtifact, COMPRESSION_CHOICES
+from checkpoint import JobCheckpoint
+from incremental import reusable_stage1_prefix, stage2_reusable, unchanged_chunks
+from repetition import WindowedRepetitionPenaltyProcessor
+from sampler import RestrictedSampler, stage1_valid_ids
+from stage1_decoder import Stage1Decoder, segment_token_budget
+from stage2_decoder import Stage2Decoder
+from sink_cache import KV_DTYPES
+from backend import (
+    ATTENTION_CHOICES,
+    BACKEND_CHOICES,
+    DTYPE_CHOICES,
+    backend_from_args,
+    enable_compile_cache,
+)
+from quantize import QUANT_CHOICES, model_nbytes, quantize_model
+from weight_snapshot import (
+    SNAPSHOT_MODES,
+    bnb_int8_model,
+    map_checkpoint,
+    mmgp_quantized_model,
+    quantized_model,
+)
+from memory_plan import plan_from_args
+from residency import PhaseResidency
+from layer_stream import STREAM_PROFILE, stream_layers
+from result_cache import (
+    ResultCache,
+    stage1_fingerprint,
+    stage2_fingerprint,
+    request_fingerprint,
+)
 
 
 def create_args(
@@ -45,6 +75,7 @@ def create_args(
     stage2_model="m-a-p/YuE-s2-1B-general",
     max_new_tokens: int = 3000,
     repetition_penalty: float = 1.1,
+    repetition_window: int = 0,
     run_n_segments: int = 2,
     stage2_batch_size: int = 2,
     use_audio_prompt: bool = False,
@@ -76,7 +107,32 @@ def create_args(
     ).as_posix(),
     rescale: bool = False,
     compile: bool = True,
+    compile_cache_dir: str = "",
     profile: int = 3,
+    output_format: str = "mp3",
+    writer_workers: int = 2,
+    artifact_compression: str = "none",
+    cache_dir: str = "",
+    cache_max_gb: float = 20.0,
+    cache_max_age_days: float = 30.0,
+    cache_stage1: bool = False,
+    checkpoint_dir: str = "",
+    edit_from: str = "",
+    long_context: bool = False,
+    kv_cache_dtype: str = "auto",
+    fused_cfg: bool = False,
+    cfg_tokens: int = 0,
+    restricted_sampler: bool = False,
+    backend: str = "auto",
+    dtype: str = "auto",
+    attn_implementation: str = "auto",
+    threads: int = 0,
+    interop_threads: int = 0,
+    numa_node: int = -1,
+    quantize: str = "none",
+    quantize_group_size: int = 128,
+    ram_budget_gb: float = 0.0,
+    vram_budget_gb: float = 0.0,
 ) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     # Model Configuration:
@@ -104,6 +160,12 @@ def create_args(
         default=1.1,
         help="repetition_penalty ranges from 1.0 to 2.0 (or higher in some cases). It controls the diversity and coherence of the audio tokens generated. The higher the value, the greater the discouragement of repetition. Setting value to 1.0 means no penalty.",
     )
+    parser.add_argument(
+        "--repetition_window",
+        type=int,
+        default=0,
+        help="If > 0, stage 1 applies repetition_penalty only to the audio tokens among the last N tokens of the current segment (100 tokens per second of audio) instead of to every token of the song so far.",
+    )
     parser.add_argument(
         "--run_n_segments",
         type=int,
@@ -181,12 +243,160 @@ def create_args(
         action="store_true",
         help="If set, intermediate outputs will be saved during processing.",
     )
+    parser.add_argument(
+        "--long_context",
+        action="store_true",
+        help="Generate stage 1 over one KV cache that keeps the instruction/reference block and a rolling window of recent tokens, instead of re-prefilling every segment and cutting long songs down to their last tokens.",
+    )
+    parser.add_argument(
+        "--kv_cache_dtype",
+        type=str,
+        default="auto",
+        choices=KV_DTYPES,
+        help="Storage of the stage-1 KV cache. int8/fp8 quantize it with per-head scales, about halving its memory at some speed cost on cpu (see python sink_cache.py). Implies --long_context.",
+    )
+    parser.add_argument(
+        "--fused_cfg",
+        action="store_true",
+        help="Run the conditional and unconditional classifier-free guidance branches of stage 1 as one batch-2 forward over one KV cache instead of two separate forwards (see python stage1_decoder.py cfg). Implies --long_context.",
+    )
+    parser.add_argument(
+        "--cfg_tokens",
+        type=int,
+        default=0,
+        help="With --fused_cfg, stop applying classifier-free guidance after this many tokens of each segment (0: the whole segment).",
+    )
+    parser.add_argument(
+        "--restricted_sampler",
+        action="store_true",
+        help="Sample stage 1 from the codebook-0 ids and <EOA> only, running CFG, penalty, temperature, top-k and top-p on that slice instead of over the full vocabulary (see python sampler.py). Implies --fused_cfg.",
+    )
     parser.add_argument(
         "--disable_offload_model",
         action="store_true",
-        help="If set, the model will not be offloaded from the GPU to CPU after Stage 1 inference.",
+        help="If set, the stage-1 model stays loaded after Stage 1 inference instead of being released (see python residency.py).",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="mp3",
+        choices=SUPPORTED_FORMATS,
+        help="Audio format of the generated stems and mixes.",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="Number of background threads used to encode output audio files.",
+    )
+    parser.add_argument(
+        "--artifact_compression",
+        type=str,
+        default="none",
+        choices=COMPRESSION_CHOICES,
+        help="Compression of the per-job artifact holding the stage-1 tokens and stage-2 codes. 'none' keeps it memory-mappable.",
+    )
+    # Result cache
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="",
+        help="If set, finished requests are stored here and identical requests are answered from it without running the models. With --quantize int8/int4 on cpu, the int8 stage-1 checkpoint on cuda (bitsandbytes) and --profile 3-5 (mmgp quantizes stage 1) the quantized weights are snapshotted here too, and later runs load them instead of quantizing again.",
+    )
+    parser.add_argument(
+        "--cache_max_gb",
+        type=float,
+        default=20.0,
+        help="Size limit of each cache under --cache_dir, least recently used entries are evicted first. 0 disables the limit.",
+    )
+    parser.add_argument(
+        "--cache_max_age_days",
+        type=float,
+        default=30.0,
+        help="Cache entries older than this are evicted. 0 disables the limit.",
+    )
+    parser.add_argument(
+        "--cache_stage1",
+        action="store_true",
+        help="Also cache the stage-1/stage-2 tokens, so requests that only change vocoder or output settings skip the language models.",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default="",
+        help="If set, every finished stage-1 segment and stage-2 chunk is saved here and a rerun of the same request resumes from the first missing one. Removed once the job finishes.",
+    )
+    parser.add_argument(
+        "--edit_from",
+        type=str,
+        default="",
+        help="Job artifact (.yuejob) of a previous run with edited lyrics. Segments before the first edited one are reused, and stage 2 only reruns the 6s chunks whose stage-1 tokens changed.",
     )
     parser.add_argument("--cuda_idx", type=int, default=0)
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="auto",
+        choices=BACKEND_CHOICES,
+        help="Device for the stage-1/stage-2 LLMs; auto picks cuda when available (see python backend.py for cpu throughput).",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="auto",
+        choices=DTYPE_CHOICES,
+        help="Weight dtype of the LLMs. auto: bfloat16 on cuda, and on cpu bfloat16 if the cpu has bf16 instructions (AVX512-BF16/AMX), float32 otherwise.",
+    )
+    parser.add_argument(
+        "--attn_implementation",
+        type=str,
+        default="auto",
+        choices=ATTENTION_CHOICES,
+        help="auto: flash_attention_2 on cuda if flash-attn is installed, sdpa otherwise.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="cpu backend: intra-op threads, 0 for one per physical core available to the process.",
+    )
+    parser.add_argument(
+        "--interop_threads",
+        type=int,
+        default=0,
+        help="cpu backend: inter-op threads, 0 keeps the torch default.",
+    )
+    parser.add_argument(
+        "--numa_node",
+        type=int,
+        default=-1,
+        help="cpu backend: pin the process to the cores of this NUMA node so threads and memory stay node local (-1: no pinning).",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="none",
+        choices=QUANT_CHOICES,
+        help="cpu backend: quantize the linear layers of both LLMs after loading. int8: int8 weights, model dtype activations; int4: group-wise int4 weights; int8-dynamic: torch dynamic quantization (float32 model). See python quantize.py for memory, speed and agreement with the unquantized models.",
+    )
+    parser.add_argument(
+        "--quantize_group_size",
+        type=int,
+        default=128,
+        help="Input channels sharing one int4 scale/zero pair (--quantize int4).",
+    )
+    parser.add_argument(
+        "--ram_budget_gb",
+        type=float,
+        default=0.0,
+        help="Plan the request for this much RAM: measure the models and their per-token KV cache and activation memory with small dry runs, print the plan and choose --profile and --stage2_batch_size from it (see python memory_plan.py). 0: no plan unless --vram_budget_gb is set.",
+    )
+    parser.add_argument(
+        "--vram_budget_gb",
+        type=float,
+        default=0.0,
+        help="Like --ram_budget_gb for the gpu memory of the cuda backend; with only --ram_budget_gb set, the whole device is the budget.",
+    )
     parser.add_argument(
         "--seed", type=int, default=42, help="An integer value to reproduce generation."
     )
@@ -232,8 +442,23 @@ def create_args(
     parser.add_argument(
         "-r", "--rescale", action="store_true", help="Rescale output to avoid clipping."
     )
-    parser.add_argument("--profile", type=int, default=3)
-    parser.add_argument("--compile", action="store_true", help="Compile model.")
+    parser.add_argument(
+        "--profile",
+        type=int,
+        default=3,
+        help="cuda: mmgp offload profile 1-5. 6 (cpu or cuda): keep the LLM weights in their memory-mapped checkpoint files (or, with --quantize, in RAM or their snapshot) and copy each decoder block into working memory just before it runs, the next one on a background thread, for hosts that cannot hold the models (see python layer_stream.py).",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the stage-2 decode step (static KV cache, fixed batch and 300-frame chunks), the xcodec decoder and the vocoders (codes padded to multiples of 300 frames) with torch.compile. This CHANGES THE OUTPUT, it is not only faster: outside float32 the stage-2 codes differ from the uncompiled generate loop's (another reduction order flips near-tied argmaxes; 17%% of the ids on a bf16 test model, see python stage2_decoder.py), and the padded decoders change the samples near the song end.",
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default="",
+        help="Where --compile keeps compiled graphs and kernels so later processes skip code generation; defaults to <cache_dir>/compile with --cache_dir, else the torch default.",
+    )
 
     args = parser.parse_args(
         [
@@ -249,6 +474,8 @@ def create_args(
             str(max_new_tokens),
             "--repetition_penalty",
             str(repetition_penalty),
+            "--repetition_window",
+            str(repetition_window),
             "--stage2_batch_size",
             str(stage2_batch_size),
             "--run_n_segments",
@@ -257,6 +484,26 @@ def create_args(
             output_dir,
             "--cuda_idx",
             str(cuda_idx),
+            "--backend",
+            backend,
+            "--dtype",
+            dtype,
+            "--attn_implementation",
+            attn_implementation,
+            "--threads",
+            str(threads),
+            "--interop_threads",
+            str(interop_threads),
+            "--numa_node",
+            str(numa_node),
+            "--quantize",
+            quantize,
+            "--quantize_group_size",
+            str(quantize_group_size),
+            "--ram_budget_gb",
+            str(ram_budget_gb),
+            "--vram_budget_gb",
+            str(vram_budget_gb),
             "--basic_model_config",
             basic_model_config,
             "--resume_path",
@@ -269,6 +516,28 @@ def create_args(
             inst_decoder_path,
             "--seed",
             str(seed),
+            "--output_format",
+            output_format,
+            "--compile_cache_dir",
+            compile_cache_dir,
+            "--writer_workers",
+            str(writer_workers),
+            "--artifact_compression",
+            artifact_compression,
+            "--cache_dir",
+            cache_dir,
+            "--cache_max_gb",
+            str(cache_max_gb),
+            "--cache_max_age_days",
+            str(cache_max_age_days),
+            "--checkpoint_dir",
+            checkpoint_dir,
+            "--edit_from",
+            edit_from,
+            "--kv_cache_dtype",
+            kv_cache_dtype,
+            "--cfg_tokens",
+            str(cfg_tokens),
         ]
     )
     if use_audio_prompt:
@@ -283,6 +552,14 @@ def create_args(
 
     args.keep_intermediate = keep_intermediate
 
+    args.cache_stage1 = cache_stage1
+
+    args.long_context = long_context
+
+    args.fused_cfg = fused_cfg
+
+    args.restricted_sampler = restricted_sampler
+
     args.disable_offload_model = disable_offload_model
 
     args.rescale = rescale
@@ -294,39 +571,25 @@ def create_args(
     return args, parser
 
 
-def main(args):
-    stage1_model = args.stage1_model
-    stage2_model = args.stage2_model
-    cuda_idx = args.cuda_idx
-    max_new_tokens = args.max_new_tokens
-    stage1_output_dir = os.path.join(args.output_dir, f"stage1")
-    stage2_output_dir = stage1_output_dir.replace("stage1", "stage2")
-    os.makedirs(stage1_output_dir, exist_ok=True)
-    os.makedirs(stage2_output_dir, exist_ok=True)
-
-    def seed_everything(seed=42):
-        random.seed(seed)
-        np.random.seed(seed)
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed_all(seed)
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
-
-    seed_everything(args.seed)
-
-    # load tokenizer and model
-    device = torch.device(f"cuda:{cuda_idx}" if torch.cuda.is_available() else "cpu")
-    print(device)
-    mmtokenizer = _MMSentencePieceTokenizer(
-        (Path(current_dir) / "mm_tokenizer_v0.2_hf" / "tokenizer.model").as_posix()
-    )
+def load_pipeline(args, backend, parts=("stage1", "stage2", "codec")):
+    """
+    Load the parts of the pipeline named in `parts` on `backend`: "stage1",
+    "stage2", "codec" and "vocoders" (vocal, instrumental). main() loads
+    each for the phases that use it (see residency.py); main(args, pipeline)
+    runs a request on parts loaded once, see serving.py.
+    """
+    device = backend.device
 
     def load_model(model_path, quantization):
+        if quantization != "bf16" and backend.name != "cuda":
+            raise ValueError(
+                f"{model_path}: bitsandbytes {quantization} models need the cuda backend"
+            )
         if quantization == "bf16":
             model = AutoModelForCausalLM.from_pretrained(
                 model_path,
-                torch_dtype=torch.bfloat16,
-                attn_implementation="flash_attention_2",  # To enable flashattn, you have to install flash-attn
+                # flash-attention 2 on cuda when flash-attn is installed, see --backend
+                **backend.model_kwargs(),
             )
             model.to("cpu")
         elif quantization == "int8":
@@ -337,7 +600,7 @@ def main(args):
             model = AutoModelForCausalLM.from_pretrained(
                 model_path,
                 quantization_config=bnb_config,
-                attn_implementation="flash_attention_2",
+                attn_implementation=backend.attn_implementation,
             )
         elif quantization == "int4":
             bnb_config = BitsAndBytesConfig(
@@ -347,56 +610,316 @@ def main(args):
             model = AutoModelForCausalLM.from_pretrained(
                 model_path,
                 quantization_config=bnb_config,
-                attn_implementation="flash_attention_2",
+                attn_implementation=backend.attn_implementation,
             )
         return model
 
-    model = load_model(
-        stage1_model, "int8" if stage1_model.endswith("int8") else "bf16"
-    )
+    def load_stage2():
+        model_stage2 = AutoModelForCausalLM.from_pretrained(
+            args.stage2_model,
+            **backend.model_kwargs(),
+            # device_map="auto",
+        )
+        model_stage2.to("cpu")
+        return model_stage2
+
+    stage1_int8 = args.stage1_model.endswith("int8")
+    # mmgp quantizes the stage-1 LLM ("transformer") in these profiles, see main
+    mmgp_quantizes = backend.name == "cuda" and args.profile in (3, 4, 5)
+    # quantized weights are snapshotted under --cache_dir, later runs map them
+    weight_cache = None
+    cuda_snapshot = backend.name == "cuda" and (stage1_int8 or mmgp_quantizes)
+    if args.cache_dir and (args.quantize in SNAPSHOT_MODES or cuda_snapshot):
+        weight_cache = ResultCache(
+            os.path.join(args.cache_dir, "weights"),
+            args.cache_max_gb * 1e9 if args.cache_max_gb > 0 else None,
+            args.cache_max_age_days * 86400 if args.cache_max_age_days > 0 else None,
+        )
 
-    # to device, if gpu is available
-    model.eval()
+    streaming = args.profile == STREAM_PROFILE
 
-    # if torch.__version__ >= "2.0.0":
-    #     model_stage2 = torch.compile(model)
+    def load_llm(name, model_path, load):
+        llm = load_weights(name, model_path, load)
+        return stream_layers(llm, device, backend.dtype) if streaming else llm
 
-    model_stage2 = AutoModelForCausalLM.from_pretrained(
-        stage2_model,
-        torch_dtype=torch.bfloat16,
-        attn_implementation="flash_attention_2",
-        # device_map="auto",
-    )
-    model_stage2.to("cpu")
-    model_stage2.eval()
+    def load_weights(name, model_path, load):
+        if args.quantize == "none":
+            if streaming:
+                if model_path.endswith("int8"):
+                    raise ValueError(
+                        f"{model_path}: --profile {STREAM_PROFILE} streams bf16 checkpoints"
+                    )
+                # nothing is read until a block is fetched
+                return map_checkpoint(
+                    model_path, backend.dtype, backend.attn_implementation
+                )
+            return load()
+        if backend.name != "cpu":
+            raise ValueError(
+                "--quantize is for the cpu backend, on cuda use the int8 stage-1 checkpoint"
+            )
+        if weight_cache is None:
+            llm = load()
+            before = model_nbytes(llm)
+            quantize_model(llm, args.quantize, args.quantize_group_size)
+            print(
+                f"{name}: {args.quantize} weights, {before / 2**30:.2f} -> "
+                f"{model_nbytes(llm) / 2**30:.2f} GiB"
+            )
+            return llm
+        llm, hit = quantized_model(
+            weight_cache,
+            model_path,
+            load,
+            args.quantize,
+            args.quantize_group_size,
+            backend.dtype,
+            attn_implementation=backend.attn_implementation,
+        )
+        print(
+            f"{name}: {args.quantize} weights, {model_nbytes(llm) / 2**30:.2f} GiB "
+            f"{'mapped from the' if hit else 'quantized into a'} snapshot"
+        )
+        return llm
+
+    def load_stage1():
+        def load():
+            return load_model(args.stage1_model, "int8" if stage1_int8 else "bf16")
+
+        if weight_cache is None or backend.name != "cuda":
+            return load()
+        if stage1_int8:
+            llm, hit = bnb_int8_model(
+                weight_cache,
+                args.stage1_model,
+                load,
+                backend.dtype,
+                attn_implementation=backend.attn_implementation,
+            )
+            kind = "bitsandbytes int8"
+        elif mmgp_quantizes:
+            llm, hit = mmgp_quantized_model(
+                weight_cache,
+                args.stage1_model,
+                load,
+                backend.dtype,
+                backend.attn_implementation,
+            )
+            kind = "mmgp qint8"
+        else:
+            return load()
+        print(
+            f"stage 1: {kind} weights {'loaded from the' if hit else 'saved to a'} snapshot"
+        )
+        return llm
+
+    pipeline = {}
+    if "stage1" in parts:
+        pipeline["stage1"] = load_llm("stage 1", args.stage1_model, load_stage1).eval()
+
+    if "stage2" in parts:
+        pipeline["stage2"] = load_llm("stage 2", args.stage2_model, load_stage2).eval()
+
+    if "codec" in parts:
+        model_config = OmegaConf.load(args.basic_model_config)
+        codec_model = eval(model_config.generator.name)(
+            **model_config.generator.config
+        ).to(device)
+        parameter_dict = torch.load(
+            args.resume_path, map_location="cpu", weights_only=False
+        )
+        codec_model.load_state_dict(parameter_dict["codec_model"])
+        del parameter_dict
+        codec_model.to(device)
+        codec_model.eval()
+        pipeline["codec"] = codec_model
+    if "vocoders" in parts:
+        pipeline["vocoders"] = build_codec_model(
+            args.config_path, args.vocal_decoder_path, args.inst_decoder_path
+        )
+    return pipeline
 
-    pipe = {"transformer": model, "stage2": model_stage2}
 
-    quantizeTransformer = args.profile == 3 or args.profile == 4 or args.profile == 5
+def main(args, pipeline=None):
+    """
+    Run one request. pipeline: models from load_pipeline to use instead of
+    loading them.
+    """
+    stage1_model = args.stage1_model
+    stage2_model = args.stage2_model
+    cuda_idx = args.cuda_idx
+    max_new_tokens = args.max_new_tokens
+    os.makedirs(args.output_dir, exist_ok=True)
 
-    codectool = CodecManipulator("xcodec", 0, 1)
-    codectool_stage2 = CodecManipulator("xcodec", 0, 8)
-    model_config = OmegaConf.load(args.basic_model_config)
-    codec_model = eval(model_config.generator.name)(**model_config.generator.config).to(
-        device
+    def seed_everything(seed=42):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed_all(seed)
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+
+    seed_everything(args.seed)
+
+    # load tokenizer and model
+    backend = backend_from_args(args)
+    device = backend.device
+    # the resolved settings change the samples, record them instead of "auto"
+    args.dtype = str(backend.dtype).replace("torch.", "")
+    args.attn_implementation = backend.attn_implementation
+    print(backend)
+    if args.compile:
+        compile_cache_dir = args.compile_cache_dir or (
+            os.path.join(args.cache_dir, "compile") if args.cache_dir else ""
+        )
+        if compile_cache_dir:
+            print(f"compile cache: {enable_compile_cache(compile_cache_dir)}")
+
+    def split_lyrics(lyrics):
+        pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
+        segments = re.findall(pattern, lyrics, re.DOTALL)
+        structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
+        return structured_lyrics
+
+    # Call the function and print the result
+    stage1_output_set = []
+    # Tips:
+    # genre tags support instrumental，genre，mood，vocal timbr and vocal gender
+    # all kinds of tags are needed
+    if args.genre_txt.endswith(".txt"):
+        with open(args.genre_txt, "r", encoding="utf-8") as f:
+            genres = f.read().strip()
+    else:
+        genres = args.genre_txt
+
+    if args.lyrics_txt.endswith(".txt"):
+        with open(args.lyrics_txt, "r", encoding="utf-8") as f:
+            lyrics = split_lyrics(f.read())
+    else:
+        lyrics = split_lyrics(args.lyrics_txt)
+
+    # identical requests are deterministic, answer them from the result cache
+    result_cache = stage1_cache = None
+    if args.cache_dir:
+        max_bytes = args.cache_max_gb * 1e9 if args.cache_max_gb > 0 else None
+        max_age = (
+            args.cache_max_age_days * 86400 if args.cache_max_age_days > 0 else None
+        )
+        result_cache = ResultCache(
+            os.path.join(args.cache_dir, "results"), max_bytes, max_age
+        )
+        if args.cache_stage1:
+            stage1_cache = ResultCache(
+                os.path.join(args.cache_dir, "stage1"), max_bytes, max_age
+            )
+    stage1_key = stage1_fingerprint(args, genres, lyrics, device)
+    stage2_key = stage2_fingerprint(args, stage1_key)
+    request_key = request_fingerprint(args, stage2_key)
+    if result_cache is not None:
+        cached = result_cache.restore(request_key, args.output_dir)
+        if cached is not None:
+            output_audio = os.path.join(
+                args.output_dir, cached["metadata"]["output_audio"]
+            )
+            print(f"Result cache hit: {output_audio}")
+            return output_audio
+
+    # a stage-1 cache hit restores the stage-1 tokens (and the stage-2 codes
+    # made with the same stage-2 args) before any model is loaded: stage 1
+    # is skipped and its model never loaded
+    cached_job = stage1_cache.path(stage1_key, "job.yuejob") if stage1_cache else None
+    stage2_codes = None
+    if cached_job is not None:
+        print(f"Stage-1 cache hit: {cached_job}")
+        with JobArtifact(cached_job) as job:
+            job_name = job.metadata["name"]
+            stage1_output_set = job.metadata["tracks"]
+            soa_idx, eoa_idx = job.metadata["soa_idx"], job.metadata["eoa_idx"]
+            raw_output = torch.from_numpy(job["raw_tokens"].astype(np.int64))
+            raw_output = raw_output.to(device).unsqueeze(0)
+            tracks = [name[len(job_name) + 1 :] for name in stage1_output_set]
+            stage1_codes = [
+                torch.from_numpy(job[f"stage1/{t}"].astype(np.int64)).to(device)
+                for t in tracks
+            ]
+            if job.metadata.get("stage2_key") == stage2_key:
+                stage2_codes = [
+                    torch.from_numpy(job[f"stage2/{t}"].astype(np.int64))
+                    for t in tracks
+                ]
+
+    if stage2_codes is None and (args.ram_budget_gb > 0 or args.vram_budget_gb > 0):
+        # after the cache lookups, which key the budgets instead of the
+        # profile and stage-2 batch size the plan chooses; nothing to plan
+        # when both stages come from the stage-1 cache
+        plan = plan_from_args(args, backend)
+        print(plan)
+        plan.apply(args)
+
+    mmtokenizer = get_mm_tokenizer(
+        (Path(current_dir) / "mm_tokenizer_v0.2_hf" / "tokenizer.model").as_posix()
     )
-    parameter_dict = torch.load(
-        args.resume_path, map_location="cpu", weights_only=False
+
+    # every part of the pipeline is loaded for the phases that use it, the
+    # next phase's parts in the background; parts passed in stay as they are
+    keep = set(pipeline or ())
+    if args.disable_offload_model:
+        keep.add("stage1")
+    # mmgp's offload profile places the LLMs on cuda, streamed LLMs
+    # (--profile 6) place their blocks themselves
+    offloaded = backend.name == "cuda" and args.profile != STREAM_PROFILE
+    residency = PhaseResidency(
+        pipeline or {},
+        lambda parts: load_pipeline(args, backend, parts),
+        device,
+        keep=keep,
+        placed=("stage1", "stage2") if offloaded else (),
     )
-    codec_model.load_state_dict(parameter_dict["codec_model"])
-    del parameter_dict
-    codec_model.to(device)
-    codec_model.eval()
+    model = codec_model = None
+    if cached_job is None:
+        parts = residency.enter("stage1")
+        model, codec_model = parts["stage1"], parts["codec"]
+    if stage2_codes is not None:
+        # both stages restored, only the codec and the vocoders run
+        residency.prefetch("vocoder")
+        model_stage2 = None
+    elif offloaded:
+        # the offload profile takes the LLMs it runs up front
+        model_stage2 = residency.get("stage2")
+    else:
+        residency.prefetch("stage2")
+        model_stage2 = None
 
-    print("profile:" + str(args.profile))
+    pipe = {
+        name: llm
+        for name, llm in (("transformer", model), ("stage2", model_stage2))
+        if llm is not None
+    }
 
-    offload.profile(
-        pipe,
-        profile_no=args.profile,
-        quantizeTransformer=quantizeTransformer,
-        compile=False,
-        verboseLevel=1,
-    )
+    quantizeTransformer = args.profile == 3 or args.profile == 4 or args.profile == 5
+
+    codectool = CodecManipulator("xcodec", 0, 1)
+    codectool_stage2 = CodecManipulator("xcodec", 0, 8)
+    # compiled decoders see codes padded to whole 6s chunks
+    bucket_frames = 300 if args.compile else 0
+
+    if args.profile == STREAM_PROFILE:
+        print(f"profile: {STREAM_PROFILE}, streaming the LLM decoder blocks")
+    elif backend.name == "cuda" and pipe:
+        print("profile:" + str(args.profile))
+
+        offload.profile(
+            pipe,
+            profile_no=args.profile,
+            quantizeTransformer=quantizeTransformer,
+            # --compile compiles the static-shape parts below instead of
+            # every transformer block for dynamic shapes
+            compile=False,
+            verboseLevel=1,
+        )
+    elif backend.name != "cuda":
+        # mmgp profiles move weights between cpu and gpu, on cpu they stay put
+        print("profile: ignored on the cpu backend")
 
     class BlockTokenRangeProcessor(LogitsProcessor):
         def __init__(self, start_id, end_id):
@@ -421,228 +944,301 @@ def main(args):
             audio_prompt.unsqueeze_(0)
         with torch.no_grad():
             raw_codes = codec_model.encode(audio_prompt.to(device), target_bw=target_bw)
-        raw_codes = raw_codes.transpose(0, 1)
-        raw_codes = raw_codes.cpu().numpy().astype(np.int16)
-        return raw_codes
-
-    def split_lyrics(lyrics):
-        pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
-        segments = re.findall(pattern, lyrics, re.DOTALL)
-        structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
-        return structured_lyrics
-
-    # Call the function and print the result
-    stage1_output_set = []
-    # Tips:
-    # genre tags support instrumental，genre，mood，vocal timbr and vocal gender
-    # all kinds of tags are needed
-    if args.genre_txt.endswith(".txt"):
-        with open(args.genre_txt, "r", encoding="utf-8") as f:
-            genres = f.read().strip()
-    else:
-        genres = args.genre_txt
-
-    if args.lyrics_txt.endswith(".txt"):
-        with open(args.lyrics_txt, "r", encoding="utf-8") as f:
-            lyrics = split_lyrics(f.read())
-    else:
-        lyrics = split_lyrics(args.lyrics_txt)
-
-    # intruction
-    full_lyrics = "\n".join(lyrics)
-    prompt_texts = [
-        f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n{full_lyrics}"
-    ]
-    prompt_texts += lyrics
-
-    random_id = uuid.uuid4()
-    output_seq = None
-    # Here is suggested decoding config
-    top_p = 0.93
-    temperature = 1.0
-    repetition_penalty = args.repetition_penalty
-    # special tokens
-    start_of_segment = mmtokenizer.tokenize("[start_of_segment]")
-    end_of_segment = mmtokenizer.tokenize("[end_of_segment]")
-    # Format text prompt
-    run_n_segments = min(args.run_n_segments + 1, len(lyrics))
-    raw_output = None
-    for i, p in enumerate(
-        tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference...")
-    ):
-        section_text = p.replace("[start_of_segment]", "").replace(
-            "[end_of_segment]", ""
+        # keep the codes on device, they are spliced straight into the prompt
+        return raw_codes.transpose(0, 1).long()
+
+    # checkpoints are keyed like the cache, so a rerun of the same request finds them
+    checkpoint = None
+    if args.checkpoint_dir:
+        checkpoint = JobCheckpoint(
+            os.path.join(args.checkpoint_dir, stage1_key), stage2_key, device
         )
-        guidance_scale = 1.5 if i <= 1 else 1.2
-        if i == 0:
-            continue
-        if i == 1:
-            if args.use_dual_tracks_prompt or args.use_audio_prompt:
-                if args.use_dual_tracks_prompt:
-                    vocals_ids = load_audio_mono(args.vocal_track_prompt_path)
-                    instrumental_ids = load_audio_mono(
-                        args.instrumental_track_prompt_path
-                    )
-                    vocals_ids = encode_audio(
-                        codec_model, vocals_ids, device, target_bw=0.5
-                    )
-                    instrumental_ids = encode_audio(
-                        codec_model, instrumental_ids, device, target_bw=0.5
-                    )
-                    vocals_ids = codectool.npy2ids(vocals_ids[0])
-                    instrumental_ids = codectool.npy2ids(instrumental_ids[0])
-                    ids_segment_interleaved = rearrange(
-                        [np.array(vocals_ids), np.array(instrumental_ids)],
-                        "b n -> (n b)",
+
+    def instruction_text(genres, lyrics):
+        full_lyrics = "\n".join(lyrics)
+        return f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n{full_lyrics}"
+
+    # edit mode: the previous job of this song, with some lyrics changed since
+    edit_job = JobArtifact(args.edit_from) if args.edit_from else None
+
+    if cached_job is None:
+        # intruction
+        prompt_texts = [instruction_text(genres, lyrics)]
+        prompt_texts += lyrics
+
+        random_id = uuid.uuid4()
+        output_seq = None
+        # Here is suggested decoding config
+        top_p = 0.93
+        temperature = 1.0
+        repetition_penalty = args.repetition_penalty
+        # special tokens
+        start_of_segment = mmtokenizer.tokenize("[start_of_segment]")
+        end_of_segment = mmtokenizer.tokenize("[end_of_segment]")
+
+        def ids_tensor(*parts):
+            """Concatenate token id lists and audio id tensors into one (L,) tensor on device."""
+            return torch.cat(
+                [
+                    (
+                        part.to(device=device, dtype=torch.long)
+                        if torch.is_tensor(part)
+                        else torch.as_tensor(part, dtype=torch.long, device=device)
                     )
-                    audio_prompt_codec = ids_segment_interleaved[
-                        int(args.prompt_start_time * 50 * 2) : int(
-                            args.prompt_end_time * 50 * 2
+                    for part in parts
+                ]
+            )
+
+        # Format text prompt
+        run_n_segments = min(args.run_n_segments + 1, len(lyrics))
+        raw_output = None
+        resume_from = 1
+        resumed = checkpoint.resume_segment() if checkpoint is not None else None
+        if resumed is not None:
+            last_segment, raw_output = resumed
+            resume_from = last_segment + 1
+            print(f"Resuming stage 1 after segment {last_segment}")
+        elif edit_job is not None:
+            kept = reusable_stage1_prefix(
+                edit_job,
+                args,
+                genres,
+                lyrics,
+                instruction_text(
+                    edit_job.metadata["genres"], edit_job.metadata["lyrics"]
+                ),
+                prompt_texts[0],
+                mmtokenizer.tokenize,
+            )
+            if kept is not None:
+                resume_from = kept[0] + 1
+                raw_output = torch.from_numpy(kept[1]).unsqueeze(0).to(device)
+                print(f"Edit mode: reusing the first {kept[0]} segments")
+        # one KV cache for the whole song, see --long_context
+        decoder = None
+        fused_cfg = args.fused_cfg or args.restricted_sampler
+        if args.long_context or args.kv_cache_dtype != "auto" or fused_cfg:
+            decoder = Stage1Decoder(
+                model,
+                kv_dtype=args.kv_cache_dtype,
+                fused_cfg=fused_cfg,
+                cfg_tokens=args.cfg_tokens,
+            )
+        for i, p in enumerate(
+            tqdm(prompt_texts[:run_n_segments], desc="Stage1 inference...")
+        ):
+            section_text = p.replace("[start_of_segment]", "").replace(
+                "[end_of_segment]", ""
+            )
+            guidance_scale = 1.5 if i <= 1 else 1.2
+            if i < resume_from:
+                continue
+            if i == 1:
+                if args.use_dual_tracks_prompt or args.use_audio_prompt:
+                    if args.use_dual_tracks_prompt:
+                        vocals_ids = load_audio_mono(args.vocal_track_prompt_path)
+                        instrumental_ids = load_audio_mono(
+                            args.instrumental_track_prompt_path
                         )
-                    ]
-                    audio_prompt_codec = audio_prompt_codec.tolist()
-                elif args.use_audio_prompt:
-                    audio_prompt = load_audio_mono(args.audio_prompt_path)
-                    raw_codes = encode_audio(
-                        codec_model, audio_prompt, device, target_bw=0.5
-                    )
-                    # Format audio prompt
-                    code_ids = codectool.npy2ids(raw_codes[0])
-                    audio_prompt_codec = code_ids[
-                        int(args.prompt_start_time * 50) : int(
-                            args.prompt_end_time * 50
+                        vocals_ids = encode_audio(
+                            codec_model, vocals_ids, device, target_bw=0.5
                         )
-                    ]  # 50 is tps of xcodec
-                audio_prompt_codec_ids = (
-                    [mmtokenizer.soa]
-                    + codectool.sep_ids
-                    + audio_prompt_codec
-                    + [mmtokenizer.eoa]
-                )
-                sentence_ids = (
-                    mmtokenizer.tokenize("[start_of_reference]")
-                    + audio_prompt_codec_ids
-                    + mmtokenizer.tokenize("[end_of_reference]")
+                        instrumental_ids = encode_audio(
+                            codec_model, instrumental_ids, device, target_bw=0.5
+                        )
+                        vocals_ids = codectool.npy2ids(vocals_ids[0])
+                        instrumental_ids = codectool.npy2ids(instrumental_ids[0])
+                        # "b n -> (n b)"
+                        ids_segment_interleaved = torch.stack(
+                            [vocals_ids, instrumental_ids], dim=1
+                        ).reshape(-1)
+                        audio_prompt_codec = ids_segment_interleaved[
+                            int(args.prompt_start_time * 50 * 2) : int(
+                                args.prompt_end_time * 50 * 2
+                            )
+                        ]
+                    elif args.use_audio_prompt:
+                        audio_prompt = load_audio_mono(args.audio_prompt_path)
+                        raw_codes = encode_audio(
+                            codec_model, audio_prompt, device, target_bw=0.5
+                        )
+                        # Format audio prompt
+                        code_ids = codectool.npy2ids(raw_codes[0])
+                        audio_prompt_codec = code_ids[
+                            int(args.prompt_start_time * 50) : int(
+                                args.prompt_end_time * 50
+                            )
+                        ]  # 50 is tps of xcodec
+                    head_id = ids_tensor(
+                        mmtokenizer.tokenize(prompt_texts[0]),
+                        mmtokenizer.tokenize("[start_of_reference]"),
+                        [mmtokenizer.soa] + codectool.sep_ids,
+                        audio_prompt_codec,
+                        [mmtokenizer.eoa],
+                        mmtokenizer.tokenize("[end_of_reference]"),
+                    )
+                else:
+                    head_id = mmtokenizer.tokenize(prompt_texts[0])
+                prompt_ids = ids_tensor(
+                    head_id,
+                    start_of_segment,
+                    mmtokenizer.tokenize(section_text),
+                    [mmtokenizer.soa] + codectool.sep_ids,
                 )
-                head_id = mmtokenizer.tokenize(prompt_texts[0]) + sentence_ids
             else:
-                head_id = mmtokenizer.tokenize(prompt_texts[0])
-            prompt_ids = (
-                head_id
-                + start_of_segment
-                + mmtokenizer.tokenize(section_text)
-                + [mmtokenizer.soa]
-                + codectool.sep_ids
-            )
-        else:
-            prompt_ids = (
-                end_of_segment
-                + start_of_segment
-                + mmtokenizer.tokenize(section_text)
-                + [mmtokenizer.soa]
-                + codectool.sep_ids
-            )
+                prompt_ids = ids_tensor(
+                    end_of_segment,
+                    start_of_segment,
+                    mmtokenizer.tokenize(section_text),
+                    [mmtokenizer.soa] + codectool.sep_ids,
+                )
 
-        prompt_ids = torch.as_tensor(prompt_ids).unsqueeze(0).to(device)
-        input_ids = torch.cat([raw_output, prompt_ids], dim=1) if i > 1 else prompt_ids
-        # Use window slicing in case output sequence exceeds the context of model
-        max_context = 16384 - max_new_tokens - 1
-        if input_ids.shape[-1] > max_context:
-            print(
-                f"Section {i}: output length {input_ids.shape[-1]} exceeding context length {max_context}, now using the last {max_context} tokens."
+            prompt_ids = prompt_ids.unsqueeze(0)
+            input_ids = (
+                torch.cat([raw_output, prompt_ids], dim=1) if i > 1 else prompt_ids
             )
-            input_ids = input_ids[:, -(max_context):]
-        with torch.no_grad():
-            output_seq = model.generate(
-                input_ids=input_ids,
+            logits_processor = LogitsProcessorList(
+                [
+                    BlockTokenRangeProcessor(0, 32002),
+                    BlockTokenRangeProcessor(32016, 32016),
+                ]
+            )
+            if args.repetition_window > 0:
+                # penalise recent codebook-0 tokens of this segment only
+                logits_processor.append(
+                    WindowedRepetitionPenaltyProcessor(
+                        repetition_penalty,
+                        args.repetition_window,
+                        codectool.global_offset,
+                        codectool.global_offset + codectool.codebook_size,
+                    )
+                )
+            generation_kwargs = dict(
                 max_new_tokens=max_new_tokens,
                 min_new_tokens=100,
                 do_sample=True,
                 top_p=top_p,
                 temperature=temperature,
-                repetition_penalty=repetition_penalty,
+                repetition_penalty=(
+                    1.0 if args.repetition_window > 0 else repetition_penalty
+                ),
                 eos_token_id=mmtokenizer.eoa,
                 pad_token_id=mmtokenizer.eoa,
-                logits_processor=LogitsProcessorList(
-                    [
-                        BlockTokenRangeProcessor(0, 32002),
-                        BlockTokenRangeProcessor(32016, 32016),
-                    ]
-                ),
+                logits_processor=logits_processor,
                 guidance_scale=guidance_scale,
             )
-            if output_seq[0][-1].item() != mmtokenizer.eoa:
-                tensor_eoa = torch.as_tensor([[mmtokenizer.eoa]]).to(model.device)
-                output_seq = torch.cat((output_seq, tensor_eoa), dim=1)
-            if i > 1 or raw_output is not None:
-                raw_output = torch.cat(
-                    [raw_output, prompt_ids, output_seq[:, input_ids.shape[-1] :]],
-                    dim=1,
+            if args.restricted_sampler:
+                # the valid ids subsume the token blocks
+                generation_kwargs["logits_processor"] = None
+                generation_kwargs["sampler"] = RestrictedSampler(
+                    stage1_valid_ids(codectool, mmtokenizer.eoa, device),
+                    model.config.vocab_size,
+                    guidance_scale=guidance_scale,
+                    repetition_penalty=repetition_penalty,
+                    repetition_window=args.repetition_window,
+                    min_new_tokens=generation_kwargs["min_new_tokens"],
+                    eos_token_id=mmtokenizer.eoa,
+                    temperature=temperature,
+                    top_k=model.generation_config.top_k,
+                    top_p=top_p,
                 )
+            if decoder is not None:
+                # everything before the first segment is the instruction/reference block
+                n_sink = torch.nonzero(input_ids[0] == start_of_segment[0])[0].item()
+                new_tokens = decoder.generate(
+                    input_ids,
+                    n_sink,
+                    # sizes the preallocated cache, never cuts the segment short
+                    token_budget=segment_token_budget(section_text, max_new_tokens),
+                    **generation_kwargs,
+                )
+                output_seq = torch.cat([input_ids, new_tokens], dim=1)
             else:
-                raw_output = output_seq
-
-    # save raw output and check sanity
-    ids = raw_output[0].cpu().numpy()
-    soa_idx = np.where(ids == mmtokenizer.soa)[0].tolist()
-    eoa_idx = np.where(ids == mmtokenizer.eoa)[0].tolist()
-    if len(soa_idx) != len(eoa_idx):
-        raise ValueError(
-            f"invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}"
-        )
+                # Use window slicing in case output sequence exceeds the context of model
+                max_context = 16384 - max_new_tokens - 1
+                if input_ids.shape[-1] > max_context:
+                    print(
+                        f"Section {i}: output length {input_ids.shape[-1]} exceeding context length {max_context}, now using the last {max_context} tokens."
+                    )
+                    input_ids = input_ids[:, -(max_context):]
+                with torch.no_grad():
+                    output_seq = model.generate(
+                        input_ids=input_ids, **generation_kwargs
+                    )
+            with torch.no_grad():
+                if output_seq[0][-1].item() != mmtokenizer.eoa:
+                    tensor_eoa = torch.as_tensor(
+                        [[mmtokenizer.eoa]], device=model.device
+                    )
+                    output_seq = torch.cat((output_seq, tensor_eoa), dim=1)
+                if i > 1 or raw_output is not None:
+                    raw_output = torch.cat(
+                        [raw_output, prompt_ids, output_seq[:, input_ids.shape[-1] :]],
+                        dim=1,
+                    )
+                else:
+                    raw_output = output_seq
+            if checkpoint is not None:
+                checkpoint.save_segment(i, raw_output)
 
-    vocals = []
-    instrumentals = []
-    range_begin = 1 if args.use_audio_prompt or args.use_dual_tracks_prompt else 0
-    for i in range(range_begin, len(soa_idx)):
-        codec_ids = ids[soa_idx[i] + 1 : eoa_idx[i]]
-        if codec_ids[0] == 32016:
-            codec_ids = codec_ids[1:]
-        codec_ids = codec_ids[: 2 * (codec_ids.shape[0] // 2)]
-        vocals_ids = codectool.ids2npy(rearrange(codec_ids, "(n b) -> b n", b=2)[0])
-        vocals.append(vocals_ids)
-        instrumentals_ids = codectool.ids2npy(
-            rearrange(codec_ids, "(n b) -> b n", b=2)[1]
-        )
-        instrumentals.append(instrumentals_ids)
-    vocals = np.concatenate(vocals, axis=1)
-    instrumentals = np.concatenate(instrumentals, axis=1)
-    vocal_save_path = os.path.join(
-        stage1_output_dir,
-        f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}_vtrack".replace(
-            ".", "@"
-        )
-        + ".npy",
-    )
-    inst_save_path = os.path.join(
-        stage1_output_dir,
-        f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}_itrack".replace(
+        if decoder is not None:
+            churn = decoder.churn()
+            print(
+                f"Stage1 KV cache: {churn['allocations']} allocations, "
+                f"{churn['allocated_mb']:.1f} MiB allocated, "
+                f"{churn['resident_mb']:.1f} MiB resident"
+            )
+
+        # save raw output and check sanity
+        # the token stream stays on device, only the soa/eoa positions come to the host
+        ids = raw_output[0]
+        soa_idx = torch.nonzero(ids == mmtokenizer.soa).flatten().tolist()
+        eoa_idx = torch.nonzero(ids == mmtokenizer.eoa).flatten().tolist()
+        if len(soa_idx) != len(eoa_idx):
+            raise ValueError(
+                f"invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}"
+            )
+
+        vocals = []
+        instrumentals = []
+        range_begin = 1 if args.use_audio_prompt or args.use_dual_tracks_prompt else 0
+        for i in range(range_begin, len(soa_idx)):
+            codec_ids = ids[soa_idx[i] + 1 : eoa_idx[i]]
+            if codec_ids[:1].eq(32016).any():
+                codec_ids = codec_ids[1:]
+            codec_ids = codec_ids[: 2 * (codec_ids.shape[0] // 2)]
+            # "(n b) -> b n"
+            codec_ids = codec_ids.reshape(-1, 2).t()
+            vocals.append(codectool.ids2npy(codec_ids[0]))
+            instrumentals.append(codectool.ids2npy(codec_ids[1]))
+        vocals = torch.cat(vocals, dim=1)
+        instrumentals = torch.cat(instrumentals, dim=1)
+        job_name = f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}".replace(
             ".", "@"
         )
-        + ".npy",
-    )
-    np.save(vocal_save_path, vocals)
-    np.save(inst_save_path, instrumentals)
-    stage1_output_set.append(vocal_save_path)
-    stage1_output_set.append(inst_save_path)
-
-    # offload model
-    # if not args.disable_offload_model:
-    #     model.cpu()
-    #     del model
-    #     torch.cuda.empty_cache()
-
-    print("Stage 2 inference...")
-    # model_stage2 = AutoModelForCausalLM.from_pretrained(
-    #     stage2_model,
-    #     torch_dtype=torch.float16,
-    #     attn_implementation="flash_attention_2"
-    #     )
-    # model_stage2.to(device)
-    # model_stage2.eval()
-
-    # if torch.__version__ >= "2.0.0":
-    #     model_stage2 = torch.compile(model_stage2)
+        stage1_output_set.append(job_name + "_vtrack")
+        stage1_output_set.append(job_name + "_itrack")
+        stage1_codes = [vocals, instrumentals]
+
+    # offload model: the residency releases stage 1 unless
+    # --disable_offload_model once nothing here references it
+    model = pipe = decoder = parts = None
+    stage2_decoder = None
+    # stage-2 codes restored from the stage-1 cache need no stage-2 model
+    if stage2_codes is None:
+        model_stage2 = residency.enter("stage2")["stage2"]
+        residency.prefetch("vocoder")
+        print("Stage 2 inference...")
+    if stage2_codes is None and args.compile:
+        if model_stage2.generation_config.do_sample:
+            print("compile: the stage-2 model samples, keeping the generate loop")
+        elif args.profile == STREAM_PROFILE:
+            # a compiled step would run on the blocks' weights of compile time
+            print("compile: streamed stage-2 blocks, keeping the generate loop")
+        else:
+            stage2_decoder = Stage2Decoder(
+                model_stage2, args.stage2_batch_size, compile=True, device=device
+            )
 
     def stage2_generate(model, prompt, batch_size=16):
         codec_ids = codectool.unflatten(prompt, n_quantizer=1)
@@ -651,37 +1247,23 @@ def main(args):
             global_offset=codectool.global_offset,
             codebook_size=codectool.codebook_size,
             num_codebooks=codectool.num_codebooks,
-        ).astype(np.int32)
+        )
 
         # Prepare prompt_ids based on batch size or single input
         if batch_size > 1:
-            codec_list = []
-            for i in range(batch_size):
-                idx_begin = i * 300
-                idx_end = (i + 1) * 300
-                codec_list.append(codec_ids[:, idx_begin:idx_end])
-
-            codec_ids = np.concatenate(codec_list, axis=0)
-            prompt_ids = np.concatenate(
-                [
-                    np.tile([mmtokenizer.soa, mmtokenizer.stage_1], (batch_size, 1)),
-                    codec_ids,
-                    np.tile([mmtokenizer.stage_2], (batch_size, 1)),
-                ],
-                axis=1,
-            )
-        else:
-            prompt_ids = np.concatenate(
-                [
-                    np.array([mmtokenizer.soa, mmtokenizer.stage_1]),
-                    codec_ids.flatten(),  # Flatten the 2D array to 1D
-                    np.array([mmtokenizer.stage_2]),
-                ]
-            ).astype(np.int32)
-            prompt_ids = prompt_ids[np.newaxis, ...]
-
-        codec_ids = torch.as_tensor(codec_ids).to(device)
-        prompt_ids = torch.as_tensor(prompt_ids).to(device)
+            # (1, batch_size * 300) -> (batch_size, 300)
+            codec_ids = codec_ids[:, : batch_size * 300].reshape(batch_size, 300)
+        head = torch.as_tensor([mmtokenizer.soa, mmtokenizer.stage_1], device=device)
+        tail = torch.as_tensor([mmtokenizer.stage_2], device=device)
+        if (
+            stage2_decoder is not None
+            and codec_ids.shape[0] <= stage2_decoder.batch_size
+            and codec_ids.shape[1] <= stage2_decoder.frames
+        ):
+            return stage2_decoder.generate(head, codec_ids, tail).reshape(-1)
+        head = head.expand(codec_ids.shape[0], -1)
+        tail = tail.expand(codec_ids.shape[0], -1)
+        prompt_ids = torch.cat([head, codec_ids, tail], dim=1)
         len_prompt = prompt_ids.shape[-1]
 
         block_list = LogitsProcessorList(
@@ -713,211 +1295,304 @@ def main(args):
             prompt_ids = stage2_output
 
         # Return output based on batch size
-        if batch_size > 1:
-            output = prompt_ids.cpu().numpy()[:, len_prompt:]
-            output_list = [output[i] for i in range(batch_size)]
-            output = np.concatenate(output_list, axis=0)
-        else:
-            output = prompt_ids[0].cpu().numpy()[len_prompt:]
-
+        return prompt_ids[:, len_prompt:].reshape(-1)
+
+    def fix_invalid_codes(codes, codebook_size=1024):
+        """
+        Replace out-of-range codes of a (K, T) tensor with the most frequent code
+        of their row; ties go to the code seen first, as Counter.most_common does.
+        """
+        invalid = (codes < 0) | (codes >= codebook_size)
+        if not invalid.any():
+            return codes
+        fixed = codes.clone()
+        positions = torch.arange(codes.shape[1], device=codes.device)
+        for row in torch.nonzero(invalid.any(dim=1)).flatten().tolist():
+            values, inverse, counts = torch.unique(
+                codes[row], return_inverse=True, return_counts=True
+            )
+            first_seen = torch.full_like(counts, codes.shape[1]).scatter_reduce(
+                0, inverse, positions, reduce="amin"
+            )
+            best = counts == counts.max()
+            most_frequent = values[
+                torch.where(best, first_seen, codes.shape[1]).argmin()
+            ]
+            fixed[row, invalid[row]] = most_frequent
+        return fixed
+
+    def stage2_chunk(model, track, prompt, start, end, batch_size):
+        """stage2_generate on frames [start, end), checkpointed per call."""
+        if checkpoint is not None:
+            output = checkpoint.load_chunk(track, start, end)
+            if output is not None:
+                return output
+        output = stage2_generate(model, prompt[:, start:end], batch_size=batch_size)
+        if checkpoint is not None:
+            checkpoint.save_chunk(track, start, end, output)
         return output
 
-    def stage2_inference(model, stage1_output_set, stage2_output_dir, batch_size=4):
-        stage2_result = []
-        for i in tqdm(range(len(stage1_output_set))):
-            output_filename = os.path.join(
-                stage2_output_dir, os.path.basename(stage1_output_set[i])
+    def stage2_incremental(model, prompt, old_prompt, old_codes, batch_size=4):
+        """
+        Stage 2 of an edited track: chunks whose stage-1 tokens did not change
+        take the codes of the previous job, the rest are generated in batches.
+        """
+        spans, kept = unchanged_chunks(old_prompt, prompt)
+        output = torch.empty(
+            (old_codes.shape[0], prompt.shape[-1]), dtype=torch.long, device=device
+        )
+        for a, b in kept:
+            output[:, a:b] = old_codes[:, a:b]
+        todo = [span for span in spans if span not in kept]
+        full = [(a, b) for a, b in todo if b - a == 300]
+        for k in range(0, len(full), batch_size):
+            group = full[k : k + batch_size]
+            codes = codectool_stage2.ids2npy(
+                stage2_generate(
+                    model,
+                    torch.cat([prompt[:, a:b] for a, b in group], dim=1),
+                    batch_size=len(group),
+                )
             )
+            for j, (a, b) in enumerate(group):
+                output[:, a:b] = codes[:, j * 300 : (j + 1) * 300]
+        for a, b in todo:
+            if b - a != 300:
+                output[:, a:b] = codectool_stage2.ids2npy(
+                    stage2_generate(model, prompt[:, a:b], batch_size=1)
+                )
+        print(f"Stage 2: reused {len(kept)} of {len(spans)} chunks")
+        return output
 
-            if os.path.exists(output_filename):
-                print(f"{output_filename} stage2 has done.")
-                continue
-
-            # Load the prompt
-            prompt = np.load(stage1_output_set[i]).astype(np.int32)
-
-            # Only accept 6s segments
-            output_duration = prompt.shape[-1] // 50 // 6 * 6
-            num_batch = output_duration // 6
-
-            if num_batch <= batch_size:
-                # If num_batch is less than or equal to batch_size, we can infer the entire prompt at once
-                output = stage2_generate(
-                    model, prompt[:, : output_duration * 50], batch_size=num_batch
+    def stage2_inference(model, stage1_codes, batch_size=4, previous=None):
+        """
+        previous: optional (stage-1 codes, stage-2 codes) of the previous job for
+        each track, see --edit_from.
+        """
+        stage2_codes = []
+        for i in tqdm(range(len(stage1_codes))):
+            prompt = stage1_codes[i].to(device=device, dtype=torch.long)
+
+            if previous is not None and previous[i] is not None:
+                output = stage2_incremental(
+                    model, prompt, *previous[i], batch_size=batch_size
                 )
             else:
-                # If num_batch is greater than batch_size, process in chunks of batch_size
-                segments = []
-                num_segments = (num_batch // batch_size) + (
-                    1 if num_batch % batch_size != 0 else 0
-                )
-
-                for seg in range(num_segments):
-                    start_idx = seg * batch_size * 300
-                    # Ensure the end_idx does not exceed the available length
-                    end_idx = min(
-                        (seg + 1) * batch_size * 300, output_duration * 50
-                    )  # Adjust the last segment
-                    current_batch_size = (
-                        batch_size
-                        if seg != num_segments - 1 or num_batch % batch_size == 0
-                        else num_batch % batch_size
+                # Only accept 6s segments
+                output_duration = prompt.shape[-1] // 50 // 6 * 6
+                num_batch = output_duration // 6
+
+                if num_batch <= batch_size:
+                    # If num_batch is less than or equal to batch_size, we can infer the entire prompt at once
+                    output = stage2_chunk(
+                        model, i, prompt, 0, output_duration * 50, batch_size=num_batch
                     )
-                    segment = stage2_generate(
-                        model,
-                        prompt[:, start_idx:end_idx],
-                        batch_size=current_batch_size,
+                else:
+                    # If num_batch is greater than batch_size, process in chunks of batch_size
+                    segments = []
+                    num_segments = (num_batch // batch_size) + (
+                        1 if num_batch % batch_size != 0 else 0
                     )
-                    segments.append(segment)
 
-                # Concatenate all the segments
-                output = np.concatenate(segments, axis=0)
+                    for seg in range(num_segments):
+                        start_idx = seg * batch_size * 300
+                        # Ensure the end_idx does not exceed the available length
+                        end_idx = min(
+                            (seg + 1) * batch_size * 300, output_duration * 50
+                        )  # Adjust the last segment
+                        current_batch_size = (
+                            batch_size
+                            if seg != num_segments - 1 or num_batch % batch_size == 0
+                            else num_batch % batch_size
+                        )
+                        segment = stage2_chunk(
+                            model,
+                            i,
+                            prompt,
+                            start_idx,
+                            end_idx,
+                            batch_size=current_batch_size,
+                        )
+                        segments.append(segment)
 
-            # Process the ending part of the prompt
-            if output_duration * 50 != prompt.shape[-1]:
-                ending = stage2_generate(
-                    model, prompt[:, output_duration * 50 :], batch_size=1
-                )
-                output = np.concatenate([output, ending], axis=0)
-            output = codectool_stage2.ids2npy(output)
+                    # Concatenate all the segments
+                    output = torch.cat(segments, dim=0)
+
+                # Process the ending part of the prompt
+                if output_duration * 50 != prompt.shape[-1]:
+                    ending = stage2_chunk(
+                        model,
+                        i,
+                        prompt,
+                        output_duration * 50,
+                        prompt.shape[-1],
+                        batch_size=1,
+                    )
+                    output = torch.cat([output, ending], dim=0)
+                output = codectool_stage2.ids2npy(output)
 
             # Fix invalid codes (a dirty solution, which may harm the quality of audio)
             # We are trying to find better one
-            fixed_output = copy.deepcopy(output)
-            for i, line in enumerate(output):
-                for j, element in enumerate(line):
-                    if element < 0 or element > 1023:
-                        counter = Counter(line)
-                        most_frequant = sorted(
-                            counter.items(), key=lambda x: x[1], reverse=True
-                        )[0][0]
-                        fixed_output[i, j] = most_frequant
-            # save output
-            np.save(output_filename, fixed_output)
-            stage2_result.append(output_filename)
-        return stage2_result
-
-    stage2_result = stage2_inference(
-        model_stage2,
-        stage1_output_set,
-        stage2_output_dir,
-        batch_size=args.stage2_batch_size,
-    )
-    print(stage2_result)
-    print("Stage 2 DONE.\n")
-
-    # convert audio tokens to audio
-    def save_audio(wav: torch.Tensor, path, sample_rate: int, rescale: bool = False):
-        folder_path = os.path.dirname(path)
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-        limit = 0.99
-        max_val = wav.abs().max()
-        wav = wav * min(limit / max_val, 1) if rescale else wav.clamp(-limit, limit)
-        torchaudio.save(
-            str(path),
-            wav,
-            sample_rate=sample_rate,
-            encoding="PCM_S",
-            bits_per_sample=16,
+            stage2_codes.append(fix_invalid_codes(output))
+        return stage2_codes
+
+    previous = None
+    if edit_job is not None:
+        if stage2_reusable(edit_job, args):
+            old_name = edit_job.metadata["name"]
+            old_tracks = [t[len(old_name) + 1 :] for t in edit_job.metadata["tracks"]]
+            previous = []
+            for name in stage1_output_set:
+                track = name[len(job_name) + 1 :]
+                previous.append(
+                    (
+                        torch.from_numpy(
+                            edit_job[f"stage1/{track}"].astype(np.int64)
+                        ).to(device),
+                        torch.from_numpy(
+                            edit_job[f"stage2/{track}"].astype(np.int64)
+                        ).to(device),
+                    )
+                    if track in old_tracks
+                    else None
+                )
+        edit_job.close()
+
+    if stage2_codes is None:
+        stage2_codes = stage2_inference(
+            model_stage2,
+            stage1_codes,
+            batch_size=args.stage2_batch_size,
+            previous=previous,
         )
+        if stage2_decoder is not None and stage2_decoder.timings:
+            timings = stage2_decoder.timings
+            steady = sum(timings[1:]) / max(1, len(timings) - 1)
+            print(
+                f"compile: stage 2 startup {timings[0]:.1f} s (first chunk, "
+                f"compilation included), steady state {steady:.1f} s per chunk"
+            )
+
+    # one file per job instead of a .npy per track and stage
+    job_path = os.path.join(args.output_dir, job_name + ".yuejob")
+    job_arrays = {"raw_tokens": narrow_codes(raw_output[0])}
+    for name, stage1, stage2 in zip(stage1_output_set, stage1_codes, stage2_codes):
+        track = name[len(job_name) + 1 :]
+        job_arrays[f"stage1/{track}"] = narrow_codes(stage1)
+        job_arrays[f"stage2/{track}"] = narrow_codes(stage2)
+    save_job(
+        job_path,
+        job_arrays,
+        metadata={
+            "name": job_name,
+            "tracks": stage1_output_set,
+            "genres": genres,
+            "lyrics": lyrics,
+            "soa_idx": soa_idx,
+            "eoa_idx": eoa_idx,
+            "stage1_key": stage1_key,
+            "stage2_key": stage2_key,
+            "args": vars(args),
+        },
+        compression=args.artifact_compression,
+    )
+    if stage1_cache is not None:
+        stage1_cache.put(stage1_key, {"job.yuejob": job_path})
+    if checkpoint is not None:
+        # the job artifact now holds everything the checkpoints did
+        checkpoint.clear()
+    print(job_path)
+    print("Stage 2 DONE.\n")
+    model_stage2 = stage2_decoder = None
+    parts = residency.enter("vocoder")
+    codec_model, (vocal_decoder, inst_decoder) = parts["codec"], parts["vocoders"]
+    if args.compile and "decode" not in vars(codec_model):
+        codec_model.decode = torch.compile(codec_model.decode, dynamic=False)
+    residency.close()
+    waits = ", ".join(f"{p} {w:.1f} s" for p, w in residency.waits.items())
+    print(f"waited for weights: {waits}")
+
+    # convert audio tokens to audio; files are encoded in the background
+    writer = AudioWriter(max_workers=args.writer_workers)
+    ext = "." + args.output_format
 
     # reconstruct tracks
     recons_output_dir = os.path.join(args.output_dir, "recons")
     recons_mix_dir = os.path.join(recons_output_dir, "mix")
-    os.makedirs(recons_mix_dir, exist_ok=True)
-    tracks = []
-    for npy in stage2_result:
-        codec_result = np.load(npy)
-        decodec_rlt = []
-        with torch.no_grad():
-            decoded_waveform = codec_model.decode(
-                torch.as_tensor(codec_result.astype(np.int16), dtype=torch.long)
-                .unsqueeze(0)
-                .permute(1, 0, 2)
-                .to(device)
-            )
-        decoded_waveform = decoded_waveform.cpu().squeeze(0)
-        decodec_rlt.append(torch.as_tensor(decoded_waveform, device="cpu"))
-        decodec_rlt = torch.cat(decodec_rlt, dim=-1)
-        save_path = os.path.join(
-            recons_output_dir, os.path.splitext(os.path.basename(npy))[0] + ".mp3"
-        )
-        tracks.append(save_path)
-        save_audio(decodec_rlt, save_path, 16000)
+    os.makedirs(recons_output_dir, exist_ok=True)
+    stem_names = stage1_output_set
+    t0 = time.perf_counter()
+    recons_stems = reconstruct_stems(
+        codec_model, stage2_codes, device, bucket_frames=bucket_frames
+    )
+    if args.compile:
+        print(f"compile: xcodec decode {time.perf_counter() - t0:.1f} s")
+    for name, stem in zip(stem_names, recons_stems):
+        writer.submit(stem, os.path.join(recons_output_dir, name + ext), 16000)
     # mix tracks
-    for inst_path in tracks:
-        try:
-            if (
-                inst_path.endswith(".wav") or inst_path.endswith(".mp3")
-            ) and "_itrack" in inst_path:
-                # find pair
-                vocal_path = inst_path.replace("_itrack", "_vtrack")
-                if not os.path.exists(vocal_path):
-                    continue
-                # mix
-                recons_mix = os.path.join(
-                    recons_mix_dir,
-                    os.path.basename(inst_path).replace("_itrack", "_mixed"),
-                )
-                vocal_stem, sr = sf.read(inst_path)
-                instrumental_stem, _ = sf.read(vocal_path)
-                mix_stem = (vocal_stem + instrumental_stem) / 1
-                sf.write(recons_mix, mix_stem, sr)
-        except Exception as e:
-            print(e)
+    mix_name = (
+        next(name for name in stem_names if "_itrack" in name).replace(
+            "_itrack", "_mixed"
+        )
+        + ext
+    )
+    recons_mix = mix_stems(recons_stems)
+    if args.keep_intermediate:
+        writer.submit(recons_mix, os.path.join(recons_mix_dir, mix_name), 16000)
 
     # vocoder to upsample audios
-    vocal_decoder, inst_decoder = build_codec_model(
-        args.config_path, args.vocal_decoder_path, args.inst_decoder_path
-    )
+    if args.compile:
+        for decoder in (vocal_decoder, inst_decoder):
+            if "forward" not in vars(decoder):
+                decoder.forward = torch.compile(decoder.forward, dynamic=False)
     vocoder_output_dir = os.path.join(args.output_dir, "vocoder")
     vocoder_stems_dir = os.path.join(vocoder_output_dir, "stems")
     vocoder_mix_dir = os.path.join(vocoder_output_dir, "mix")
-    os.makedirs(vocoder_mix_dir, exist_ok=True)
     os.makedirs(vocoder_stems_dir, exist_ok=True)
-    for npy in stage2_result:
-        if "_itrack" in npy:
-            # Process instrumental
-            instrumental_output = process_audio(
-                npy,
-                os.path.join(vocoder_stems_dir, "itrack.mp3"),
-                args.rescale,
-                args,
-                inst_decoder,
-                codec_model,
-            )
-        else:
-            # Process vocal
-            vocal_output = process_audio(
-                npy,
-                os.path.join(vocoder_stems_dir, "vtrack.mp3"),
-                args.rescale,
-                args,
-                vocal_decoder,
-                codec_model,
-            )
+    t0 = time.perf_counter()
+    vocoder_stems = decode_stems(
+        codec_model,
+        [inst_decoder if "_itrack" in name else vocal_decoder for name in stem_names],
+        stage2_codes,
+        device,
+        bucket_frames=bucket_frames,
+    )
+    if args.compile:
+        print(f"compile: vocoders {time.perf_counter() - t0:.1f} s")
+    for name, stem in zip(stem_names, vocoder_stems):
+        stem_file = ("itrack" if "_itrack" in name else "vtrack") + ext
+        writer.submit(
+            stem, os.path.join(vocoder_stems_dir, stem_file), 44100, args.rescale
+        )
     # mix tracks
-    try:
-        mix_output = instrumental_output + vocal_output
-        vocoder_mix = os.path.join(vocoder_mix_dir, os.path.basename(recons_mix))
-        save_audio(mix_output, vocoder_mix, 44100, args.rescale)
+    mix_output = mix_stems(vocoder_stems)
+    if args.keep_intermediate:
+        vocoder_mix = os.path.join(vocoder_mix_dir, mix_name)
+        writer.submit(mix_output, vocoder_mix, 44100, args.rescale)
         print(f"Created mix: {vocoder_mix}")
-    except RuntimeError as e:
-        print(e)
-        print(
-            f"mix {vocoder_mix} failed! inst: {instrumental_output.shape}, vocal: {vocal_output.shape}"
-        )
 
     # Post process
-    replace_low_freq_with_energy_matched(
-        a_file=recons_mix,  # 16kHz
-        b_file=vocoder_mix,  # 48kHz
-        c_file=os.path.join(args.output_dir, os.path.basename(recons_mix)),
+    output_audio = os.path.join(args.output_dir, mix_name)
+    final_mix = replace_low_freq_with_energy_matched(
+        recons_mix,  # 16kHz
+        mix_output,  # 44.1kHz
+        low_sr=16000,
+        high_sr=44100,
         cutoff_freq=5500.0,
     )
-
-    output_audio = os.path.join(args.output_dir, os.path.basename(recons_mix))
+    writer.submit(final_mix, output_audio, 44100, args.rescale)
+    written = writer.join()
+    writer.close()
+
+    if result_cache is not None:
+        result_cache.put(
+            request_key,
+            {
+                os.path.relpath(path, args.output_dir): path
+                for path in written + [job_path]
+            },
+            metadata={"output_audio": mix_name, "stage2_key": stage2_key},
+        )
 
     return output_audio
 
@@ -0,0 +1,260 @@
+import json
+import lzma
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+import torch
+
+MAGIC = b"YUEJOB\x00\x01"
+ALIGN = 64
+COMPRESSORS = {
+    "zlib": (lambda b: zlib.compress(b, 6), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+COMPRESSION_CHOICES = ("none",) + tuple(COMPRESSORS)
+
+_HEADER = struct.Struct("<8sQ")
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _as_array(value):
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    return np.ascontiguousarray(value)
+
+
+def narrow_codes(codes):
+    """
+    Codec codes fit in 10 bits and are stored as uint16; token ids past 65535
+    (the raw stage-1 stream) fall back to uint32.
+    """
+    codes = _as_array(codes)
+    if codes.size == 0:
+        return codes.astype(np.uint16)
+    lo, hi = int(codes.min()), int(codes.max())
+    if lo < 0:
+        raise ValueError(f"negative code {lo} can not be stored unsigned")
+    if hi <= np.iinfo(np.uint16).max:
+        return codes.astype(np.uint16)
+    return codes.astype(np.uint32)
+
+
+def save_job(path, arrays, metadata=None, compression=None):
+    """
+    Write a single-file job artifact.
+
+    arrays: {name: array or tensor}; names may contain "/" to group entries,
+            e.g. "stage1/vtrack".
+    metadata: json serialisable dict.
+    compression: None/"none" keeps arrays raw so they can be memory-mapped,
+                 "zlib" or "lzma" compresses every array.
+
+    The file is written next to its destination and renamed over it, with a
+    single fsync, so readers never see a half-written job.
+    """
+    if compression in (None, "none"):
+        compress = None
+    elif compression in COMPRESSORS:
+        compress = COMPRESSORS[compression][0]
+    else:
+        raise ValueError(
+            f"unknown compression {compression}, expected one of {COMPRESSION_CHOICES}"
+        )
+
+    index = {}
+    blobs = []
+    offset = 0
+    for name, value in arrays.items():
+        array = _as_array(value)
+        data = array.tobytes()
+        entry = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "compression": None,
+            "raw_nbytes": len(data),
+        }
+        if compress is not None:
+            packed = compress(data)
+            # incompressible data is kept raw and stays mmap-able
+            if len(packed) < len(data):
+                data = packed
+                entry["compression"] = compression
+        entry["offset"] = offset
+        entry["nbytes"] = len(data)
+        index[name] = entry
+        blobs.append(data)
+        offset = _align(offset + len(data))
+
+    header = json.dumps(
+        {"version": 1, "metadata": metadata or {}, "arrays": index},
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        data_start = _align(f.tell())
+        for entry, data in zip(index.values(), blobs):
+            f.seek(data_start + entry["offset"])
+            f.write(data)
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+class JobArtifact(object):
+    """
+    Read side of `save_job`.
+
+    Uncompressed arrays are returned as read-only views into a memory map of
+    the file, so opening a job costs one header parse and slicing an array only
+    touches the pages it covers. Compressed arrays are inflated on first access
+    and cached.
+
+        with JobArtifact(path) as job:
+            job.metadata["genres"]
+            job["stage2/vtrack"][:, 3000:3300]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            magic, header_len = _HEADER.unpack(self._file.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a job artifact")
+            header = json.loads(self._file.read(header_len).decode("utf-8"))
+            self._data_start = _align(_HEADER.size + header_len)
+            self._mmap = (
+                mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(self._file.fileno()).st_size > 0
+                else None
+            )
+        except Exception:
+            self._file.close()
+            raise
+        self.metadata = header["metadata"]
+        self.index = header["arrays"]
+        self._inflated = {}
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        dtype = np.dtype(entry["dtype"])
+        start = self._data_start + entry["offset"]
+        if entry["compression"] is None:
+            count = entry["raw_nbytes"] // dtype.itemsize
+            if count == 0:
+                return np.zeros(entry["shape"], dtype=dtype)
+            array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=start)
+            return array.reshape(entry["shape"])
+        if name not in self._inflated:
+            decompress = COMPRESSORS[entry["compression"]][1]
+            data = decompress(self._mmap[start : start + entry["nbytes"]])
+            array = np.frombuffer(data, dtype=dtype).reshape(entry["shape"])
+            self._inflated[name] = array
+        return self._inflated[name]
+
+    def get(self, name, default=None):
+        return self[name] if name in self.index else default
+
+    def group(self, prefix):
+        """{suffix: array} for every entry stored under `prefix/`."""
+        prefix = prefix.rstrip("/") + "/"
+        return {
+            name[len(prefix) :]: self[name]
+            for name in self.index
+            if name.startswith(prefix)
+        }
+
+    def close(self):
+        self._inflated.clear()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views handed out are still alive; the map goes away with them
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    # Compare a job artifact against the per-track .npy files for a 3 minute song.
+    import shutil
+    import tempfile
+    import time
+
+    frames = 180 * 50
+    rng = np.random.default_rng(0)
+    tracks = ["vtrack", "itrack"]
+    stage1 = {t: rng.integers(0, 1024, (1, frames)) for t in tracks}
+    stage2 = {t: rng.integers(0, 1024, (8, frames)) for t in tracks}
+    raw = rng.integers(0, 83734, (1, 2 * frames + 500))
+
+    root = tempfile.mkdtemp()
+    try:
+        npy_files = []
+        t0 = time.perf_counter()
+        for stage, codes in (("stage1", stage1), ("stage2", stage2)):
+            for t in tracks:
+                npy = os.path.join(root, f"{stage}_{t}.npy")
+                np.save(npy, codes[t])
+                npy_files.append(npy)
+        t_npy_save = time.perf_counter() - t0
+        npy_bytes = sum(os.path.getsize(f) for f in npy_files)
+        t0 = time.perf_counter()
+        loaded = [np.load(f) for f in npy_files]
+        t_npy_load = time.perf_counter() - t0
+
+        arrays = {f"stage1/{t}": narrow_codes(stage1[t]) for t in tracks}
+        arrays.update({f"stage2/{t}": narrow_codes(stage2[t]) for t in tracks})
+        arrays["raw_tokens"] = narrow_codes(raw)
+        print(
+            f"npy:      {len(npy_files)} files {npy_bytes / 1e6:.2f} MB "
+            f"save {t_npy_save * 1e3:.1f} ms load {t_npy_load * 1e3:.1f} ms"
+        )
+        for compression in COMPRESSION_CHOICES:
+            job = os.path.join(root, f"job_{compression}.yuejob")
+            t0 = time.perf_counter()
+            save_job(job, arrays, {"tracks": tracks}, compression=compression)
+            t_save = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            with JobArtifact(job) as artifact:
+                chunk = np.array(artifact["stage2/itrack"][:, 3000:3300])
+                t_slice = time.perf_counter() - t0
+                for name, value in arrays.items():
+                    assert np.array_equal(artifact[name], value), name
+                for t in tracks:
+                    assert np.array_equal(artifact["stage2/" + t], stage2[t])
+                    assert np.array_equal(artifact["stage1/" + t], stage1[t])
+                assert np.array_equal(artifact["raw_tokens"], raw)
+            assert np.array_equal(chunk, stage2["itrack"][:, 3000:3300])
+            print(
+                f"{compression:9s} 1 file  {os.path.getsize(job) / 1e6:.2f} MB "
+                f"save {t_save * 1e3:.1f} ms (1 fsync) open+slice {t_slice * 1e3:.2f} ms"
+            )
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,239 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch import nn
+
+# --profile number of layer streaming, next to mmgp's offload profiles 1-5
+STREAM_PROFILE = 6
+
+
+def _block_tensors(block):
+    """[(module, leaf, is parameter, tensor)] of every tensor of a decoder block."""
+    tensors = []
+    for module in block.modules():
+        for leaf, tensor in module._parameters.items():
+            if tensor is not None:
+                tensors.append((module, leaf, True, tensor.data))
+        for leaf, tensor in module._buffers.items():
+            if tensor is not None:
+                tensors.append((module, leaf, False, tensor))
+    return tensors
+
+
+def _set(module, leaf, parameter, tensor):
+    if parameter:
+        module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[leaf] = tensor
+
+
+class LayerStreamer(object):
+    """
+    Runs the decoder blocks of a causal LM from weights that stay where they
+    are: memory-mapped files (weight_snapshot.map_checkpoint, snapshots) or
+    cpu RAM. Each block is copied into working memory on `device` (and into
+    the model dtype) just before it runs and the copy is dropped after it, so
+    the model needs two blocks of working memory instead of all of them.
+
+    With prefetch, a background thread copies block i + 1 while block i
+    computes, and block 0 of the next forward while the last block computes,
+    so reading the weights (page faults on a map, host-to-device copies)
+    overlaps with compute. The other modules (embeddings, final norm, output
+    head) are moved to `device` once.
+
+    Blocks of a model mapped from files (map_checkpoint, load_snapshot; or
+    mapped=True) are always copied, which is what reads them. Blocks already
+    in RAM are copied only when they change device or dtype, and otherwise
+    run in place.
+
+    stats: seconds spent fetching blocks (on the background thread with
+    prefetch), computing them, and waiting for a fetch before a block could
+    start; overlap() is the share of the fetching hidden behind compute.
+    """
+
+    def __init__(self, model, device=None, dtype=None, prefetch=True, mapped=None):
+        self.model = model
+        if mapped is None:
+            mapped = bool(
+                getattr(model, "snapshot_files", None)
+                or getattr(model, "mapped_files", None)
+            )
+        self.mapped = mapped
+        self.device = torch.device(device) if device is not None else model.device
+        self.dtype = dtype if dtype is not None else model.dtype
+        self.blocks = list(model.get_decoder().layers)
+        self.sources = [_block_tensors(block) for block in self.blocks]
+        streamed = {id(block) for block in self.blocks}
+        for module in model.modules():
+            if id(module) in streamed:
+                continue
+            for leaf, tensor in list(module._parameters.items()):
+                if tensor is not None and tensor.device != self.device:
+                    _set(module, leaf, True, tensor.data.to(self.device))
+            for leaf, tensor in list(module._buffers.items()):
+                if tensor is not None and tensor.device != self.device:
+                    _set(module, leaf, False, tensor.to(self.device))
+        self.prefetch = prefetch
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._stream = (
+            torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        )
+        self._pending = {}
+        self._started = None
+        self.stats = {"fetch": 0.0, "compute": 0.0, "wait": 0.0}
+        self._hooks = []
+        for i, block in enumerate(self.blocks):
+            self._hooks.append(
+                block.register_forward_pre_hook(lambda m, a, i=i: self._enter(i))
+            )
+            self._hooks.append(
+                block.register_forward_hook(lambda m, a, o, i=i: self._leave(i))
+            )
+
+    def _fetch(self, i):
+        t0 = time.perf_counter()
+        working = []
+        if self._stream is not None:
+            with torch.cuda.stream(self._stream):
+                for _, _, parameter, tensor in self.sources[i]:
+                    working.append(self._copy(tensor, parameter))
+            self._stream.synchronize()
+        else:
+            working = [self._copy(t, p) for _, _, p, t in self.sources[i]]
+        self.stats["fetch"] += time.perf_counter() - t0
+        return working
+
+    def _copy(self, tensor, parameter):
+        # buffers keep their dtype (int8 weights and their scales, see quantize.py)
+        convert = parameter and tensor.is_floating_point()
+        dtype = self.dtype if convert else tensor.dtype
+        return tensor.to(self.device, dtype, copy=self.mapped)
+
+    def _request(self, i):
+        if i not in self._pending:
+            if self._executor is not None:
+                self._pending[i] = self._executor.submit(self._fetch, i)
+            else:
+                self._pending[i] = None
+
+    def _enter(self, i):
+        self._request(i)
+        t0 = time.perf_counter()
+        future = self._pending.pop(i)
+        working = future.result() if future is not None else self._fetch(i)
+        self.stats["wait"] += time.perf_counter() - t0
+        for (module, leaf, parameter, _), tensor in zip(self.sources[i], working):
+            _set(module, leaf, parameter, tensor)
+        if self.prefetch:
+            self._request((i + 1) % len(self.blocks))
+        self._started = time.perf_counter()
+
+    def _leave(self, i):
+        if self.device.type == "cuda":
+            torch.cuda.current_stream(self.device).synchronize()
+        self.stats["compute"] += time.perf_counter() - self._started
+        # back to the source tensors, the working copies are freed
+        for module, leaf, parameter, tensor in self.sources[i]:
+            _set(module, leaf, parameter, tensor)
+
+    def overlap(self):
+        fetch = self.stats["fetch"]
+        return max(0.0, 1.0 - self.stats["wait"] / fetch) if fetch else 0.0
+
+    def close(self):
+        for hook in self._hooks:
+            hook.remove()
+        for future in self._pending.values():
+            if future is not None:
+                future.result()
+        self._pending = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+def stream_layers(model, device=None, dtype=None, prefetch=True, mapped=None):
+    """Attach a LayerStreamer to `model` (model.layer_streamer) and return the model."""
+    model.layer_streamer = LayerStreamer(model, device, dtype, prefetch, mapped)
+    return model
+
+
+# benchmark: python layer_stream.py [layers] [hidden]
+# prefill + decode of a scaled down LLaMA saved as a safetensors checkpoint:
+# resident in RAM, then streamed block by block from the memory-mapped
+# checkpoint with a cold page cache, without and with prefetching
+if __name__ == "__main__":
+    import gc
+    import os
+    import shutil
+    import sys
+    import tempfile
+    import warnings
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    from backend import Backend
+    from weight_snapshot import map_checkpoint
+
+    warnings.filterwarnings("ignore")
+    layers = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    hidden = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    backend = Backend("cpu", dtype="bfloat16")
+    torch.manual_seed(0)
+    work = tempfile.mkdtemp()
+    config = LlamaConfig(
+        vocab_size=83734,
+        hidden_size=hidden,
+        intermediate_size=hidden * 11 // 4,
+        num_hidden_layers=layers,
+        num_attention_heads=hidden // 128,
+        num_key_value_heads=hidden // 128,
+    )
+    LlamaForCausalLM(config).to(torch.bfloat16).save_pretrained(work)
+    files = [os.path.join(work, n) for n in os.listdir(work)]
+    size = sum(os.path.getsize(f) for f in files if f.endswith(".safetensors"))
+    print(f"{layers} blocks, hidden {hidden}: {size / 2**20:.0f} MiB checkpoint")
+
+    def drop_page_cache():
+        for path in files:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+    def run(model):
+        prompt = torch.randint(0, 32000, (1, 256))
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            model.generate(
+                input_ids=prompt,
+                max_new_tokens=16,
+                min_new_tokens=16,
+                do_sample=False,
+                pad_token_id=0,
+            )
+        return time.perf_counter() - t0
+
+    try:
+        model = LlamaForCausalLM.from_pretrained(work, **backend.model_kwargs())
+        run(model)
+        print(f"resident in RAM            {run(model):6.2f} s")
+        del model
+        for prefetch in (False, True):
+            gc.collect()
+            drop_page_cache()
+            model = map_checkpoint(work, backend.dtype, backend.attn_implementation)
+            stream_layers(model, prefetch=prefetch)
+            seconds = run(model)
+            stats = model.layer_streamer.stats
+            model.layer_streamer.close()
+            label = f"streamed, {'prefetch' if prefetch else 'no prefetch'}"
+            print(
+                f"{label:26s} {seconds:6.2f} s | fetch {stats['fetch']:5.2f} s, "
+                f"compute {stats['compute']:5.2f} s, waited {stats['wait']:5.2f} s, "
+                f"fetch hidden behind compute {model.layer_streamer.overlap():4.0%}"
+            )
+            del model
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
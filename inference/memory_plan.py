@@ -0,0 +1,602 @@
+import copy
+import ctypes
+import ctypes.util
+import inspect
+import math
+import os
+
+import torch
+
+from layer_stream import STREAM_PROFILE
+from quantize import model_nbytes, quantize_model
+from stage2_decoder import FRAME_TOKENS
+
+GiB = 2**30
+# a stage-2 row: [soa, stage_1] + 300 codebook-0 ids + [stage_2], then 8
+# tokens per frame
+STAGE2_CHUNK_FRAMES = 300
+STAGE2_ROW_TOKENS = STAGE2_CHUNK_FRAMES + 3 + STAGE2_CHUNK_FRAMES * FRAME_TOKENS
+# stage 1: the context limit of infer.py, the instruction block before the
+# first segment and the section prompt of every segment (generous estimates)
+STAGE1_MAX_CONTEXT = 16384
+INSTRUCTION_TOKENS = 500
+SEGMENT_PROMPT_TOKENS = 200
+# mmgp profiles as the planner models them: stage-1 weights quantized to int8
+# (quantizeTransformer) and whether the model running a phase is copied to
+# VRAM whole ("model") or block by block ("block"). Profile 5 only differs
+# from 4 in not pinning RAM, which the budget does not model; it is the
+# fallback when nothing fits.
+MMGP_PROFILES = {
+    1: (False, "model"),
+    2: (False, "block"),
+    3: (True, "model"),
+    4: (True, "block"),
+}
+FALLBACK_PROFILE = 5
+
+
+def _malloc_trim():
+    # freed blocks glibc keeps for reuse would hide the peak from VmHWM
+    try:
+        ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+def _status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def rss():
+    """Resident bytes of this process (Linux), 0 elsewhere."""
+    _malloc_trim()
+    try:
+        return _status("VmRSS")
+    except OSError:
+        return 0
+
+
+class PeakMemory(object):
+    """
+    Peak bytes allocated inside the block above what was allocated at its
+    start: the caching allocator's statistics on cuda, the process's peak RSS
+    (VmHWM, reset through /proc/self/clear_refs, after returning the heap's
+    free memory to the system) on cpu.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.bytes = 0
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.start = torch.cuda.memory_allocated(self.device)
+        else:
+            _malloc_trim()
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+            except OSError:
+                pass  # the old peak stays, which only overestimates
+            self.start = rss()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            peak = _status("VmHWM")
+        self.bytes = max(0, peak - self.start)
+
+
+def _tensor_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(_tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_nbytes(v) for v in value)
+    return 0
+
+
+def checkpoint_nbytes(path, key=None):
+    """Bytes of the tensors in a torch checkpoint (under `key`), None if missing."""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        state = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    except RuntimeError:
+        # legacy (non zip) checkpoints cannot be mapped
+        state = torch.load(path, map_location="cpu", weights_only=False)
+    if key is not None:
+        state = state[key]
+    return _tensor_nbytes(state)
+
+
+def _cache_nbytes(cache):
+    if hasattr(cache, "key_cache"):
+        return _tensor_nbytes(cache.key_cache) + _tensor_nbytes(cache.value_cache)
+    return _tensor_nbytes(list(cache))
+
+
+class LLMCost(object):
+    """
+    Measured memory of a causal LM: its weights, one decoder block, and the
+    KV cache and activations a forward over `tokens` tokens of `rows` rows
+    needs: rows * tokens * (kv_per_token + activation_per_token) plus
+    activation_fixed.
+    """
+
+    def __init__(
+        self,
+        weights,
+        block,
+        layers,
+        kv_per_token=0,
+        activation_per_token=0,
+        activation_fixed=0,
+    ):
+        self.weights = weights
+        self.block = block
+        self.layers = layers
+        self.kv_per_token = kv_per_token
+        self.activation_per_token = activation_per_token
+        self.activation_fixed = activation_fixed
+
+    def working(self, rows, tokens, kv_scale=1.0):
+        per_token = self.kv_per_token * kv_scale + self.activation_per_token
+        return rows * tokens * per_token + self.activation_fixed
+
+    def streamed(self):
+        """Weights on the device when blocks are copied one at a time (two in flight)."""
+        return self.weights - self.layers * self.block + 2 * self.block
+
+
+def _probe(config, layers, vocab_size, dtype, attn_implementation):
+    from transformers import AutoModelForCausalLM
+
+    config = copy.deepcopy(config)
+    config.num_hidden_layers = layers
+    config.vocab_size = vocab_size
+    for name in ("pad_token_id", "bos_token_id", "eos_token_id"):
+        if isinstance(getattr(config, name, None), int):
+            setattr(config, name, min(getattr(config, name), vocab_size - 1))
+    model = AutoModelForCausalLM.from_config(
+        config, torch_dtype=dtype, attn_implementation=attn_implementation
+    )
+    return model.eval()
+
+
+def measure_llm(
+    config,
+    backend,
+    quantize="none",
+    group_size=128,
+    dry_run=True,
+    probe_tokens=(512, 2048),
+    probe_vocab=(1024, 2048),
+):
+    """
+    LLMCost of the model `config` describes on `backend`, from small dry runs
+    instead of the model itself: randomly initialised copies with one and two
+    decoder blocks and a reduced vocabulary, quantized like the real one.
+    Their sizes give the bytes of the embeddings and output head per
+    vocabulary row, of one block and of the rest. Prefills of the two-block
+    copy over probe_tokens tokens give the KV cache bytes per token and
+    block, and the activations as fixed + per-token bytes (they are freed
+    block by block, so they do not grow with depth).
+    """
+    dtype, attn = backend.dtype, backend.attn_implementation
+    small, large = probe_vocab
+    sizes = {}
+    for layers, vocab_size in ((1, small), (2, small), (1, large)):
+        model = quantize_model(
+            _probe(config, layers, vocab_size, dtype, attn), quantize, group_size
+        )
+        sizes[layers, vocab_size] = model_nbytes(model)
+        if layers == 2:
+            probe = model
+        else:
+            del model
+    block = sizes[2, small] - sizes[1, small]
+    per_row = (sizes[1, large] - sizes[1, small]) / (large - small)
+    weights = (
+        sizes[1, small]
+        + (config.num_hidden_layers - 1) * block
+        + (config.vocab_size - small) * per_row
+    )
+    cost = LLMCost(int(weights), block, config.num_hidden_layers)
+    if not dry_run:
+        return cost
+
+    probe = probe.to(backend.device)
+    kwargs = {}
+    # the prefill of generate only computes the logits of the last token
+    parameters = inspect.signature(type(probe).forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in parameters:
+            kwargs[name] = 1
+            break
+    points = []
+    with torch.no_grad():
+        for tokens in probe_tokens:
+            ids = torch.randint(0, small, (1, tokens), device=backend.device)
+            with PeakMemory(backend.device) as peak:
+                out = probe(input_ids=ids, use_cache=True, **kwargs)
+                kv = _cache_nbytes(out.past_key_values)
+                del out
+            points.append((tokens, kv, peak.bytes - kv))
+    del probe
+    (t0, kv0, a0), (t1, kv1, a1) = points
+    cost.kv_per_token = kv1 / t1 / 2 * config.num_hidden_layers
+    # the larger of the fitted slope and the average, small prefills are noisy
+    cost.activation_per_token = max(0.0, (a1 - a0) / (t1 - t0), a1 / t1)
+    cost.activation_fixed = max(0.0, a0 - cost.activation_per_token * t0)
+    return cost
+
+
+def stage1_context(run_n_segments, max_new_tokens):
+    """Tokens of the stage-1 context when the last segment ends."""
+    return min(
+        STAGE1_MAX_CONTEXT,
+        INSTRUCTION_TOKENS + run_n_segments * (SEGMENT_PROMPT_TOKENS + max_new_tokens),
+    )
+
+
+def stage2_chunks(run_n_segments, max_new_tokens):
+    """
+    300-frame chunks of the longest track: stage 1 writes one codebook-0
+    token per frame and track, vocal and instrumental interleaved.
+    """
+    frames = run_n_segments * max_new_tokens // 2
+    return max(1, math.ceil(frames / STAGE2_CHUNK_FRAMES))
+
+
+class MemoryPlan(object):
+    """
+    Residency, stage-2 batch size and chunking chosen by plan_memory, with
+    the peak RAM/VRAM bytes of each phase it expects.
+    """
+
+    def __init__(self, backend, ram_budget, vram_budget, reserve):
+        self.backend = backend
+        self.ram_budget = ram_budget
+        self.vram_budget = vram_budget
+        self.reserve = reserve
+        self.profile = None
+        self.residency = ""
+        self.stage2_batch_size = 1
+        self.stage2_passes = 1
+        self.phases = []  # (name, ram bytes, vram bytes or None)
+        self.weights = {}
+        self.fits = True
+        self.notes = []
+
+    def apply(self, args):
+        """Write the plan's choices into infer.py arguments."""
+        if self.profile is not None:
+            args.profile = self.profile
+        args.stage2_batch_size = self.stage2_batch_size
+
+    def __str__(self):
+        def gib(n):
+            return "-" if n is None else f"{n / GiB:6.2f} GiB"
+
+        budgets = [f"RAM {gib(self.ram_budget).strip()}"]
+        if self.backend == "cuda":
+            budgets.append(f"VRAM {gib(self.vram_budget).strip()}")
+        lines = [
+            f"memory plan ({self.backend}, budget {', '.join(budgets)}, "
+            f"{self.reserve:.0%} kept in reserve):",
+            "  weights: "
+            + ", ".join(f"{name} {gib(n).strip()}" for name, n in self.weights.items()),
+            f"  residency: {self.residency}",
+            f"  {'phase':8s} {'RAM':>10s} {'VRAM':>10s}",
+        ]
+        for name, ram, vram in self.phases:
+            lines.append(f"  {name:8s} {gib(ram):>10s} {gib(vram):>10s}")
+        if self.profile is not None:
+            lines.append(f"  profile {self.profile}")
+        lines.append(
+            f"  stage 2: batch {self.stage2_batch_size} x {STAGE2_CHUNK_FRAMES} "
+            f"frames, {self.stage2_passes} pass(es) per track"
+        )
+        lines.extend(f"  note: {note}" for note in self.notes)
+        if not self.fits:
+            lines.append("  does NOT fit the budget")
+        return "\n".join(lines)
+
+
+def plan_memory(
+    backend,
+    stage1,
+    stage2,
+    codec=0,
+    vocoders=0,
+    ram_budget=None,
+    vram_budget=None,
+    baseline=0,
+    run_n_segments=2,
+    max_new_tokens=3000,
+    kv_scale=1.0,
+    reserve=0.1,
+    stage1_int8=None,
+):
+    """
+    Plan a request for RAM/VRAM budgets (bytes, None = unbounded).
+
+    stage1 / stage2: LLMCost of the LLMs as they will be loaded, stage1_int8
+    the stage-1 model quantized to int8 (mmgp profiles 3-5); codec /
+    vocoders: weight bytes; baseline: RAM the process holds without models;
+    kv_scale: stage-1 KV cache bytes relative to the model dtype
+    (--kv_cache_dtype). Stage 1 runs two rows (classifier-free guidance) over
+    the whole context; a stage-2 row holds one 300-frame chunk.
+
+    cpu: every model stays in RAM the whole request, as infer.py loads them,
+    or when that does not fit the LLMs stream their decoder blocks from the
+    mapped checkpoints (layer_stream.py, profile 6).
+    cuda: mmgp keeps the models in RAM and copies the one running a phase to
+    VRAM; the lowest profile (fastest) that fits both budgets is chosen,
+    then streaming from the mapped checkpoints, which needs no RAM for them.
+    Either way the stage-2 batch is the largest that fits, at most the
+    number of chunks of the longest track.
+    """
+    plan = MemoryPlan(backend, ram_budget, vram_budget, reserve)
+    ram_free = None if ram_budget is None else ram_budget * (1 - reserve) - baseline
+    vram_free = None if vram_budget is None else vram_budget * (1 - reserve)
+    context = stage1_context(run_n_segments, max_new_tokens)
+    chunks = stage2_chunks(run_n_segments, max_new_tokens)
+    stage1_work = stage1.working(2, context, kv_scale)
+
+    def stage2_work(batch):
+        return stage2.working(batch, STAGE2_ROW_TOKENS)
+
+    def fits(value, free):
+        return free is None or value <= free
+
+    if backend == "cpu":
+        plan.weights = {"stage 1": stage1.weights, "stage 2": stage2.weights}
+        plan.weights.update(codec=codec, vocoders=vocoders)
+        for profile, models in (
+            (None, stage1.weights + stage2.weights + codec),
+            (STREAM_PROFILE, stage1.streamed() + stage2.streamed() + codec),
+        ):
+            batch = chunks
+            while batch > 1 and not fits(models + stage2_work(batch), ram_free):
+                batch -= 1
+            plan.phases = [
+                ("stage 1", baseline + models + stage1_work, None),
+                ("stage 2", baseline + models + stage2_work(batch), None),
+                ("vocoder", baseline + models + vocoders, None),
+            ]
+            plan.fits = all(fits(ram - baseline, ram_free) for _, ram, _ in plan.phases)
+            if plan.fits:
+                break
+        plan.profile = profile
+        if profile is None:
+            plan.residency = "all models in RAM"
+        else:
+            plan.residency = (
+                "LLM weights mapped from their checkpoints, two decoder blocks "
+                "of each in RAM"
+            )
+            plan.notes.append(
+                "--quantize without --cache_dir keeps the quantized weights in RAM"
+            )
+    else:
+
+        def on_device(cost, placement):
+            return cost.weights if placement == "model" else cost.streamed()
+
+        for profile, (int8, placement) in MMGP_PROFILES.items():
+            first = stage1_int8 if int8 and stage1_int8 is not None else stage1
+            ram = first.weights + stage2.weights + codec + vocoders
+            # the codec and the vocoders stay on the device, outside mmgp
+            vram = [
+                on_device(first, placement) + stage1_work + codec,
+                on_device(stage2, placement) + stage2_work(1) + codec,
+                codec + vocoders,
+            ]
+            if fits(ram, ram_free) and all(fits(v, vram_free) for v in vram):
+                break
+        else:
+            # streamed from the page cache, the LLMs hold no RAM of their own
+            vram = [
+                stage1.streamed() + stage1_work + codec,
+                stage2.streamed() + stage2_work(1) + codec,
+                codec + vocoders,
+            ]
+            if all(fits(v, vram_free) for v in vram):
+                profile, int8, placement, first = STREAM_PROFILE, False, "block", stage1
+                ram = codec + vocoders
+            else:
+                profile = FALLBACK_PROFILE
+                plan.fits = False
+        plan.profile = profile
+        if profile == STREAM_PROFILE:
+            plan.residency = (
+                "LLM weights mapped from their checkpoints; the running model "
+                "streamed to VRAM block by block"
+            )
+        else:
+            plan.residency = (
+                f"models in RAM, stage 1 {'int8' if int8 else 'bf16'}; "
+                + (
+                    "the running model whole in VRAM"
+                    if placement == "model"
+                    else "the running model streamed to VRAM block by block"
+                )
+            )
+        plan.weights = {"stage 1": first.weights, "stage 2": stage2.weights}
+        plan.weights.update(codec=codec, vocoders=vocoders)
+        batch = chunks
+        while batch > 1 and not fits(
+            on_device(stage2, placement) + stage2_work(batch) + codec, vram_free
+        ):
+            batch -= 1
+        ram += baseline
+        plan.phases = [
+            ("stage 1", ram, on_device(first, placement) + stage1_work + codec),
+            ("stage 2", ram, on_device(stage2, placement) + stage2_work(batch) + codec),
+            ("vocoder", ram, codec + vocoders),
+        ]
+    plan.stage2_batch_size = batch
+    plan.stage2_passes = math.ceil(chunks / batch)
+    plan.notes.append(
+        f"stage 1 context {context} tokens; stage 2 {chunks} chunk(s) per track"
+    )
+    if not codec or not vocoders:
+        plan.notes.append("codec/vocoder checkpoints not found, counted as 0")
+    return plan
+
+
+def plan_from_args(args, backend, reserve=0.1):
+    """
+    plan_memory for an infer.py request: measures the LLMs named by
+    args.stage1_model / args.stage2_model (configs only, see measure_llm)
+    and the codec/vocoder checkpoints. Budgets: --ram_budget_gb,
+    --vram_budget_gb (default: the device's memory on cuda).
+    """
+    from transformers import AutoConfig
+
+    def budget(gb):
+        return gb * GiB if gb > 0 else None
+
+    ram_budget = budget(args.ram_budget_gb)
+    vram_budget = budget(args.vram_budget_gb)
+    if backend.name == "cuda" and vram_budget is None:
+        vram_budget = torch.cuda.get_device_properties(backend.device).total_memory
+    # on cuda the LLMs run unquantized or through mmgp's int8 (profiles 3-5)
+    quantize = args.quantize if backend.name == "cpu" else "none"
+    costs = [
+        measure_llm(
+            AutoConfig.from_pretrained(path),
+            backend,
+            quantize,
+            args.quantize_group_size,
+        )
+        for path in (args.stage1_model, args.stage2_model)
+    ]
+    stage1_int8 = None
+    if backend.name == "cuda":
+        stage1_int8 = measure_llm(
+            AutoConfig.from_pretrained(args.stage1_model),
+            backend,
+            "int8",
+            dry_run=False,
+        )
+        stage1_int8.__dict__.update(
+            {
+                k: v
+                for k, v in costs[0].__dict__.items()
+                if k not in ("weights", "block")
+            }
+        )
+    kv_scale = 1.0
+    if args.kv_cache_dtype in ("int8", "fp8"):
+        kv_scale = 1.0 / torch.empty((), dtype=backend.dtype).element_size()
+    vocoders = [
+        checkpoint_nbytes(p) for p in (args.vocal_decoder_path, args.inst_decoder_path)
+    ]
+    plan = plan_memory(
+        backend.name,
+        *costs,
+        codec=checkpoint_nbytes(args.resume_path, "codec_model") or 0,
+        vocoders=sum(v or 0 for v in vocoders),
+        ram_budget=ram_budget,
+        vram_budget=vram_budget,
+        baseline=rss(),
+        run_n_segments=args.run_n_segments,
+        max_new_tokens=args.max_new_tokens,
+        kv_scale=kv_scale,
+        reserve=reserve,
+        stage1_int8=stage1_int8,
+    )
+    if not plan.fits and backend.name == "cpu" and args.quantize in ("none", "int8"):
+        for mode in ("int8", "int4")[args.quantize == "int8" :]:
+            smaller = measure_llm(
+                AutoConfig.from_pretrained(args.stage1_model),
+                backend,
+                mode,
+                args.quantize_group_size,
+                dry_run=False,
+            )
+            plan.notes.append(
+                f"--quantize {mode}: stage 1 weights {smaller.weights / GiB:.2f} GiB"
+            )
+    return plan
+
+
+# benchmark: python memory_plan.py [ram_budget_gb] [layers]
+# plan a scaled down pipeline for a cpu RAM budget, then run its stage-1 and
+# stage-2 phases and compare the measured peaks with the planned ones
+if __name__ == "__main__":
+    import sys
+    import warnings
+
+    from backend import Backend, scaled_down_models
+
+    warnings.filterwarnings("ignore")
+    budget_gb = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    layers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    backend = Backend("cpu", dtype="bfloat16")
+    torch.manual_seed(0)
+    # configs of the scaled down models, measured without them
+    configs = [m.config for m in scaled_down_models(backend, layers=layers)]
+    baseline = rss()
+    costs = [measure_llm(c, backend) for c in configs]
+    segments, new_tokens = 2, 1200
+    plan = plan_memory(
+        "cpu",
+        *costs,
+        ram_budget=budget_gb * GiB,
+        baseline=baseline,
+        run_n_segments=segments,
+        max_new_tokens=new_tokens,
+    )
+    print(plan)
+
+    from transformers import AutoModelForCausalLM
+
+    models = [
+        AutoModelForCausalLM.from_config(
+            c,
+            torch_dtype=backend.dtype,
+            attn_implementation=backend.attn_implementation,
+        ).eval()
+        for c in configs
+    ]
+    loaded = rss() - baseline
+    print(
+        f"weights: planned {(costs[0].weights + costs[1].weights) / GiB:.3f} GiB, "
+        f"loaded {loaded / GiB:.3f} GiB (rss)"
+    )
+    kwargs = {"num_logits_to_keep": 1}
+    with torch.no_grad():
+        # stage 1: two guidance rows over the whole context
+        context = stage1_context(segments, new_tokens)
+        ids = torch.randint(0, 32000, (2, context))
+        with PeakMemory("cpu") as peak:
+            models[0](input_ids=ids, use_cache=True, **kwargs)
+        planned = costs[0].working(2, context)
+        print(
+            f"stage 1 working memory: planned {planned / GiB:.3f} GiB, "
+            f"measured {peak.bytes / GiB:.3f} GiB"
+        )
+        # stage 2: the last call of the generate loop sees whole rows
+        batch = plan.stage2_batch_size
+        ids = torch.randint(45334, 46358, (batch, STAGE2_ROW_TOKENS))
+        with PeakMemory("cpu") as peak:
+            models[1](input_ids=ids, use_cache=True, **kwargs)
+        planned = costs[1].working(batch, STAGE2_ROW_TOKENS)
+        print(
+            f"stage 2 working memory, batch {batch}: planned {planned / GiB:.3f} "
+            f"GiB, measured {peak.bytes / GiB:.3f} GiB"
+        )
@@ -1,5 +1,19 @@
+import hashlib
+import json
+import os
+import re
+import threading
 from abc import ABC
 from abc import abstractmethod
+from collections import OrderedDict
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
 
 
 class AbstractTokenizer(ABC):
@@ -63,22 +77,52 @@ class AbstractTokenizer(ABC):
 class _SentencePieceTokenizer(AbstractTokenizer):
     """SentencePieceTokenizer-Megatron wrapper"""
 
+    # number of plain-text fragments whose ids are memoized by tokenize()
+    fragment_cache_size = 4096
+
     def __init__(self, model_file, vocab_extra_ids=0):
         name = 'SentencePieceTokenizer'
         super().__init__(name)
 
         import sentencepiece
+        self.model_file = model_file
         self.tokenizer = sentencepiece.SentencePieceProcessor(model_file=model_file)
+        self._special_tokens_re = None
+        self._special_tokens_re_key = None
+        self._fragment_cache = OrderedDict()
+        # the instance is shared process-wide (get_mm_tokenizer), by threads too
+        self._fragment_lock = threading.Lock()
         self._initalize(vocab_extra_ids)
 
-    def _populate_vocab(self):
-        self._vocab = {}
-        self._inv_vocab = {}
+    def _load_pieces(self):
+        """
+        Id -> piece table of the sentencepiece model. It is read from a json cache
+        next to the model file and rebuilt when the model file hash changes.
+        """
+        cache_file = self.model_file + '.vocab.json'
+        model_hash = file_sha256(self.model_file)
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached['sha256'] == model_hash and len(cached['pieces']) == len(self.tokenizer):
+                return cached['pieces']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        pieces = self.tokenizer.id_to_piece(list(range(len(self.tokenizer))))
+        try:
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'sha256': model_hash, 'pieces': pieces}, f, ensure_ascii=False)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass  # read-only install, rebuild next time
+        return pieces
 
-        for i in range(len(self.tokenizer)):
-            t = self.tokenizer.id_to_piece(i)
-            self._inv_vocab[i] = t
-            self._vocab[t] = i
+    def _populate_vocab(self):
+        pieces = self._load_pieces()
+        self._inv_vocab = dict(enumerate(pieces))
+        self._vocab = {t: i for i, t in enumerate(pieces)}
 
     def _initalize(self, vocab_extra_ids):
         self._populate_vocab()
@@ -153,46 +197,77 @@ class _SentencePieceTokenizer(AbstractTokenizer):
     def encoder(self):
         return self._vocab
 
-    # From:
+    def _special_tokens_pattern(self):
+        # alternatives keep the insertion order of self._special_tokens, so when two
+        # special tokens start at the same position the earlier registered one wins,
+        # exactly like the min() over str.index() results in the NeMo loop
+        key = tuple(self._special_tokens)
+        if self._special_tokens_re_key != key:
+            self._special_tokens_re = re.compile(
+                "|".join(re.escape(t) for t in key)) if key else None
+            self._special_tokens_re_key = key
+        return self._special_tokens_re
+
+    def _encode_fragments(self, fragments):
+        """Encode plain-text fragments in one sentencepiece call, memoizing each one."""
+        cache = self._fragment_cache
+        with self._fragment_lock:
+            missing = [f for f in dict.fromkeys(fragments) if f not in cache]
+            if missing:
+                for f, ids in zip(missing, self.tokenizer.encode(missing, out_type=int)):
+                    cache[f] = ids
+                while len(cache) > self.fragment_cache_size:
+                    cache.popitem(last=False)
+            out = []
+            for f in fragments:
+                ids = cache.get(f)
+                if ids is None:  # evicted by this very call
+                    ids = self.tokenizer.encode_as_ids(f)
+                else:
+                    cache.move_to_end(f)
+                out.append(ids)
+        return out
+
+    # Single-pass version of:
     # https://github.com/NVIDIA/NeMo/blob/c8fa217e811d60d11d014827c7f3845ff6c99ae7/nemo/collections/common/tokenizers/sentencepiece_tokenizer.py#L89
     def tokenize(self, text):
-        ids = []
-        idx = 0
-
-        while 1:
-            indices = {}
-            for token in self._special_tokens:
-                try:
-                    indices[token] = text[idx:].index(token)
-                except ValueError:
-                    continue
-            if len(indices) == 0:
-                break
-
-            next_token = min(indices, key=indices.get)
-            next_idx = idx + indices[next_token]
+        pattern = self._special_tokens_pattern()
+        if pattern is None:
+            return list(self._encode_fragments([text])[0])
 
-            ids.extend(self.tokenizer.encode_as_ids(text[idx:next_idx]))
-            ids.append(self._special_tokens[next_token])
-            idx = next_idx + len(next_token)
+        fragments = []
+        specials = []
+        idx = 0
+        for match in pattern.finditer(text):
+            fragments.append(text[idx:match.start()])
+            specials.append(self._special_tokens[match.group()])
+            idx = match.end()
+        fragments.append(text[idx:])
 
-        ids.extend(self.tokenizer.encode_as_ids(text[idx:]))
+        encoded = self._encode_fragments(fragments)
+        ids = []
+        for fragment_ids, special_id in zip(encoded, specials):
+            ids.extend(fragment_ids)
+            ids.append(special_id)
+        ids.extend(encoded[-1])
         return ids
 
     # From:
     # https://github.com/NVIDIA/NeMo/blob/c8fa217e811d60d11d014827c7f3845ff6c99ae7/nemo/collections/common/tokenizers/sentencepiece_tokenizer.py#L125
     def detokenize(self, ids):
-        text = ""
+        parts = []
         last_i = 0
 
         for i, id in enumerate(ids):
             if id in self._inv_special_tokens:
-                text += self.tokenizer.decode_ids(ids[last_i:i]) + " "
-                text += self._inv_special_tokens[id] + " "
+                parts.append(self.tokenizer.decode_ids(ids[last_i:i]))
+                parts.append(" ")
+                parts.append(self._inv_special_tokens[id])
+                parts.append(" ")
                 last_i = i + 1
 
-        text += self.tokenizer.decode_ids(ids[last_i:])
-        return text
+        parts.append(self.tokenizer.decode_ids(ids[last_i:]))
+        return "".join(parts)
 
     @property
     def cls(self):
@@ -365,3 +440,85 @@ class _MMSentencePieceTokenizer(_SentencePieceTokenizer):
     @property
     def stage_2(self):
         return self._stage_2_id
+
+
+_tokenizer_instances = {}
+_tokenizer_lock = threading.Lock()
+
+
+def get_mm_tokenizer(model_file, vocab_extra_ids=0):
+    """
+    Process-wide _MMSentencePieceTokenizer, built once per model file. A changed
+    model file (size or mtime) gets a fresh instance.
+    """
+    st = os.stat(model_file)
+    key = (os.path.realpath(model_file), st.st_size, st.st_mtime_ns, vocab_extra_ids)
+    with _tokenizer_lock:
+        tok = _tokenizer_instances.get(key)
+        if tok is None:
+            tok = _MMSentencePieceTokenizer(model_file, vocab_extra_ids)
+            _tokenizer_instances.clear()
+            _tokenizer_instances[key] = tok
+        return tok
+
+
+# microbenchmark: python mmtokenizer.py [path/to/lyrics.txt]
+if __name__ == '__main__':
+    import sys
+    import time
+
+    def nemo_tokenize(tok, text):
+        ids = []
+        idx = 0
+        while 1:
+            indices = {}
+            for token in tok._special_tokens:
+                try:
+                    indices[token] = text[idx:].index(token)
+                except ValueError:
+                    continue
+            if len(indices) == 0:
+                break
+            next_token = min(indices, key=indices.get)
+            next_idx = idx + indices[next_token]
+            ids.extend(tok.tokenizer.encode_as_ids(text[idx:next_idx]))
+            ids.append(tok._special_tokens[next_token])
+            idx = next_idx + len(next_token)
+        ids.extend(tok.tokenizer.encode_as_ids(text[idx:]))
+        return ids
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    lyrics_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, '..', 'prompt_egs', 'lyrics.txt')
+    with open(lyrics_file, 'r', encoding='utf-8') as f:
+        lyrics = f.read()
+    tok = _MMSentencePieceTokenizer(os.path.join(here, 'mm_tokenizer_v0.2_hf', 'tokenizer.model'))
+    song = "\n".join(
+        "[start_of_segment]" + lyrics + "<SOA><xcodec><EOA>[end_of_segment]" for _ in range(20))
+    samples = [song, lyrics, "[start_of_segment]", "<SOA><EOA>", "", "<SOA>", "plain text"]
+    for sample in samples:
+        assert tok.tokenize(sample) == nemo_tokenize(tok, sample), sample[:40]
+
+    def bench(fn, text, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(text)
+        return (time.perf_counter() - start) / repeat * 1e3
+
+    print(f"long lyrics: {len(song)} chars, {len(tok.tokenize(song))} ids, "
+          f"{len(tok._special_tokens)} special tokens")
+    ref = bench(lambda t: nemo_tokenize(tok, t), song, 5)
+    tok._fragment_cache.clear()
+    cold = bench(tok.tokenize, song, 1)
+    warm = bench(tok.tokenize, song, 20)
+    print(f"nemo loop: {ref:8.2f} ms")
+    print(f"one pass : {cold:8.2f} ms (cold fragment cache)")
+    print(f"one pass : {warm:8.2f} ms (warm fragment cache)")
+
+    model_file = os.path.join(here, 'mm_tokenizer_v0.2_hf', 'tokenizer.model')
+    start = time.perf_counter()
+    _MMSentencePieceTokenizer(model_file)
+    print(f"construct: {(time.perf_counter() - start) * 1e3:8.2f} ms (vocab cache)")
+    get_mm_tokenizer(model_file)
+    start = time.perf_counter()
+    get_mm_tokenizer(model_file)
+    print(f"singleton: {(time.perf_counter() - start) * 1e3:8.2f} ms")
@@ -0,0 +1,103 @@
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+import torch
+
+SUPPORTED_FORMATS = ("wav", "flac", "mp3")
+
+
+def _prepare(wav, rescale=False, limit=0.99):
+    if isinstance(wav, torch.Tensor):
+        wav = wav.detach().float().cpu().numpy()
+    wav = np.asarray(wav, dtype=np.float32)
+    if wav.ndim == 1:
+        wav = wav[np.newaxis, :]
+    if rescale:
+        max_val = np.abs(wav).max()
+        wav = wav * min(limit / max_val, 1) if max_val > 0 else wav
+    else:
+        wav = np.clip(wav, -limit, limit)
+    return wav
+
+
+def _encode(wav, path, sample_rate):
+    """
+    wav: (C, N) float32 array, already clamped/rescaled. The file is encoded
+    next to `path` and renamed over it: an existing file at `path` (a stem or
+    mix of an earlier request, maybe held by the result cache) is replaced,
+    never rewritten in place.
+    """
+    folder_path = os.path.dirname(path)
+    if folder_path:
+        os.makedirs(folder_path, exist_ok=True)
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in SUPPORTED_FORMATS:
+        raise ValueError(
+            f"unsupported audio format: {fmt}, expected {SUPPORTED_FORMATS}"
+        )
+    # the extension stays last, both encoders pick the format from it
+    tmp_path = f"{os.path.splitext(path)[0]}.tmp{uuid.uuid4().hex}.{fmt}"
+    try:
+        if fmt == "mp3" and "MP3" not in sf.available_formats():
+            # libsndfile < 1.1 has no mp3 encoder, fall back to torchaudio/ffmpeg
+            import torchaudio
+
+            torchaudio.save(tmp_path, torch.from_numpy(wav), sample_rate=sample_rate)
+        else:
+            subtype = None if fmt == "mp3" else "PCM_16"
+            sf.write(tmp_path, wav.T, sample_rate, subtype=subtype)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def save_audio(wav, path, sample_rate, rescale=False):
+    """Synchronous version of AudioWriter.submit."""
+    return _encode(_prepare(wav, rescale), path, sample_rate)
+
+
+class AudioWriter(object):
+    """
+    Encode audio on a background pool so the caller can move on to the next model
+    stage. `submit` snapshots the tensor to host memory before returning, so the
+    caller may free or overwrite it right away.
+
+    use_processes: encode in worker processes instead of threads. Threads are
+    enough for libsndfile (it releases the GIL); processes help when the mp3
+    fallback goes through python-heavy code paths.
+    """
+
+    def __init__(self, max_workers=2, use_processes=False):
+        pool_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.pool = pool_cls(max_workers=max_workers)
+        self.futures = []
+
+    def submit(self, wav, path, sample_rate, rescale=False):
+        future = self.pool.submit(_encode, _prepare(wav, rescale), path, sample_rate)
+        self.futures.append(future)
+        return future
+
+    def join(self):
+        """Wait for every queued file; re-raises the first encoding error."""
+        futures, self.futures = self.futures, []
+        return [f.result() for f in futures]
+
+    def close(self):
+        try:
+            self.join()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.close()
@@ -0,0 +1,303 @@
+import torch
+from torch import nn
+
+QUANT_CHOICES = ("none", "int8-dynamic", "int8", "int4")
+
+
+# The int8/int4 x bf16 cpu kernels are matrix-vector kernels: ahead of a dense
+# matmul up to about this many rows (decode steps, small stage-2 batches), far
+# behind it on a prefill. Longer inputs dequantize the weight instead.
+KERNEL_MAX_ROWS = 16
+
+
+def _has_op(name):
+    return hasattr(torch.ops.aten, name)
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    nn.Linear with int8 weights and one scale per output channel; activations
+    stay in the model dtype. Short inputs run on the fused int8 x bf16 cpu
+    matmul where torch has it (about twice as fast as the bf16 one for a
+    single row), the rest on the dequantized weight.
+    """
+
+    CONFIG = ("in_features", "out_features")
+
+    def __init__(self, linear):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.register_buffer(
+            "weight", (weight / scale[:, None]).round().clamp(-127, 127).to(torch.int8)
+        )
+        self.register_buffer("scale", scale.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def dequantize(self, dtype):
+        return self.weight.to(dtype) * self.scale.to(dtype)[:, None]
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        if (
+            x.shape[0] <= KERNEL_MAX_ROWS
+            and x.device.type == "cpu"
+            and _has_op("_weight_int8pack_mm")
+        ):
+            y = torch.ops.aten._weight_int8pack_mm(
+                x.contiguous(), self.weight, self.scale.to(x.dtype)
+            )
+        else:
+            y = nn.functional.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            y = y + self.bias
+        return y.reshape(*shape[:-1], self.out_features)
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    nn.Linear with asymmetric int4 weights, one (scale, zero) pair per
+    `group_size` input channels of an output channel:
+    w = (q - 8) * scale + zero, q in [0, 15].
+
+    bf16 models on a torch with the cpu int4 kernels (2.6+) keep the weights
+    in the kernel's packed layout ("packed", needs out_features % 64 == 0) and
+    run short inputs on the kernel; otherwise two nibbles are stored per byte
+    ("nibbles") and the weight is dequantized for every call, which saves the
+    memory but not the time.
+    """
+
+    CONFIG = ("in_features", "out_features", "group_size", "layout")
+
+    def __init__(self, linear, group_size=128):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        n, k = weight.shape
+        groups = weight.reshape(n, k // group_size, group_size)
+        low = groups.amin(dim=-1)
+        high = groups.amax(dim=-1)
+        scale = ((high - low) / 15).clamp(min=1e-8)
+        q = ((groups - low[..., None]) / scale[..., None]).round().clamp(0, 15)
+        q = q.reshape(n, k).to(torch.int32)
+        zero = low + 8 * scale
+        dtype = linear.weight.dtype
+        self.in_features = k
+        self.out_features = n
+        self.group_size = group_size
+        self.layout = (
+            "packed"
+            if _has_op("_weight_int4pack_mm_for_cpu")
+            and dtype == torch.bfloat16
+            and linear.weight.device.type == "cpu"
+            and n % 64 == 0
+            else "nibbles"
+        )
+        if self.layout == "packed":
+            self.register_buffer(
+                "weight", torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 1)
+            )
+        else:
+            self.register_buffer(
+                "weight", (q[:, 0::2] | (q[:, 1::2] << 4)).to(torch.uint8)
+            )
+        # (k / group_size, n, 2), the layout of the int4 kernels
+        self.register_buffer(
+            "scales_and_zeros", torch.stack([scale.t(), zero.t()], dim=-1).to(dtype)
+        )
+        self.bias = linear.bias
+
+    def unpack(self):
+        """(out_features, in_features) uint8 values 0..15."""
+        n, k = self.out_features, self.in_features
+        if self.layout == "packed":
+            # blocks of 64 output channels; byte j of input channel i holds
+            # channel j in its low and channel j + 32 in its high nibble
+            packed = self.weight.view(torch.uint8).reshape(n // 64, k, 32)
+            q = torch.cat([packed & 15, packed >> 4], dim=2)
+            return q.permute(0, 2, 1).reshape(n, k)
+        return torch.stack([self.weight & 15, self.weight >> 4], dim=-1).reshape(n, k)
+
+    def dequantize(self, dtype):
+        q = self.unpack().reshape(self.out_features, -1, self.group_size).to(dtype)
+        scale, zero = self.scales_and_zeros.to(dtype).unbind(-1)
+        weight = (q - 8) * scale.t()[..., None] + zero.t()[..., None]
+        return weight.reshape(self.out_features, self.in_features)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        if self.layout == "packed" and x.shape[0] <= KERNEL_MAX_ROWS:
+            y = torch.ops.aten._weight_int4pack_mm_for_cpu(
+                x.contiguous(), self.weight, self.group_size, self.scales_and_zeros
+            )
+        else:
+            y = nn.functional.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            y = y + self.bias
+        return y.reshape(*shape[:-1], self.out_features)
+
+
+QUANTIZED_LINEARS = {
+    cls.__name__: cls for cls in (Int8WeightOnlyLinear, Int4WeightOnlyLinear)
+}
+
+
+def linear_config(module):
+    """(kind, config) that `empty_linear` rebuilds a quantized linear from."""
+    return type(module).__name__, {
+        name: getattr(module, name) for name in module.CONFIG
+    }
+
+
+def empty_linear(kind, config):
+    """A quantized linear without tensors, for loaders that assign them afterwards."""
+    module = QUANTIZED_LINEARS[kind].__new__(QUANTIZED_LINEARS[kind])
+    nn.Module.__init__(module)
+    for name, value in config.items():
+        setattr(module, name, value)
+    module.register_parameter("bias", None)
+    return module
+
+
+def _replace_linears(model, make):
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                full = f"{name}.{child_name}" if name else child_name
+                replacement = make(full, child)
+                if replacement is not None:
+                    setattr(module, child_name, replacement)
+
+
+def quantize_model(model, mode, group_size=128):
+    """
+    Quantize the linear layers of a causal LM in place for cpu inference.
+
+    int8-dynamic  torch dynamic quantization: int8 weights and per-call int8
+                  activations on the fbgemm/onednn kernels. Needs float32, the
+                  rest of the model is converted.
+    int8          weight-only int8 (Int8WeightOnlyLinear), model dtype kept.
+    int4          weight-only group-wise int4 (Int4WeightOnlyLinear); lm_head
+                  and layers whose width is not a multiple of group_size get
+                  int8 instead.
+    """
+    if mode in (None, "none"):
+        return model
+    if mode == "int8-dynamic":
+        model.float()
+        return torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    if mode == "int8":
+        _replace_linears(model, lambda name, linear: Int8WeightOnlyLinear(linear))
+    elif mode == "int4":
+
+        def make(name, linear):
+            if name.endswith("lm_head") or linear.in_features % group_size:
+                return Int8WeightOnlyLinear(linear)
+            return Int4WeightOnlyLinear(linear, group_size)
+
+        _replace_linears(model, make)
+    else:
+        raise ValueError(
+            f"unknown quantization {mode}, expected one of {QUANT_CHOICES}"
+        )
+    return model
+
+
+def model_nbytes(model):
+    """Bytes of a model's weights, quantized packed params included."""
+    total = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, (tuple, list)) else [value]
+        for t in tensors:
+            if isinstance(t, torch.Tensor):
+                total += t.numel() * t.element_size()
+    return total
+
+
+def codebook_agreement(reference, candidate, sequence, targets, ranges):
+    """
+    Teacher-forced greedy agreement of two models on one token sequence.
+
+    targets: (L,) codebook index of the token at each position, -1 for
+    positions that are not predicted; ranges: [(start, end)] id range of each
+    codebook. Returns the fraction of positions of each codebook where both
+    models' argmax over that codebook's ids agree.
+    """
+    with torch.no_grad():
+        ref = reference(sequence).logits[0, :-1].float()
+        cand = candidate(sequence).logits[0, :-1].float()
+    targets = targets[1:]
+    agreement = []
+    for codebook, (start, end) in enumerate(ranges):
+        rows = targets == codebook
+        if not rows.any():
+            agreement.append(float("nan"))
+            continue
+        same = ref[rows, start:end].argmax(-1) == cand[rows, start:end].argmax(-1)
+        agreement.append(same.float().mean().item())
+    return agreement
+
+
+# benchmark: python quantize.py [stage1_model stage2_model]
+# memory, tokens/s and codebook agreement with the unquantized models
+if __name__ == "__main__":
+    import copy
+    import sys
+    import warnings
+
+    from backend import (
+        Backend,
+        scaled_down_models,
+        stage1_tokens_per_second,
+        stage2_tokens_per_second,
+    )
+
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    warnings.filterwarnings("ignore", category=UserWarning)
+    backend = Backend("cpu", dtype="bfloat16")
+    torch.manual_seed(0)
+    if len(sys.argv) > 2:
+        from transformers import AutoModelForCausalLM
+
+        models = [
+            AutoModelForCausalLM.from_pretrained(path, **backend.model_kwargs()).eval()
+            for path in sys.argv[1:3]
+        ]
+    else:
+        models = scaled_down_models(backend)
+
+    offset, size = 45334, 1024
+    # stage 1: text prompt, then interleaved codebook-0 tokens
+    text = torch.randint(0, 32000, (200,))
+    codes = torch.randint(offset, offset + size, (1000,))
+    stage1_seq = torch.cat([text, codes]).unsqueeze(0)
+    stage1_targets = torch.cat([torch.full((200,), -1), torch.zeros(1000)]).long()
+    stage1_ranges = [(offset, offset + size)]
+    # stage 2: frames of 8 codebooks, codebook k at offset + k * 1024
+    frames = torch.randint(0, size, (100, 8)) + offset + torch.arange(8) * size
+    stage2_seq = frames.reshape(1, -1)
+    stage2_targets = torch.arange(8).repeat(100)
+    stage2_targets[stage2_targets == 0] = -1  # codebook 0 is teacher forced
+    stage2_ranges = [(offset + k * size, offset + (k + 1) * size) for k in range(8)]
+
+    for mode in QUANT_CHOICES:
+        quantized = [quantize_model(copy.deepcopy(m), mode) for m in models]
+        s1_agree = codebook_agreement(
+            models[0], quantized[0], stage1_seq, stage1_targets, stage1_ranges
+        )[0]
+        s2_agree = codebook_agreement(
+            models[1], quantized[1], stage2_seq, stage2_targets, stage2_ranges
+        )[1:]
+        print(
+            f"{mode:12s} stage 1 {model_nbytes(quantized[0]) / 2**20:6.1f} MiB "
+            f"{stage1_tokens_per_second(quantized[0]):6.1f} tok/s "
+            f"agreement {s1_agree:.3f} | "
+            f"stage 2 {model_nbytes(quantized[1]) / 2**20:6.1f} MiB "
+            f"{stage2_tokens_per_second(quantized[1]):6.1f} tok/s "
+            f"agreement per codebook 1-7 " + " ".join(f"{a:.2f}" for a in s2_agree)
+        )
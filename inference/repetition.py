@@ -0,0 +1,180 @@
+import torch
+from transformers import LogitsProcessor
+
+
+class TokenCounts(object):
+    """
+    Occurrences of tracked ids in a growing input_ids, kept up to date from
+    the tokens appended since the previous `update` instead of re-gathering
+    the whole input.
+
+    to_index maps ids to table columns 0..n-1, or n for ids that are not
+    tracked. window > 0 counts only the last `window` tokens appended after
+    the first update (the current segment): one id enters and at most one
+    leaves the table per token. window=0 counts the whole input, the first
+    update included, as the stock repetition penalty does.
+    """
+
+    def __init__(self, n, to_index, window=0):
+        self.n = n
+        self.to_index = to_index
+        self.window = window
+        self.start = None  # input length at the first update
+        self.seen = 0  # input length at the previous update
+        self.counts = None  # (B, n + 1), the last column collects other ids
+        self.recent = None  # (B, window) ring of the last table indices
+        self._ones = None
+
+    def update(self, input_ids):
+        if self.start is None:
+            batch, device = input_ids.shape[0], input_ids.device
+            self.start = self.seen = input_ids.shape[1]
+            self.counts = torch.zeros(
+                (batch, self.n + 1), dtype=torch.int32, device=device
+            )
+            self._ones = torch.ones((batch, 1), dtype=torch.int32, device=device)
+            if self.window:
+                # the ring starts out filled with the "other ids" column
+                self.recent = torch.full(
+                    (batch, self.window), self.n, dtype=torch.long, device=device
+                )
+            else:
+                index = self.to_index(input_ids)
+                self.counts.scatter_add_(1, index, self._ones.expand_as(index))
+            return
+        new = self.to_index(input_ids[:, self.seen :])
+        if not self.window:
+            self.counts.scatter_add_(1, new, self._ones.expand_as(new))
+        for t in range(new.shape[1] if self.window else 0):
+            slot = (self.seen + t - self.start) % self.window
+            leaving = self.recent[:, slot : slot + 1]
+            entering = new[:, t : t + 1]
+            self.counts.scatter_add_(1, leaving, -self._ones)
+            self.counts.scatter_add_(1, entering, self._ones)
+            self.recent[:, slot] = new[:, t]
+        self.seen = input_ids.shape[1]
+
+    def present(self):
+        """(B, n) bool, which tracked ids are counted."""
+        return self.counts[:, : self.n] > 0
+
+
+def apply_penalty(scores, present, penalty):
+    """The stock repetition penalty on the scores of the ids marked present."""
+    penalised = torch.where(scores < 0, scores * penalty, scores / penalty)
+    return torch.where(present, penalised, scores)
+
+
+class WindowedRepetitionPenaltyProcessor(LogitsProcessor):
+    """
+    Repetition penalty over the last `window` tokens sampled in the current
+    segment, restricted to the audio ids [vocab_start, vocab_end).
+
+    The stock RepetitionPenaltyLogitsProcessor gathers the scores of every id
+    in input_ids on each step, i.e. the whole song so far including the lyrics
+    text. Here the segment starts at the input length of the first call and
+    the window is a ring of ids: each new token overwrites the one leaving
+    the window, and only the scores of the ids in the ring are gathered,
+    penalised and scattered back, so a step costs the same at any context
+    length. Ids outside the audio range, and the slots of a ring that is not
+    full yet, hold a placeholder id whose score is written back unchanged.
+
+    The penalty itself is the stock one: a penalised score is divided by
+    `penalty` if positive and multiplied by it if negative.
+    """
+
+    def __init__(self, penalty, window, vocab_start, vocab_end):
+        if not penalty > 0:
+            raise ValueError(
+                f"penalty has to be a strictly positive float, got {penalty}"
+            )
+        if window <= 0:
+            raise ValueError(f"window has to be a positive integer, got {window}")
+        self.penalty = penalty
+        self.window = window
+        self.vocab_start = vocab_start
+        self.vocab_end = vocab_end
+        # any id outside the audio range
+        self.placeholder = vocab_start - 1 if vocab_start > 0 else vocab_end
+        self.start = None  # input length at the first call
+        self.seen = 0  # input length at the previous call
+        self.ring = None  # (B, window) ids of the window
+        self._audio_id = None  # id -> itself if audio, else the placeholder
+
+    def _begin(self, input_ids, scores):
+        batch, device = input_ids.shape[0], input_ids.device
+        self.start = self.seen = input_ids.shape[1]
+        self.ring = torch.full(
+            (batch, self.window), self.placeholder, dtype=torch.long, device=device
+        )
+        self._audio_id = torch.full(
+            (scores.shape[-1],), self.placeholder, dtype=torch.long, device=device
+        )
+        self._audio_id[self.vocab_start : self.vocab_end] = torch.arange(
+            self.vocab_start, self.vocab_end, device=device
+        )
+
+    def __call__(self, input_ids, scores):
+        if self.start is None:
+            self._begin(input_ids, scores)
+        new = self._audio_id[input_ids[:, self.seen :]]
+        for t in range(new.shape[1]):
+            slot = (self.seen + t - self.start) % self.window
+            self.ring[:, slot] = new[:, t]
+        self.seen = input_ids.shape[1]
+        if self.seen == self.start:
+            return scores
+        ring = self.ring
+        score = torch.gather(scores, 1, ring)
+        penalised = torch.where(
+            ring == self.placeholder,
+            score,
+            torch.where(score < 0, score * self.penalty, score / self.penalty),
+        )
+        return scores.scatter_(1, ring, penalised)
+
+
+# benchmark: python repetition.py [context_tokens] [steps] [window]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from transformers import RepetitionPenaltyLogitsProcessor
+
+    context = int(sys.argv[1]) if len(sys.argv) > 1 else 16000
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    window = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    vocab, audio_start, audio_end = 83734, 45334, 46358
+    torch.manual_seed(0)
+    prompt = torch.randint(0, audio_end, (1, context))
+    sampled = torch.randint(audio_start, audio_end, (1, steps))
+    stream = torch.cat([prompt, sampled], dim=1)
+    logits = torch.randn(steps, 1, vocab)
+
+    def run(processor):
+        t0 = time.perf_counter()
+        for step in range(steps):
+            processor(stream[:, : context + step], logits[step].clone())
+        return (time.perf_counter() - t0) / steps * 1e6
+
+    # correctness against the stock processor applied to the window
+    windowed = WindowedRepetitionPenaltyProcessor(1.1, window, audio_start, audio_end)
+    stock = RepetitionPenaltyLogitsProcessor(1.1)
+    for step in range(steps):
+        ours = windowed(stream[:, : context + step], logits[step].clone())
+        recent = sampled[:, max(0, step - window) : step]
+        expected = logits[step].clone()
+        if recent.shape[1]:
+            expected = stock(recent, expected)
+        assert torch.equal(ours, expected), f"mismatch at step {step}"
+    print(f"matches the stock penalty over the window for {steps} steps")
+
+    # stock cost grows with the context, the windowed one does not
+    stock_us = run(RepetitionPenaltyLogitsProcessor(1.1))
+    windowed_us = run(
+        WindowedRepetitionPenaltyProcessor(1.1, window, audio_start, audio_end)
+    )
+    print(
+        f"per step at {context} context tokens: stock {stock_us:.0f} us, "
+        f"windowed ({window}) {windowed_us:.0f} us"
+    )
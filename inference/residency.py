@@ -0,0 +1,204 @@
+import gc
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# the phases of a request in order, and the parts of the pipeline each uses
+PHASES = ("stage1", "stage2", "vocoder")
+PHASE_PARTS = {
+    "stage1": ("stage1", "codec"),
+    "stage2": ("stage2",),
+    "vocoder": ("codec", "vocoders"),
+}
+
+
+def _modules(part):
+    return part if isinstance(part, (tuple, list)) else [part]
+
+
+class PhaseResidency(object):
+    """
+    Keeps the parts of the pipeline ("stage1", "stage2", "codec",
+    "vocoders") in memory only for the phases that use them (PHASE_PARTS).
+
+    enter(phase) returns the parts of `phase`, loading those that are
+    missing, and then:
+    - releases every part no later phase uses, e.g. stage 1 when stage 2
+      starts and stage 2 when the vocoders start;
+    - on cuda, demotes to cpu RAM the parts a later phase uses again but
+      this one does not (the codec during stage 2).
+
+    prefetch(phase) starts the loads and promotions of `phase` on a
+    background thread, so the next phase's weights arrive while the current
+    phase computes; enter waits for them.
+
+    load(names) -> {name: part} loads parts (infer.load_pipeline). Parts in
+    `keep` are never released or moved (models shared with other requests,
+    see serving.py), parts in `placed` never moved (models mmgp's offload
+    profile places itself).
+    """
+
+    def __init__(self, parts, load, device, keep=(), placed=()):
+        self.parts = dict(parts)
+        self.load = load
+        self.device = torch.device(device)
+        self.keep = set(keep)
+        self.placed = set(placed)
+        self.demoted = set()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # seconds enter() waited for each phase's parts
+        self.waits = {}
+
+    def _fetch(self, names):
+        missing = [n for n in names if n not in self.parts]
+        loaded = self.load(missing) if missing else {}
+        promoted = [n for n in names if n in self.demoted]
+        if promoted:
+            stream = torch.cuda.Stream(self.device)
+            with torch.cuda.stream(stream):
+                for name in promoted:
+                    for module in _modules(self.parts[name]):
+                        module.to(self.device, non_blocking=True)
+            stream.synchronize()
+        return loaded, promoted
+
+    def prefetch(self, phase):
+        with self._lock:
+            names = [
+                n
+                for n in PHASE_PARTS[phase]
+                if (n not in self.parts or n in self.demoted) and n not in self._pending
+            ]
+            if names:
+                future = self._executor.submit(self._fetch, names)
+                for name in names:
+                    self._pending[name] = future
+
+    def enter(self, phase):
+        self.prefetch(phase)
+        t0 = time.perf_counter()
+        for name in PHASE_PARTS[phase]:
+            self.get(name)
+        self.waits[phase] = time.perf_counter() - t0
+        later = {n for p in PHASES[PHASES.index(phase) + 1 :] for n in PHASE_PARTS[p]}
+        for name in list(self.parts):
+            if name in PHASE_PARTS[phase] or name in self.keep:
+                continue
+            if name not in later and name not in self._pending:
+                self.release(name)
+            elif name in later and name not in self.placed:
+                self.demote(name)
+        return {name: self.parts[name] for name in PHASE_PARTS[phase]}
+
+    def get(self, name):
+        """One part outside the phase order, waiting for or loading it."""
+        future = self._pending.pop(name, None)
+        if future is not None:
+            loaded, promoted = future.result()
+            self.parts.update(loaded)
+            self.demoted.difference_update(promoted)
+        elif name not in self.parts:
+            self.parts.update(self.load([name]))
+        return self.parts[name]
+
+    def demote(self, name):
+        if name in self.demoted or self.device.type != "cuda":
+            return
+        for module in _modules(self.parts[name]):
+            module.to("cpu")
+        self.demoted.add(name)
+        torch.cuda.empty_cache()
+
+    def release(self, name):
+        """Drop the part; memory returns once the caller holds no reference either."""
+        self.parts.pop(name, None)
+        self.demoted.discard(name)
+        gc.collect()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+# benchmark: python residency.py [layers]
+# a request's phases on scaled down models (stage 1, stage 2 and a stand-in
+# for the vocoders): peak RSS of each phase and the time waited for the next
+# phase's weights, with every part loaded up front and with PhaseResidency
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import warnings
+
+    from transformers import AutoModelForCausalLM
+
+    from backend import Backend, scaled_down_models, stage1_tokens_per_second
+    from memory_plan import PeakMemory, rss
+
+    warnings.filterwarnings("ignore")
+    layers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    backend = Backend("cpu", dtype="bfloat16")
+    torch.manual_seed(0)
+    folder = tempfile.mkdtemp()
+    paths = {}
+    for name, model in zip(("stage1", "stage2"), scaled_down_models(backend, layers)):
+        paths[name] = f"{folder}/{name}"
+        model.save_pretrained(paths[name])
+    del model
+
+    def load(names):
+        parts = {}
+        for name in names:
+            if name in paths:
+                parts[name] = AutoModelForCausalLM.from_pretrained(
+                    paths[name], **backend.model_kwargs()
+                ).eval()
+            elif name == "codec":
+                parts[name] = torch.nn.Linear(1024, 1024).to(backend.dtype)
+            else:
+                # vocoders: two stand-ins the size of the stage-2 stand-in
+                parts[name] = tuple(
+                    torch.nn.Embedding(83734, 256).to(backend.dtype) for _ in range(2)
+                )
+                time.sleep(0.5)  # reading two checkpoints
+        return parts
+
+    def run(phase, parts):
+        if phase == "vocoder":
+            time.sleep(0.5)
+            return
+        stage1_tokens_per_second(parts[phase], context=500, new_tokens=48)
+
+    baseline = rss()
+    for label in ("all parts up front", "phase residency"):
+        t0 = time.perf_counter()
+        if label == "all parts up front":
+            parts = load(("stage1", "stage2", "codec", "vocoders"))
+            residency = None
+        else:
+            residency = PhaseResidency({}, load, backend.device)
+        peaks, waits = [], []
+        for i, phase in enumerate(PHASES):
+            if residency is not None:
+                parts = residency.enter(phase)
+                if i + 1 < len(PHASES):
+                    residency.prefetch(PHASES[i + 1])
+            waits.append(residency.waits[phase] if residency is not None else 0.0)
+            with PeakMemory("cpu") as peak:
+                run(phase, parts)
+            peaks.append(peak.start + peak.bytes - baseline)
+        total = time.perf_counter() - t0
+        if residency is not None:
+            residency.close()
+        parts = None
+        print(
+            f"{label:18s} peak RSS per phase "
+            + " ".join(f"{p / 2**20:6.0f}" for p in peaks)
+            + " MiB | waited for weights "
+            + " ".join(f"{w:4.2f}" for w in waits)
+            + f" s | total {total:5.2f} s"
+        )
@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from mmtokenizer import file_sha256
+
+# args that change the stage-1 tokens. With a memory budget, infer.py plans
+# --profile and --stage2_batch_size after the cache lookup: the budgets are
+# keyed along with the arguments as given, so a hit measures nothing.
+STAGE1_FIELDS = (
+    "stage1_model",
+    "max_new_tokens",
+    "repetition_penalty",
+    "repetition_window",
+    "run_n_segments",
+    "use_audio_prompt",
+    "use_dual_tracks_prompt",
+    "prompt_start_time",
+    "prompt_end_time",
+    "seed",
+    "profile",
+    "basic_model_config",
+    "resume_path",
+    "edit_from",
+    "long_context",
+    "kv_cache_dtype",
+    "fused_cfg",
+    "cfg_tokens",
+    "restricted_sampler",
+    "dtype",
+    "attn_implementation",
+    "quantize",
+    "quantize_group_size",
+    "ram_budget_gb",
+    "vram_budget_gb",
+)
+# args that additionally change the stage-2 codes (--compile decodes over a
+# static KV cache, which is not bit-identical to re-prefilling)
+STAGE2_FIELDS = ("stage2_model", "stage2_batch_size", "compile")
+# args that only change the rendered audio
+OUTPUT_FIELDS = (
+    "config_path",
+    "vocal_decoder_path",
+    "inst_decoder_path",
+    "rescale",
+    "output_format",
+)
+PROMPT_FILES = (
+    "audio_prompt_path",
+    "vocal_track_prompt_path",
+    "instrumental_track_prompt_path",
+)
+
+
+def _path_identity(value):
+    """Local files are identified by path, size and mtime; anything else (hub ids) by value."""
+    if isinstance(value, str) and value and os.path.isfile(value):
+        st = os.stat(value)
+        return [os.path.realpath(value), st.st_size, st.st_mtime_ns]
+    return value
+
+
+def _digest(payload):
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def stage1_fingerprint(args, genres, lyrics, device):
+    """
+    Key of the stage-1 tokens: prompt text, models, seed, sampling params,
+    the content of any audio prompt and the device type (cpu and cuda kernels
+    do not produce the same samples).
+    """
+    payload = {
+        "genres": genres,
+        "lyrics": lyrics,
+        "device": str(device).split(":")[0],
+        "args": {f: _path_identity(getattr(args, f, None)) for f in STAGE1_FIELDS},
+    }
+    if getattr(args, "use_audio_prompt", False) or getattr(
+        args, "use_dual_tracks_prompt", False
+    ):
+        payload["prompt_files"] = {
+            f: file_sha256(getattr(args, f))
+            for f in PROMPT_FILES
+            if getattr(args, f, "") and os.path.isfile(getattr(args, f))
+        }
+    return _digest(payload)
+
+
+def stage2_fingerprint(args, stage1_key):
+    return _digest(
+        {
+            "stage1": stage1_key,
+            "args": {f: _path_identity(getattr(args, f, None)) for f in STAGE2_FIELDS},
+        }
+    )
+
+
+def request_fingerprint(args, stage2_key):
+    return _digest(
+        {
+            "stage2": stage2_key,
+            "args": {f: _path_identity(getattr(args, f, None)) for f in OUTPUT_FIELDS},
+        }
+    )
+
+
+def _copy(src, dst):
+    """
+    Copy src to dst through a temporary file renamed over it. Entries never
+    share an inode with the output directory: writers that rewrite a file in
+    place (soundfile truncates it) would change every hard link to it, i.e.
+    the cached result of an earlier request.
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp_path = f"{dst}.tmp{uuid.uuid4().hex}"
+    try:
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _link(src, dst):
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache(object):
+    """
+    Content-addressed store of finished files.
+
+    An entry is a directory holding copies of the files of one request plus a
+    manifest. `put` takes {relative path: source file}, `restore` recreates
+    those relative paths under another directory, so a hit costs a few file
+    copies instead of a pipeline run. Files are copied, not linked, so
+    rewriting an output (the fixed stem names, a mix rendered again from a
+    reused job) never changes an entry, nor a restored file an entry.
+
+    max_bytes / max_age (seconds): entries older than max_age are dropped, then
+    the least recently used ones until the cache fits in max_bytes. None
+    disables the respective limit.
+    """
+
+    MANIFEST = "entry.json"
+
+    def __init__(self, root, max_bytes=None, max_age=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _load_manifest(self, entry_dir):
+        try:
+            with open(
+                os.path.join(entry_dir, self.MANIFEST), "r", encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _expired(self, manifest, now=None):
+        if self.max_age is None:
+            return False
+        return (now or time.time()) - manifest["created"] > self.max_age
+
+    def get(self, key):
+        """Manifest of a live entry ({"files", "metadata", "created"}) or None."""
+        entry_dir = self._entry_dir(key)
+        manifest = self._load_manifest(entry_dir)
+        if manifest is None:
+            return None
+        missing = any(
+            not os.path.exists(os.path.join(entry_dir, name))
+            for name in manifest["files"].values()
+        )
+        if missing or self._expired(manifest):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        # the manifest mtime is the last access time used by LRU eviction
+        os.utime(os.path.join(entry_dir, self.MANIFEST))
+        manifest["dir"] = entry_dir
+        return manifest
+
+    def path(self, key, name):
+        """Absolute path of one cached file, or None on a miss."""
+        manifest = self.get(key)
+        if manifest is None or name not in manifest["files"]:
+            return None
+        return os.path.join(manifest["dir"], manifest["files"][name])
+
+    def restore(self, key, dest_dir, link=False):
+        """
+        Copy the files of an entry under dest_dir; returns its manifest or None.
+        link: hard link them instead, for a private dest_dir nothing writes to.
+        """
+        manifest = self.get(key)
+        if manifest is None:
+            return None
+        place = _link if link else _copy
+        for rel_path, name in manifest["files"].items():
+            place(os.path.join(manifest["dir"], name), os.path.join(dest_dir, rel_path))
+        return manifest
+
+    def put(self, key, files, metadata=None, move=False):
+        """
+        files: {relative path: existing file}. The entry is staged in a temporary
+        directory and renamed into place, so concurrent readers never see a
+        partial entry.
+
+        move: the files are the caller's to give away (written for the cache
+        only, on the same file system); they are renamed into the entry
+        instead of copied.
+        """
+        tmp_dir = os.path.join(self.root, f".tmp-{key}-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            stored = {}
+            for i, (rel_path, src) in enumerate(files.items()):
+                name = f"{i}_{os.path.basename(rel_path)}"
+                if move:
+                    shutil.move(src, os.path.join(tmp_dir, name))
+                else:
+                    _copy(src, os.path.join(tmp_dir, name))
+                stored[rel_path] = name
+            manifest = {
+                "files": stored,
+                "metadata": metadata or {},
+                "created": time.time(),
+            }
+            with open(os.path.join(tmp_dir, self.MANIFEST), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            entry_dir = self._entry_dir(key)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+        return entry_dir
+
+    def _entries(self):
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if shard.startswith(".") or not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                yield os.path.join(shard_dir, key)
+
+    @staticmethod
+    def _size(entry_dir):
+        return sum(
+            os.path.getsize(os.path.join(entry_dir, name))
+            for name in os.listdir(entry_dir)
+        )
+
+    def evict(self):
+        """Apply the age and size limits; returns the number of dropped entries."""
+        now = time.time()
+        live = []
+        dropped = 0
+        for entry_dir in self._entries():
+            manifest = self._load_manifest(entry_dir)
+            if manifest is None or self._expired(manifest, now):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                dropped += 1
+                continue
+            last_used = os.path.getmtime(os.path.join(entry_dir, self.MANIFEST))
+            live.append((last_used, self._size(entry_dir), entry_dir))
+        if self.max_bytes is not None:
+            total = sum(size for _, size, _ in live)
+            for _, size, entry_dir in sorted(live):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                dropped += 1
+        return dropped
@@ -0,0 +1,296 @@
+import torch
+
+from repetition import TokenCounts, apply_penalty
+
+
+def stage1_valid_ids(codectool, eoa, device=None):
+    """The ids stage 1 can emit inside a segment: codebook-0 codes and <EOA>."""
+    start = codectool.global_offset
+    return torch.cat(
+        [
+            torch.arange(start, start + codectool.codebook_size, device=device),
+            torch.tensor([eoa], device=device),
+        ]
+    )
+
+
+class RestrictedSampler(object):
+    """
+    Next-token sampling over a fixed set of valid ids in one pass.
+
+    The processor chain of `model.generate` runs CFG mixing, the repetition
+    penalty, min_new_tokens, the token blocks, temperature, top-k and top-p
+    (a sort of the whole 83k vocabulary) one after the other over the full
+    logits. Here the logits are narrowed to `valid_ids` first and everything
+    else runs on that slice; the only full-vocabulary work left is the
+    logsumexp that CFG needs to normalise both branches.
+
+    The result is the distribution of the stock chain with every id outside
+    `valid_ids` blocked, which is the stock distribution itself whenever
+    top-k / top-p leave no mass outside them. Anything else sampled inside a
+    stage-1 segment would not decode as codebook 0 anyway. python sampler.py
+    compares both against the chain.
+
+    logits passed to __call__ are (1, V), or (2, V) conditional and
+    unconditional rows when guidance_scale is set (Stage1Decoder fused_cfg).
+    repetition_window > 0 penalises only the last that many tokens of the
+    segment, as WindowedRepetitionPenaltyProcessor.
+    """
+
+    def __init__(
+        self,
+        valid_ids,
+        vocab_size,
+        guidance_scale=None,
+        repetition_penalty=1.0,
+        repetition_window=0,
+        min_new_tokens=0,
+        eos_token_id=None,
+        temperature=1.0,
+        top_k=None,
+        top_p=1.0,
+        do_sample=True,
+    ):
+        self.valid_ids = valid_ids
+        self.guidance_scale = guidance_scale
+        self.repetition_penalty = repetition_penalty
+        self.min_new_tokens = min_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.do_sample = do_sample
+        n = valid_ids.shape[0]
+        self._lookup = torch.full((vocab_size,), n, dtype=torch.long)
+        self._lookup[valid_ids.cpu()] = torch.arange(n)
+        self._lookup = self._lookup.to(valid_ids.device)
+        self.eos_index = None
+        if eos_token_id is not None and eos_token_id in valid_ids.tolist():
+            self.eos_index = valid_ids.tolist().index(eos_token_id)
+        self.counts = None
+        if repetition_penalty not in (None, 1.0):
+            self.counts = TokenCounts(n, self._lookup.__getitem__, repetition_window)
+        self.prompt_length = None
+
+    def scores(self, input_ids, logits):
+        """(B, len(valid_ids)) processed scores of the valid ids."""
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        logits = logits.float()
+        scores = logits[:, self.valid_ids]
+        if self.guidance_scale is not None:
+            # log_softmax over the full vocabulary, as the CFG processor
+            scores = scores - torch.logsumexp(logits, dim=-1, keepdim=True)
+            if scores.shape[0] == 2:
+                cond, uncond = scores[:1], scores[1:]
+                scores = self.guidance_scale * (cond - uncond) + uncond
+        if self.counts is not None:
+            self.counts.update(input_ids)
+            scores = apply_penalty(
+                scores, self.counts.present(), self.repetition_penalty
+            )
+        if (
+            self.eos_index is not None
+            and input_ids.shape[1] - self.prompt_length < self.min_new_tokens
+        ):
+            scores[:, self.eos_index] = -float("inf")
+        if not self.do_sample:
+            return scores
+        if self.temperature not in (None, 1.0):
+            scores = scores / self.temperature
+        if self.top_k and self.top_k < scores.shape[-1]:
+            kth = torch.topk(scores, self.top_k)[0][..., -1:]
+            scores = scores.masked_fill(scores < kth, -float("inf"))
+        if self.top_p is not None and self.top_p < 1.0:
+            sorted_scores, order = torch.sort(scores, descending=False, stable=True)
+            cumulative = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+            remove = cumulative <= 1 - self.top_p
+            remove[..., -1:] = False  # keep at least one
+            scores = scores.masked_fill(remove.scatter(1, order, remove), -float("inf"))
+        return scores
+
+    def probs(self, input_ids, logits):
+        return torch.softmax(self.scores(input_ids, logits), dim=-1)
+
+    def __call__(self, input_ids, logits):
+        """(1, 1) sampled id."""
+        scores = self.scores(input_ids, logits)
+        if self.do_sample:
+            index = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+        else:
+            index = torch.argmax(scores, dim=-1, keepdim=True)
+        return self.valid_ids[index]
+
+
+# check and benchmark: python sampler.py [context_tokens] [steps]
+# the check raises when the sampler's distribution departs from the
+# processor chain's by more than float32 rounding (plus, for the stock
+# chain, the mass it leaves on ids the sampler never considers). A second
+# model leaves a real share of its mass outside codebook 0 + <EOA>: there the
+# sampler must equal the chain with those ids blocked, and the stock chain's
+# distribution renormalised over the valid ids when no top-k / top-p runs
+if __name__ == "__main__":
+    import sys
+    import time
+    from types import SimpleNamespace
+
+    from transformers import (
+        LogitsProcessorList,
+        MinNewTokensLengthLogitsProcessor,
+        RepetitionPenaltyLogitsProcessor,
+        TemperatureLogitsWarper,
+        TopKLogitsWarper,
+        TopPLogitsWarper,
+        UnbatchedClassifierFreeGuidanceLogitsProcessor,
+    )
+
+    from codecmanipulator import CodecManipulator
+    from repetition import WindowedRepetitionPenaltyProcessor
+
+    context = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    vocab, eoa = 83734, 32002
+    codectool = CodecManipulator("xcodec", 0, 1)
+    valid_ids = stage1_valid_ids(codectool, eoa)
+    settings = dict(
+        guidance_scale=1.5,
+        repetition_penalty=1.1,
+        min_new_tokens=100,
+        temperature=1.0,
+        top_k=50,
+        top_p=0.93,
+    )
+
+    class Blocked(object):
+        """BlockTokenRangeProcessor of infer.py, or any other id mask."""
+
+        def __init__(self, ids):
+            self.ids = ids
+
+        def __call__(self, input_ids, scores):
+            scores[:, self.ids] = -float("inf")
+            return scores
+
+    class Unconditional(object):
+        """Stands in for the model of the CFG processor: replays given logits."""
+
+        def __call__(self, input_ids, **kwargs):
+            return SimpleNamespace(logits=self.logits, get=lambda *a: None)
+
+    def chain(prompt_length, window, block_invalid, options=settings):
+        uncond = Unconditional()
+        blocked = torch.ones(vocab, dtype=torch.bool)
+        blocked[valid_ids] = False
+        processors = [
+            UnbatchedClassifierFreeGuidanceLogitsProcessor(
+                options["guidance_scale"], uncond
+            )
+        ]
+        if not window:
+            processors.append(
+                RepetitionPenaltyLogitsProcessor(options["repetition_penalty"])
+            )
+        processors += [
+            MinNewTokensLengthLogitsProcessor(
+                prompt_length, options["min_new_tokens"], eoa
+            ),
+            Blocked(list(range(0, 32002))),
+        ]
+        if window:
+            processors.append(
+                WindowedRepetitionPenaltyProcessor(
+                    options["repetition_penalty"],
+                    window,
+                    codectool.global_offset,
+                    codectool.global_offset + codectool.codebook_size,
+                )
+            )
+        if block_invalid:
+            processors.append(Blocked(blocked.nonzero().flatten()))
+        processors.append(TemperatureLogitsWarper(options["temperature"]))
+        if options["top_k"]:
+            processors.append(TopKLogitsWarper(options["top_k"]))
+        if options["top_p"] < 1.0:
+            processors.append(TopPLogitsWarper(options["top_p"]))
+        return LogitsProcessorList(processors), uncond
+
+    def compare(logits, window, block_invalid, options=settings, renormalise=False):
+        """(max |p - p_chain| over the valid ids, chain mass outside them)."""
+        processors, uncond = chain(context, window, block_invalid, options)
+        sampler = RestrictedSampler(
+            valid_ids, vocab, repetition_window=window, eos_token_id=eoa, **options
+        )
+        worst = outside = 0.0
+        for step in range(steps):
+            input_ids = stream[:, : context + step]
+            uncond.logits = logits[step, 1:].unsqueeze(1)
+            full = processors(input_ids, logits[step, :1].clone()).softmax(-1)
+            inside = full[:, valid_ids]
+            if renormalise:
+                inside = inside / inside.sum(-1, keepdim=True)
+            ours = sampler.probs(input_ids, logits[step])
+            worst = max(worst, (inside - ours).abs().max().item())
+            outside = max(outside, 1 - full[:, valid_ids].sum().item())
+        return worst, outside
+
+    torch.manual_seed(0)
+    prompt = torch.randint(0, vocab, (1, context))
+    sampled = valid_ids[torch.randint(0, 1024, (1, steps))]
+    stream = torch.cat([prompt, sampled], dim=1)
+    # a model that puts its mass on codebook 0, as stage 1 does
+    logits = torch.randn(steps, 2, vocab) * 2
+    logits[:, :, valid_ids] += 12
+    tolerance = 1e-5
+
+    for window in (0, 300):
+        for block_invalid in (True, False):
+            worst, outside = compare(logits, window, block_invalid)
+            print(
+                f"window {window:3d}, {'invalid ids blocked' if block_invalid else 'stock chain':19s}: "
+                f"max |p - p_chain| {worst:.2e}, chain mass outside the valid ids {outside:.2e}"
+            )
+            if worst > outside + tolerance:
+                raise AssertionError(
+                    f"window {window}: max |p - p_chain| {worst:.2e} exceeds "
+                    f"{outside:.2e} + {tolerance:.0e}"
+                )
+
+    # a model that leaves a real share of its mass outside the valid ids
+    spread = torch.randn(steps, 2, vocab) * 2
+    spread[:, :, valid_ids] += 4
+    unfiltered = dict(settings, top_k=None, top_p=1.0)
+    for window in (0, 300):
+        blocked_worst, _ = compare(spread, window, True)
+        renormalised_worst, outside = compare(
+            spread, window, False, unfiltered, renormalise=True
+        )
+        print(
+            f"window {window:3d}, mass outside {outside:.2f}: max |p - p_chain| "
+            f"{blocked_worst:.2e} invalid ids blocked, {renormalised_worst:.2e} "
+            f"stock chain renormalised over the valid ids (no top-k / top-p)"
+        )
+        if outside < 0.1:
+            raise AssertionError(f"only {outside:.2e} of the mass is outside")
+        if max(blocked_worst, renormalised_worst) > tolerance:
+            raise AssertionError(
+                f"window {window}: max |p - p_chain| "
+                f"{max(blocked_worst, renormalised_worst):.2e} exceeds {tolerance:.0e}"
+            )
+
+    processors, uncond = chain(context, 0, False)
+    sampler = RestrictedSampler(valid_ids, vocab, eos_token_id=eoa, **settings)
+    timings = {}
+    for name in ("chain", "restricted"):
+        t0 = time.perf_counter()
+        for step in range(steps):
+            input_ids = stream[:, : context + step]
+            if name == "chain":
+                uncond.logits = logits[step, 1:].unsqueeze(1)
+                scores = processors(input_ids, logits[step, :1].clone())
+                torch.multinomial(scores.softmax(-1), num_samples=1)
+            else:
+                sampler(input_ids, logits[step])
+        timings[name] = (time.perf_counter() - t0) / steps * 1e6
+    print(
+        f"per step at {context} context tokens: processor chain "
+        f"{timings['chain']:.0f} us, restricted sampler {timings['restricted']:.0f} us"
+    )
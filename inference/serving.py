@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.multiprocessing as mp
+
+from backend import physical_cpus
+
+
+class SnapshotRef(object):
+    """A model loaded from a weight snapshot, sent to workers as its files."""
+
+    def __init__(self, files):
+        self.files = files
+
+
+def share_pipeline(pipeline):
+    """
+    Prepare the models of a pipeline (load_pipeline) for worker processes.
+
+    Models mapped from a weight snapshot (--quantize with --cache_dir) are
+    already shared through the page cache; they become SnapshotRefs and each
+    worker maps the same files again. Every other model is moved into shared
+    memory (torch's share_memory_, one copy), which workers attach to when
+    they unpickle it. Returns the portable pipeline.
+    """
+    portable = {}
+    for name, value in pipeline.items():
+        several = isinstance(value, (tuple, list))
+        models = value if several else [value]
+        shared = []
+        for model in models:
+            if getattr(model, "snapshot_files", None):
+                shared.append(SnapshotRef(model.snapshot_files))
+            else:
+                shared.append(model.share_memory())
+        portable[name] = type(value)(shared) if several else shared[0]
+    return portable
+
+
+def attach_pipeline(portable):
+    """Worker side of share_pipeline."""
+    from weight_snapshot import load_snapshot
+
+    pipeline = {}
+    for name, value in portable.items():
+        several = isinstance(value, (tuple, list))
+        models = value if several else [value]
+        attached = [
+            load_snapshot(m.files) if isinstance(m, SnapshotRef) else m for m in models
+        ]
+        pipeline[name] = type(value)(attached) if several else attached[0]
+    return pipeline
+
+
+def memory(pid="self"):
+    """
+    MiB of a process from /proc/<pid>/smaps_rollup (Linux): rss, pss (shared
+    pages divided among the processes mapping them), private and shared.
+    """
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "private": fields["Private_Clean"] + fields["Private_Dirty"],
+        "shared": fields["Shared_Clean"] + fields["Shared_Dirty"],
+    }
+
+
+def run_request(pipeline, job):
+    """Default worker task: one infer.py request, job = args namespace."""
+    from infer import main
+
+    return main(job, pipeline)
+
+
+def _worker(index, portable, threads, task, tasks, results):
+    torch.set_num_threads(threads)
+    pipeline = attach_pipeline(portable) if portable is not None else None
+    results.put((None, index, "ready", memory()))
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        job_id, job = item
+        try:
+            value = task(pipeline, job)
+            results.put((job_id, index, "done", value))
+        except Exception as e:  # reported to the parent, the worker lives on
+            results.put((job_id, index, "error", f"{type(e).__name__}: {e}"))
+
+
+class WorkerPool(object):
+    """
+    Worker processes running requests on one copy of the model weights.
+
+    The parent loads the pipeline once; share_pipeline puts it where the
+    workers can map it, so a worker only adds its own KV caches, activations
+    and interpreter to the host's memory. Workers are spawned (fork would
+    copy the parent's OpenMP state) and each uses threads_per_worker intra-op
+    threads, by default the physical cores split evenly.
+
+        pool = WorkerPool(pipeline, workers=4)
+        ids = [pool.submit(job) for job in jobs]
+        for job_id, status, value in pool.results(len(ids)): ...
+        pool.close()
+
+    task(pipeline, job) runs in the workers and must be importable by name;
+    it defaults to run_request (infer.main). pipeline=None leaves loading to
+    the task, which is how the duplicated-weights baseline is measured.
+    """
+
+    def __init__(self, pipeline, workers, threads_per_worker=0, task=run_request):
+        if not threads_per_worker:
+            cores = len(physical_cpus(sorted(os.sched_getaffinity(0))))
+            threads_per_worker = max(1, cores // workers)
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self._results = context.Queue()
+        portable = share_pipeline(pipeline) if pipeline is not None else None
+        self.processes = [
+            context.Process(
+                target=_worker,
+                args=(i, portable, threads_per_worker, task, self.tasks, self._results),
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+        # wait until every worker holds its models
+        self.ready = {}
+        while len(self.ready) < workers:
+            _, index, _, usage = self._results.get()
+            self.ready[index] = usage
+        self._next_id = 0
+
+    def submit(self, job):
+        job_id = self._next_id
+        self._next_id += 1
+        self.tasks.put((job_id, job))
+        return job_id
+
+    def results(self, n, timeout=None):
+        """Yield (job id, "done" | "error", value) for the next n finished jobs."""
+        for _ in range(n):
+            job_id, _, status, value = self._results.get(timeout=timeout)
+            yield job_id, status, value
+
+    def memory(self):
+        """memory() of every worker, see there."""
+        return [memory(p.pid) for p in self.processes]
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+
+
+def small_job(pipeline, job):
+    """
+    Check task: stage-1 and stage-2 token generation with the scaled down
+    models of backend.py, loaded here when there is no shared pipeline.
+    """
+    from backend import Backend, scaled_down_models
+
+    if pipeline is None:
+        backend = Backend("cpu", dtype="bfloat16", threads=torch.get_num_threads())
+        torch.manual_seed(0)
+        stage1, stage2 = scaled_down_models(backend, layers=job.layers)
+        pipeline = {"stage1": stage1, "stage2": stage2}
+    with torch.no_grad():
+        for name in ("stage1", "stage2"):
+            prompt = torch.randint(45334, 46358, (1, job.context))
+            pipeline[name].generate(
+                input_ids=prompt,
+                max_new_tokens=job.new_tokens,
+                min_new_tokens=job.new_tokens,
+                do_sample=False,
+                pad_token_id=0,
+            )
+    return memory()
+
+
+def check(workers=3, layers=8):
+    """
+    RSS/PSS of workers sharing one copy of scaled down stage-1/stage-2 LLMs,
+    against workers that load their own copy.
+    """
+    from backend import Backend, scaled_down_models
+    from quantize import model_nbytes
+
+    job = SimpleNamespace(layers=layers, context=256, new_tokens=16)
+    backend = Backend("cpu", dtype="bfloat16")
+    torch.manual_seed(0)
+    stage1, stage2 = scaled_down_models(backend, layers=layers)
+    weights = (model_nbytes(stage1) + model_nbytes(stage2)) / 2**20
+    print(f"{workers} workers, weights of both LLMs {weights:.0f} MiB")
+
+    for label, pipeline in (
+        ("own copy per worker", None),
+        ("shared weights", {"stage1": stage1, "stage2": stage2}),
+    ):
+        t0 = time.perf_counter()
+        pool = WorkerPool(pipeline, workers, threads_per_worker=1, task=small_job)
+        start = time.perf_counter() - t0
+        for _ in range(workers):
+            pool.submit(job)
+        # measured by each job before it returns: weights, caches and
+        # activations all live (the own-copy workers drop theirs afterwards)
+        usage = []
+        for job_id, status, value in pool.results(workers, timeout=600):
+            assert status == "done", value
+            usage.append(value)
+        pool.close()
+        parent = memory()
+        print(
+            f"{label:20s} start {start:5.1f} s | per request rss "
+            + " ".join(f"{u['rss']:5.0f}" for u in usage)
+            + " private "
+            + " ".join(f"{u['private']:5.0f}" for u in usage)
+            + f" MiB | pss workers {sum(u['pss'] for u in usage):6.0f} + parent "
+            f"{parent['pss']:5.0f} MiB"
+        )
+
+
+def serve(argv=None):
+    """
+    python serving.py --workers N --jobs jobs.jsonl [infer.py arguments]
+
+    Loads the pipeline once and runs every line of jobs.jsonl, a json object
+    of infer.py arguments overriding the command line ones (e.g.
+    {"genre_txt": ..., "lyrics_txt": ..., "output_dir": ..., "seed": 1}), on
+    the worker processes. Only the stage-1/stage-2 LLMs, the codec and the
+    vocoders are shared, so jobs must not change the model arguments.
+    """
+    from backend import backend_from_args
+    from infer import create_args, load_pipeline
+
+    _, parser = create_args()
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads_per_worker", type=int, default=0)
+    parser.add_argument("--jobs", type=str, required=True)
+    args = parser.parse_args(argv)
+    backend = backend_from_args(args)
+    if backend.name != "cpu":
+        raise ValueError("serving.py runs on the cpu backend")
+    args.threads = args.threads_per_worker or max(1, backend.threads // args.workers)
+    with open(args.jobs, "r", encoding="utf-8") as f:
+        jobs = [json.loads(line) for line in f if line.strip()]
+    pipeline = load_pipeline(args, backend, ("stage1", "stage2", "codec", "vocoders"))
+    pool = WorkerPool(pipeline, args.workers, threads_per_worker=args.threads)
+    print(
+        f"{args.workers} workers ready: "
+        + ", ".join(f"{u['private']:.0f} MiB private" for u in pool.ready.values())
+    )
+    for overrides in jobs:
+        job = argparse.Namespace(**{**vars(args), **overrides})
+        pool.submit(job)
+    failed = 0
+    for job_id, status, value in pool.results(len(jobs)):
+        print(f"job {job_id}: {status} {value}")
+        failed += status != "done"
+    pool.close()
+    return failed
+
+
+# check: python serving.py --check [workers] [layers]
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--check":
+        check(*[int(a) for a in sys.argv[2:4]])
+    else:
+        sys.exit(1 if serve() else 0)
@@ -0,0 +1,281 @@
+import torch
+from transformers import DynamicCache
+from transformers.models.llama.modeling_llama import rotate_half
+
+
+class SinkWindowCache(DynamicCache):
+    """
+    KV cache that holds the first `n_sink` positions (the instruction and
+    reference block of a stage-1 prompt) plus a rolling window of the most
+    recent tokens, at most `capacity` positions in total.
+
+    When new tokens do not fit, at least `evict_chunk` of the oldest window
+    tokens are dropped at once and the remaining window keys are rotated back
+    by the number of dropped positions. Cached positions therefore always run
+    0..len-1 without gaps, so the next token simply goes at position len and
+    the model never sees a position past `capacity`.
+
+    Storage is preallocated per layer instead of growing by torch.cat on every
+    token: `reserve(n)` sizes the buffers for n positions (the caller's
+    estimate for the next segment) and a segment that outruns its estimate
+    grows them once to `capacity`. `allocations` / `allocated_bytes` count what
+    the buffers cost; exact_growth=True allocates exactly what every update
+    needs, which is what a DynamicCache does, for comparison.
+
+    `batch` reserves rows for updates that only write some of them: an update
+    of b rows writes and returns rows [0, b). With `rotated_rows` set, only
+    that many leading rows are re-rotated on eviction, the others keep their
+    own positions (the unconditional CFG row of Stage1Decoder).
+    """
+
+    def __init__(self, rotary_emb, capacity, evict_chunk=1024, exact_growth=False):
+        super().__init__()
+        self.rotary_emb = rotary_emb
+        self.capacity = capacity
+        self.evict_chunk = evict_chunk
+        self.exact_growth = exact_growth
+        self.n_sink = 0
+        self.batch = 1
+        self.rotated_rows = None
+        self.reserved = 0
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self._planes = []  # per layer: buffers of shape (B, H, allocated, X)
+        self._lengths = []
+
+    # ----------------------------------------------------------------- storage
+    def __len__(self):
+        return len(self._planes)
+
+    def get_seq_length(self, layer_idx=0):
+        return self._lengths[layer_idx] if layer_idx < len(self._lengths) else 0
+
+    def _alloc(self, like, size):
+        shape = (
+            (max(like.shape[0], self.batch),)
+            + like.shape[1:-2]
+            + (size,)
+            + like.shape[-1:]
+        )
+        # rows that are not written by every update must not hold nan/inf
+        # garbage, masked attention still multiplies their values by zero
+        empty = torch.zeros if self.batch > 1 else torch.empty
+        buf = empty(shape, dtype=like.dtype, device=like.device)
+        self.allocations += 1
+        self.allocated_bytes += buf.numel() * buf.element_size()
+        return buf
+
+    def _resize(self, layer, size):
+        length = self._lengths[layer]
+        planes = []
+        for buf in self._planes[layer]:
+            new = self._alloc(buf, size)
+            new[:, :, :length] = buf[:, :, :length]
+            planes.append(new)
+        self._planes[layer] = planes
+
+    def reserve(self, n):
+        """Make room for n positions (capped at capacity) up front."""
+        self.reserved = min(n, self.capacity)
+        if self.exact_growth:
+            return
+        for layer, planes in enumerate(self._planes):
+            if planes[0].shape[-2] < self.reserved:
+                self._resize(layer, self.reserved)
+
+    def _append(self, layer, tensors):
+        rows, n = tensors[0].shape[0], tensors[0].shape[-2]
+        if layer == len(self._planes):
+            size = n if self.exact_growth else max(n, self.reserved)
+            self._planes.append([self._alloc(t, size) for t in tensors])
+            self._lengths.append(0)
+        length = self._lengths[layer]
+        if length + n > self._planes[layer][0].shape[-2]:
+            if self.exact_growth:
+                size = length + n
+            elif self.reserved >= length + n:
+                size = self.reserved
+            else:
+                # the segment outran its estimate, fall back to the hard cap
+                size = max(self.capacity, length + n)
+            self._resize(layer, size)
+        for buf, t in zip(self._planes[layer], tensors):
+            buf[:rows, :, length : length + n] = t
+        self._lengths[layer] = length + n
+        return [buf[:rows, :, : length + n] for buf in self._planes[layer]]
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        keys, values = self._append(layer_idx, [key_states, value_states])
+        return keys, values
+
+    def nbytes(self):
+        """Bytes held by the cache buffers."""
+        return sum(
+            buf.numel() * buf.element_size()
+            for planes in self._planes
+            for buf in planes
+        )
+
+    # ---------------------------------------------------------------- eviction
+    def _rotate_back(self, keys, shift):
+        rows = keys.shape[0] if self.rotated_rows is None else self.rotated_rows
+        position = torch.tensor(
+            [[shift]] * rows + [[0]] * (keys.shape[0] - rows), device=keys.device
+        )
+        cos, sin = self.rotary_emb(keys.float(), position)
+        scaling = getattr(self.rotary_emb, "attention_scaling", 1.0)
+        cos, sin = cos.unsqueeze(1) / scaling, sin.unsqueeze(1) / scaling
+        # R(p - shift) = R(-shift) R(p)
+        rotated = keys.float() * cos - rotate_half(keys.float()) * sin
+        return rotated.to(keys.dtype)
+
+    def make_room(self, n_new):
+        """Evict window tokens so that n_new more fit; returns the number dropped."""
+        length = self.get_seq_length()
+        excess = length + n_new - self.capacity
+        if excess <= 0:
+            return 0
+        window = length - self.n_sink
+        drop = min(window, max(excess, self.evict_chunk))
+        if drop < excess:
+            raise ValueError(
+                f"{n_new} new tokens do not fit next to {self.n_sink} sink tokens "
+                f"in a cache of {self.capacity}"
+            )
+        for layer in range(len(self._planes)):
+            length = self._lengths[layer]
+            window = [
+                buf[:, :, self.n_sink + drop : length] for buf in self._planes[layer]
+            ]
+            for buf, x in zip(self._planes[layer], self._shift_window(window, drop)):
+                buf[:, :, self.n_sink : length - drop] = x
+            self._lengths[layer] = length - drop
+        return drop
+
+    def _shift_window(self, planes, drop):
+        """Window planes moved `drop` positions to the front (new tensors)."""
+        keys, values = planes
+        return [self._rotate_back(keys, drop), values.clone()]
+
+
+KV_DTYPES = ("auto", "int8", "fp8")
+
+
+class QuantizedSinkWindowCache(SinkWindowCache):
+    """
+    SinkWindowCache that stores keys and values as int8 or float8 (e4m3) with
+    one float32 scale per head and token (absmax over the head dimension).
+
+    Each layer's cache is dequantized to the compute dtype only while that
+    layer attends, so the resident cache takes about half the memory of bf16
+    (plus 4 bytes of scale per head and token) and only one layer is ever held
+    in full precision at a time.
+    """
+
+    QMAX = {"int8": 127.0, "fp8": 448.0}
+
+    def __init__(
+        self,
+        rotary_emb,
+        capacity,
+        evict_chunk=1024,
+        kv_dtype="int8",
+        exact_growth=False,
+    ):
+        super().__init__(rotary_emb, capacity, evict_chunk, exact_growth)
+        if kv_dtype not in self.QMAX:
+            raise ValueError(f"unknown kv_dtype {kv_dtype}, expected int8 or fp8")
+        self.kv_dtype = kv_dtype
+        self.qmax = self.QMAX[kv_dtype]
+
+    def _quantize(self, x):
+        scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / self.qmax
+        scaled = x.float() / scale
+        if self.kv_dtype == "int8":
+            q = scaled.round_().clamp_(-self.qmax, self.qmax).to(torch.int8)
+        else:
+            q = scaled.to(torch.float8_e4m3fn)
+        return q, scale
+
+    @staticmethod
+    def _dequantize(q, scale, dtype):
+        # int8 values are exact in bf16/fp16, so the product can run in the
+        # compute dtype instead of going through float32
+        return q.to(dtype) * scale.to(dtype)
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        qk, sk = self._quantize(key_states)
+        qv, sv = self._quantize(value_states)
+        qk, qv, sk, sv = self._append(layer_idx, [qk, qv, sk, sv])
+        dtype = key_states.dtype
+        return self._dequantize(qk, sk, dtype), self._dequantize(qv, sv, dtype)
+
+    def _shift_window(self, planes, drop):
+        qk, qv, sk, sv = planes
+        keys = self._dequantize(qk, sk, torch.float32)
+        qk, sk = self._quantize(self._rotate_back(keys, drop))
+        return [qk, qv.clone(), sk, sv.clone()]
+
+
+def build_sink_cache(
+    rotary_emb, capacity, evict_chunk=1024, kv_dtype="auto", exact_growth=False
+):
+    """kv_dtype: "auto" keeps the model dtype, "int8" / "fp8" quantize the cache."""
+    if kv_dtype in (None, "auto"):
+        return SinkWindowCache(rotary_emb, capacity, evict_chunk, exact_growth)
+    return QuantizedSinkWindowCache(
+        rotary_emb, capacity, evict_chunk, kv_dtype, exact_growth
+    )
+
+
+# benchmark: python sink_cache.py [context_tokens] [new_tokens]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    context = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    new_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    torch.manual_seed(0)
+    # a scaled down stage-1 LLaMA (same head_dim and GQA layout), bf16 on cpu
+    config = LlamaConfig(
+        vocab_size=83734,
+        hidden_size=512,
+        intermediate_size=1408,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=16384,
+        attn_implementation="sdpa",
+    )
+    model = LlamaForCausalLM(config).to(torch.bfloat16).eval()
+    prompt = torch.randint(0, config.vocab_size, (1, context))
+
+    reference = None
+    for kv_dtype in KV_DTYPES:
+        cache = build_sink_cache(model.model.rotary_emb, 16383, kv_dtype=kv_dtype)
+        cache.reserve(context + new_tokens + 1)
+        with torch.no_grad():
+            out = model(input_ids=prompt, past_key_values=cache, num_logits_to_keep=1)
+            # same next token for every cache, to compare the logits it produces
+            token = prompt[:, -1:]
+            out = model(input_ids=token, past_key_values=cache, use_cache=True)
+            logits = out.logits[0, -1].float()
+            t0 = time.perf_counter()
+            for _ in range(new_tokens):
+                out = model(input_ids=token, past_key_values=cache, use_cache=True)
+                token = out.logits[:, -1:].argmax(-1)
+            elapsed = time.perf_counter() - t0
+        if reference is None:
+            reference = logits
+        err = (logits - reference).abs().max() / reference.abs().max()
+        print(
+            f"{kv_dtype:5s} cache {cache.nbytes() / 2**20:7.1f} MiB "
+            f"{new_tokens / elapsed:7.1f} tok/s at {context} tokens, "
+            f"max relative logit error vs bf16 {err.item():.4f}"
+        )
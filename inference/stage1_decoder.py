@@ -0,0 +1,424 @@
+import copy
+import re
+
+import torch
+from transformers import LogitsProcessorList
+
+from sink_cache import build_sink_cache
+
+# stage-1 emits 50 codec frames/s for each of the two interleaved tracks
+TOKENS_PER_SECOND = 100
+# shortest plausible length (seconds) of a section by its tag; lyric-free
+# sections are not bounded by their word count
+_MIN_SECONDS = (
+    ("intro", 12),
+    ("outro", 12),
+    ("inst", 15),
+    ("break", 10),
+    ("bridge", 10),
+)
+_DEFAULT_MIN_SECONDS = 8
+_SECONDS_PER_WORD = 0.6
+
+
+def segment_token_budget(section_text, max_new_tokens, margin=1.5):
+    """
+    Expected number of stage-1 tokens for one lyric segment ("[verse]\n..."),
+    from its word count and section type, with `margin` of headroom and
+    clamped to [100, max_new_tokens]. Only used to size buffers: a segment
+    that runs longer still gets up to max_new_tokens.
+    """
+    tag = re.match(r"\s*\[([^\]]*)\]", section_text)
+    tag = tag.group(1).lower() if tag else ""
+    body = re.sub(r"\[[^\]]*\]", " ", section_text)
+    seconds = len(body.split()) * _SECONDS_PER_WORD
+    floor = next((s for name, s in _MIN_SECONDS if name in tag), _DEFAULT_MIN_SECONDS)
+    budget = int(max(seconds, floor) * TOKENS_PER_SECOND * margin)
+    return max(100, min(budget, max_new_tokens))
+
+
+class _TokenBuffer(object):
+    """A (1, n) token sequence appended in place into a preallocated row."""
+
+    def __init__(self, size, device):
+        self.data = torch.empty((1, size), dtype=torch.long, device=device)
+        self.length = 0
+
+    def append(self, ids):
+        n = ids.shape[1]
+        if self.length + n > self.data.shape[1]:
+            grown = torch.empty(
+                (1, max(self.length + n, 2 * self.data.shape[1])),
+                dtype=self.data.dtype,
+                device=self.data.device,
+            )
+            grown[:, : self.length] = self.data[:, : self.length]
+            self.data = grown
+        self.data[:, self.length : self.length + n] = ids
+        self.length += n
+
+    def drop(self, start, n):
+        """Remove tokens [start, start + n)."""
+        self.data[:, start : self.length - n] = self.data[
+            :, start + n : self.length
+        ].clone()
+        self.length -= n
+
+    def view(self):
+        return self.data[:, : self.length]
+
+
+class Stage1Decoder(object):
+    """
+    Stage-1 sampling over one KV cache that lives for the whole song.
+
+    `model.generate` is called once per lyric segment on the full token stream,
+    so every segment prefills everything generated so far again, and once the
+    stream outgrows the context the caller has to cut it down to the last
+    tokens, losing the instruction block. Here each call only feeds the tokens
+    the cache has not seen yet; the cache is a SinkWindowCache that keeps the
+    instruction/reference block (`n_sink` tokens) and a rolling window of recent
+    tokens.
+
+    Logits processors come from the model's own `_get_logits_processor` with the
+    same generation kwargs, so CFG, repetition penalty, min_new_tokens and the
+    sampling warpers behave as in `model.generate`.
+
+    kv_dtype: "auto" keeps the cache in the model dtype, "int8" / "fp8" store it
+    quantized with per-head scales (QuantizedSinkWindowCache).
+
+    Each `generate` call reserves cache room for the tokens already held, the
+    new prompt and `token_budget` (see segment_token_budget), so a segment
+    normally decodes without reallocating anything. preallocate=False grows
+    the cache token by token instead, as DynamicCache does; `churn()` reports
+    what the cache allocated either way.
+
+    fused_cfg: classifier-free guidance as in `model.generate`, whose
+    unconditional branch is the last prompt token plus the tokens sampled so
+    far, run as a separate forward over its own cache. Here both branches go
+    through one batch-2 forward over one cache: the unconditional row sits
+    under the tail of the conditional one (the shared token inputs of this
+    segment), its slots before the segment are masked out, and it keeps its
+    own positions 0, 1, ... `cfg_tokens` > 0 switches guidance off after that
+    many tokens of a segment, from then on only the conditional row is run.
+    """
+
+    def __init__(
+        self,
+        model,
+        capacity=16383,
+        evict_chunk=1024,
+        prefill_chunk=4096,
+        kv_dtype="auto",
+        preallocate=True,
+        fused_cfg=False,
+        cfg_tokens=0,
+    ):
+        self.model = model
+        self.capacity = capacity
+        self.prefill_chunk = prefill_chunk
+        self.preallocate = preallocate
+        self.cache = build_sink_cache(
+            model.model.rotary_emb,
+            capacity,
+            evict_chunk,
+            kv_dtype,
+            exact_growth=not preallocate,
+        )
+        # tokens currently held by the cache
+        self.context_ids = _TokenBuffer(capacity, model.device)
+        self.fed = 0  # tokens of the stream consumed so far
+        self.fused_cfg = fused_cfg
+        self.cfg_tokens = cfg_tokens
+        if fused_cfg:
+            # row 0 conditional, row 1 unconditional
+            self.cache.batch = 2
+            self.cache.rotated_rows = 1
+            self._pair_mask = torch.ones(
+                (2, capacity), dtype=torch.long, device=model.device
+            )
+            self.uncond_start = 0  # first cache slot of the unconditional row
+            self.uncond_pos = 0  # its next position
+
+    def churn(self):
+        """Cache allocations so far: {"allocations", "allocated_mb", "resident_mb"}."""
+        return {
+            "allocations": self.cache.allocations,
+            "allocated_mb": self.cache.allocated_bytes / 2**20,
+            "resident_mb": self.cache.nbytes() / 2**20,
+        }
+
+    def _forward(self, ids):
+        """Feed ids into the cache; returns the logits of the last one."""
+        for start in range(0, ids.shape[1], self.prefill_chunk):
+            part = ids[:, start : start + self.prefill_chunk]
+            dropped = self.cache.make_room(part.shape[1])
+            if dropped:
+                self.context_ids.drop(self.cache.n_sink, dropped)
+            past = self.cache.get_seq_length()
+            out = self.model(
+                input_ids=part,
+                past_key_values=self.cache,
+                use_cache=True,
+                cache_position=torch.arange(
+                    past, past + part.shape[1], device=part.device
+                ),
+                num_logits_to_keep=1,
+            )
+            self.context_ids.append(part)
+        return out.logits[:, -1, :]
+
+    def _forward_pair(self, token):
+        """
+        Feed one (1, 1) token to both CFG rows; returns the (2, vocab) logits
+        of the conditional and the unconditional row.
+        """
+        dropped = self.cache.make_room(1)
+        if dropped:
+            self.context_ids.drop(self.cache.n_sink, dropped)
+            self.uncond_start = max(self.cache.n_sink, self.uncond_start - dropped)
+            self._pair_mask[1].fill_(1)
+            self._pair_mask[1, : self.uncond_start] = 0
+        past = self.cache.get_seq_length()
+        out = self.model(
+            input_ids=token.expand(2, 1),
+            attention_mask=self._pair_mask[:, : past + 1],
+            position_ids=torch.tensor([[past], [self.uncond_pos]], device=token.device),
+            past_key_values=self.cache,
+            use_cache=True,
+            cache_position=torch.arange(past, past + 1, device=token.device),
+            num_logits_to_keep=1,
+        )
+        self.context_ids.append(token)
+        self.uncond_pos += 1
+        return out.logits[:, -1, :]
+
+    def _start_uncond(self):
+        """The next fed token starts a new unconditional row."""
+        self.uncond_start = self.cache.get_seq_length()
+        self.uncond_pos = 0
+        self._pair_mask[1].fill_(1)
+        self._pair_mask[1, : self.uncond_start] = 0
+
+    def generate(
+        self,
+        stream,
+        n_sink,
+        logits_processor=None,
+        token_budget=None,
+        sampler=None,
+        **generation_kwargs,
+    ):
+        """
+        stream: (1, L) every token of the song so far, ending with the prompt of
+        the next segment. n_sink: length of the instruction/reference block.
+        token_budget: expected number of new tokens, defaults to max_new_tokens.
+        sampler: a RestrictedSampler that replaces the logits processors; its
+        guidance needs fused_cfg.
+        Returns the (1, n) newly sampled tokens.
+        """
+        if sampler is not None:
+            if logits_processor:
+                raise ValueError("a sampler replaces the logits processors")
+            if sampler.guidance_scale is not None and not self.fused_cfg:
+                raise ValueError("a sampler with guidance_scale needs fused_cfg")
+        if self.fed == 0:
+            self.cache.n_sink = n_sink
+            tail = self.capacity - n_sink - self.cache.evict_chunk
+            if tail <= 0:
+                raise ValueError(
+                    f"a cache of {self.capacity} can not hold {n_sink} sink tokens"
+                )
+            if stream.shape[1] > n_sink + tail:
+                # resuming a long stream: the middle would be evicted right away
+                new = torch.cat([stream[:, :n_sink], stream[:, -tail:]], dim=1)
+            else:
+                new = stream
+        else:
+            new = stream[:, self.fed :]
+        self.fed = stream.shape[1]
+        generation_config = copy.deepcopy(self.model.generation_config)
+        generation_config.update(**generation_kwargs)
+        max_new_tokens = generation_config.max_new_tokens
+        budget = min(token_budget or max_new_tokens, max_new_tokens)
+        self.cache.reserve(self.cache.get_seq_length() + new.shape[1] + budget)
+        guidance_scale = None
+        if self.fused_cfg and generation_config.guidance_scale not in (None, 1):
+            # applied below instead of by the unbatched HF processor
+            guidance_scale = generation_config.guidance_scale
+            generation_config.guidance_scale = None
+        with torch.no_grad():
+            if guidance_scale is None:
+                logits = self._forward(new)
+            else:
+                if new.shape[1] > 1:
+                    self._forward(new[:, :-1])
+                # the unconditional branch starts from the last prompt token
+                self._start_uncond()
+                logits = self._forward_pair(new[:, -1:])
+
+            self.model._prepare_special_tokens(generation_config, True, stream.device)
+            # processors see the context plus everything sampled in this call,
+            # even if part of the context is evicted meanwhile
+            input_ids = _TokenBuffer(self.context_ids.length + budget, stream.device)
+            input_ids.append(self.context_ids.view())
+            if sampler is None:
+                processors = self.model._get_logits_processor(
+                    generation_config=generation_config,
+                    input_ids_seq_length=input_ids.length,
+                    encoder_input_ids=input_ids.view(),
+                    prefix_allowed_tokens_fn=None,
+                    logits_processor=logits_processor or LogitsProcessorList(),
+                    device=stream.device,
+                    model_kwargs={},
+                )
+            eos_ids = set(generation_config._eos_token_tensor.flatten().tolist())
+
+            new_tokens = 0
+            for step in range(max_new_tokens):
+                if sampler is not None:
+                    next_token = sampler(input_ids.view(), logits)
+                else:
+                    scores = logits.float()
+                    if guidance_scale is not None:
+                        scores = torch.nn.functional.log_softmax(scores, dim=-1)
+                        if scores.shape[0] == 2:
+                            cond, uncond = scores[:1], scores[1:]
+                            scores = guidance_scale * (cond - uncond) + uncond
+                    scores = processors(input_ids.view(), scores)
+                    if generation_config.do_sample:
+                        probs = torch.nn.functional.softmax(scores, dim=-1)
+                        next_token = torch.multinomial(probs, num_samples=1)
+                    else:
+                        next_token = torch.argmax(scores, dim=-1, keepdim=True)
+                input_ids.append(next_token)
+                new_tokens += 1
+                if next_token.item() in eos_ids or step == max_new_tokens - 1:
+                    break
+                if guidance_scale is not None and (
+                    not self.cfg_tokens or step + 1 < self.cfg_tokens
+                ):
+                    logits = self._forward_pair(next_token)
+                else:
+                    logits = self._forward(next_token)
+        # the last token is fed together with the next segment's prompt
+        self.fed += new_tokens - 1
+        return input_ids.view()[:, -new_tokens:].clone()
+
+
+# benchmarks:
+#   python stage1_decoder.py churn [segments] [tokens_per_segment]
+#   python stage1_decoder.py cfg [context_tokens] [new_tokens] [cfg_tokens]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from transformers import LlamaConfig, LlamaForCausalLM, LogitsProcessor
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else "churn"
+    numbers = [int(a) for a in sys.argv[2:]]
+    eoa = 32002
+
+    class EndAfter(LogitsProcessor):
+        """Forces <EOA> after n tokens, as a segment that ends well before max_new_tokens."""
+
+        def __init__(self, start, n):
+            self.stop = start + n
+
+        def __call__(self, input_ids, scores):
+            if input_ids.shape[1] >= self.stop:
+                scores[:, :] = -float("inf")
+                scores[:, eoa] = 0
+            return scores
+
+    def churn(model, n_segments=4, segment_tokens=300):
+        head = torch.randint(0, 32000, (1, 200))
+        prompts = [torch.randint(0, 32000, (1, 20)) for _ in range(n_segments)]
+        section = "[verse]\n" + " ".join(["la"] * (segment_tokens // 100 * 2))
+        results = {}
+        for preallocate in (False, True):
+            torch.manual_seed(1)
+            decoder = Stage1Decoder(model, preallocate=preallocate)
+            stream = head
+            t0 = time.perf_counter()
+            for prompt in prompts:
+                stream = torch.cat([stream, prompt], dim=1)
+                new = decoder.generate(
+                    stream,
+                    n_sink=head.shape[1],
+                    logits_processor=LogitsProcessorList(
+                        [EndAfter(stream.shape[1], segment_tokens)]
+                    ),
+                    token_budget=segment_token_budget(section, 3000),
+                    max_new_tokens=3000,
+                    do_sample=True,
+                    top_k=None,
+                    eos_token_id=eoa,
+                    pad_token_id=eoa,
+                )
+                stream = torch.cat([stream, new], dim=1)
+            elapsed = time.perf_counter() - t0
+            results[preallocate] = stream
+            stats = decoder.churn()
+            print(
+                f"{'preallocated' if preallocate else 'token-by-token':14s} "
+                f"{stats['allocations']:6d} cache allocations "
+                f"{stats['allocated_mb']:9.1f} MiB allocated "
+                f"{stats['resident_mb']:6.1f} MiB resident "
+                f"{(stream.shape[1] - head.shape[1]) / elapsed:7.1f} tok/s"
+            )
+        print("same tokens:", torch.equal(results[False], results[True]))
+
+    def cfg(model, context=2000, new_tokens=300, cfg_tokens=100):
+        prompt = torch.randint(0, 32000, (1, context))
+        kwargs = dict(
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=True,
+            top_p=0.93,
+            repetition_penalty=1.1,
+            eos_token_id=eoa,
+            pad_token_id=eoa,
+            guidance_scale=1.5,
+        )
+        runs = [
+            ("model.generate", None),
+            ("unbatched CFG", dict()),
+            ("fused CFG", dict(fused_cfg=True)),
+            (
+                f"fused, CFG for {cfg_tokens}",
+                dict(fused_cfg=True, cfg_tokens=cfg_tokens),
+            ),
+        ]
+        results = {}
+        for name, options in runs:
+            torch.manual_seed(1)
+            t0 = time.perf_counter()
+            with torch.no_grad():
+                if options is None:
+                    out = model.generate(input_ids=prompt, **kwargs)[:, context:]
+                else:
+                    decoder = Stage1Decoder(model, **options)
+                    out = decoder.generate(prompt, n_sink=100, **kwargs)
+            elapsed = time.perf_counter() - t0
+            results[name] = out
+            same = torch.equal(out, results["model.generate"])
+            print(
+                f"{name:22s} {new_tokens / elapsed:7.1f} tok/s "
+                f"(incl. {context}-token prefill), "
+                f"same tokens as model.generate: {same}"
+            )
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=83734,
+        hidden_size=512 if mode == "cfg" else 256,
+        intermediate_size=1408 if mode == "cfg" else 704,
+        num_hidden_layers=4,
+        num_attention_heads=4 if mode == "cfg" else 2,
+        num_key_value_heads=4 if mode == "cfg" else 2,
+        max_position_embeddings=16384,
+        attn_implementation="sdpa",
+    )
+    model = LlamaForCausalLM(config).eval()
+    {"churn": churn, "cfg": cfg}[mode](model, *numbers)
@@ -0,0 +1,253 @@
+import time
+
+import torch
+from torch import nn
+from transformers import StaticCache
+
+# stage 2 writes codebooks 1-7 of every frame; the ids of codebooks 1-7
+STAGE2_VOCAB = (46358, 53526)
+FRAME_TOKENS = 8
+
+
+class Stage2Decoder(object):
+    """
+    The teacher-forced stage-2 loop of infer.py (stage2_generate) over a
+    static KV cache.
+
+    stage2_generate calls model.generate once per codebook-0 frame on the
+    whole prompt so far: the sequence grows by 8 tokens per call and each
+    call prefills it again. Here the prompt [soa, stage_1, codebook-0 ids,
+    stage_2] is prefilled once into a StaticCache sized for `frames` frames
+    and `batch_size` rows. Then every token, teacher-forced codebook-0 ids
+    and the 7 greedy ids of codebooks 1-7 alike, goes through one
+    single-token step. That step always sees the same shapes: with
+    compile=True it is compiled once (no dynamic shapes, cuda graphs when the
+    model is resident on the gpu) and replayed for every token of every chunk. Smaller
+    batches are padded to `batch_size` with copies of their last row. The
+    output projection of a resident model only computes the codebook 1-7
+    rows of the vocabulary, in float32; an offloaded model (mmgp) goes
+    through its lm_head, which mmgp places at forward time.
+
+    The ids are not bit-identical to stage2_generate's outside float32: the
+    static cache and the single-token steps reduce in another order than
+    re-prefilling, and in bf16 that flips argmaxes between near-tied ids.
+
+    Decoding is greedy over the codebook 1-7 ids, which is what the block
+    processors of stage2_generate leave; models whose generation config
+    samples are rejected.
+    """
+
+    def __init__(self, model, batch_size, frames=300, compile=False, device=None):
+        if model.generation_config.do_sample:
+            raise ValueError("Stage2Decoder decodes greedily, the model config samples")
+        self.model = model
+        self.batch_size = batch_size
+        self.frames = frames
+        self.device = torch.device(device) if device is not None else model.device
+        # [soa, stage_1] + codebook 0 + [stage_2], then 8 tokens per frame
+        self.cache = StaticCache(
+            config=model.config,
+            max_batch_size=batch_size,
+            max_cache_len=frames + 3 + frames * FRAME_TOKENS,
+            device=self.device,
+            dtype=model.dtype,
+        )
+        # offloaded models (mmgp) have their weights moved at forward time
+        resident = all(p.device == self.device for p in model.parameters())
+        lm_head = model.get_output_embeddings()
+        if resident and isinstance(lm_head, nn.Linear) and lm_head.bias is None:
+            # only the codebook 1-7 rows of the output projection, in float32
+            # so that bf16 rounding does not tie the logits it compares
+            self.head_weight = lm_head.weight[STAGE2_VOCAB[0] : STAGE2_VOCAB[1]].float()
+        else:
+            self.head_weight = None
+        self.step = self._step
+        if compile:
+            # cuda graphs replay fixed weight addresses, not for offloaded models
+            self.step = torch.compile(
+                self._step,
+                dynamic=False,
+                mode=(
+                    "reduce-overhead"
+                    if self.device.type == "cuda" and resident
+                    else None
+                ),
+            )
+        # seconds of each generate call, the first one includes compilation
+        self.timings = []
+
+    def _step(self, ids, position):
+        """(B, 1) ids at cache position (1,) -> (B, 1) greedy codebook 1-7 ids."""
+        hidden = self.model.get_decoder()(
+            input_ids=ids,
+            position_ids=position.expand(ids.shape[0], 1),
+            cache_position=position,
+            past_key_values=self.cache,
+            use_cache=True,
+        ).last_hidden_state[:, -1]
+        if self.head_weight is not None:
+            logits = nn.functional.linear(hidden.float(), self.head_weight)
+        else:
+            lm_head = self.model.get_output_embeddings()
+            logits = lm_head(hidden)[:, STAGE2_VOCAB[0] : STAGE2_VOCAB[1]]
+        return logits.argmax(dim=-1, keepdim=True) + STAGE2_VOCAB[0]
+
+    def generate(self, head, codec_ids, tail):
+        """
+        head: (2,) / tail: (1,) prompt ids around codec_ids, (B, T) offset
+        codebook-0 ids with B <= batch_size and T <= frames.
+        Returns the (B, T * 8) ids stage2_generate appends after the prompt.
+        """
+        rows, frames = codec_ids.shape
+        if rows > self.batch_size or frames > self.frames:
+            raise ValueError(
+                f"({rows}, {frames}) codes exceed the decoder's "
+                f"({self.batch_size}, {self.frames})"
+            )
+        t0 = time.perf_counter()
+        if rows < self.batch_size:
+            pad = codec_ids[-1:].expand(self.batch_size - rows, -1)
+            codec_ids = torch.cat([codec_ids, pad])
+        batch = self.batch_size
+        prompt = torch.cat(
+            [head.expand(batch, -1), codec_ids, tail.expand(batch, -1)], dim=1
+        )
+        output = torch.empty(
+            (batch, frames * FRAME_TOKENS), dtype=torch.long, device=self.device
+        )
+        self.cache.reset()
+        with torch.no_grad():
+            self.model.get_decoder()(
+                input_ids=prompt,
+                cache_position=torch.arange(prompt.shape[1], device=self.device),
+                past_key_values=self.cache,
+                use_cache=True,
+            )
+            position = prompt.shape[1]
+            for frame in range(frames):
+                ids = codec_ids[:, frame : frame + 1]
+                for k in range(FRAME_TOKENS):
+                    output[:, frame * FRAME_TOKENS + k] = ids[:, 0]
+                    if frame == frames - 1 and k == FRAME_TOKENS - 1:
+                        break
+                    cache_position = torch.tensor([position], device=self.device)
+                    # clone: cuda graph outputs are overwritten by the next replay
+                    next_ids = self.step(ids, cache_position).clone()
+                    position += 1
+                    if k < FRAME_TOKENS - 1:
+                        ids = next_ids
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.timings.append(time.perf_counter() - t0)
+        return output[:rows]
+
+
+# benchmark: python stage2_decoder.py [frames] [batch] [dtype]
+# one stage-2 chunk of a scaled down stage-2 LLM: model.generate loop, static
+# cache decoder, compiled decoder in a process with an empty compilation cache
+# (startup = first chunk, steady state = the chunks after it) and in a second
+# process reusing that cache
+if __name__ == "__main__":
+    import json
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+    import warnings
+
+    from transformers import LogitsProcessor, LogitsProcessorList
+
+    from backend import Backend, enable_compile_cache, scaled_down_models
+
+    warnings.filterwarnings("ignore")
+
+    def run_compiled(frames, batch, dtype, cache):
+        enable_compile_cache(cache)
+        backend = Backend("cpu", dtype=dtype)
+        torch.manual_seed(0)
+        model = scaled_down_models(backend)[1]
+        codes = torch.randint(45334, 46358, (batch, frames))
+        decoder = Stage2Decoder(model, batch, frames, compile=True)
+        outputs = [
+            decoder.generate(torch.tensor([32001, 32016]), codes, torch.tensor([32017]))
+            for _ in range(3)
+        ]
+        return {
+            "timings": decoder.timings,
+            "output": outputs[-1].tolist(),
+        }
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        _, _, frames, batch, dtype, cache = sys.argv
+        print(json.dumps(run_compiled(int(frames), int(batch), dtype, cache)))
+        sys.exit(0)
+
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    dtype = sys.argv[3] if len(sys.argv) > 3 else "bfloat16"
+    backend = Backend("cpu", dtype=dtype)
+    torch.manual_seed(0)
+    model = scaled_down_models(backend)[1]
+    codes = torch.randint(45334, 46358, (batch, frames))
+    head, tail = torch.tensor([32001, 32016]), torch.tensor([32017])
+
+    class Block(LogitsProcessor):
+        def __init__(self, start, end):
+            self.start, self.end = start, end
+
+        def __call__(self, input_ids, scores):
+            scores[:, : self.start] = -float("inf")
+            scores[:, self.end :] = -float("inf")
+            return scores
+
+    t0 = time.perf_counter()
+    prompt = torch.cat([head.expand(batch, -1), codes, tail.expand(batch, -1)], 1)
+    length = prompt.shape[1]
+    with torch.no_grad():
+        for frame in range(frames):
+            prompt = torch.cat([prompt, codes[:, frame : frame + 1]], dim=1)
+            prompt = model.generate(
+                input_ids=prompt,
+                min_new_tokens=7,
+                max_new_tokens=7,
+                eos_token_id=32002,
+                pad_token_id=32002,
+                logits_processor=LogitsProcessorList([Block(*STAGE2_VOCAB)]),
+            )
+    stock = prompt[:, length:]
+    stock_s = time.perf_counter() - t0
+    decoder = Stage2Decoder(model, batch, frames)
+    for _ in range(2):
+        eager = decoder.generate(head, codes, tail)
+    tokens = batch * frames * FRAME_TOKENS
+    print(f"chunk of {frames} frames x {batch} rows ({tokens} tokens), {dtype}")
+    print(f"model.generate loop     {stock_s:7.2f} s")
+    print(
+        f"static cache, eager     {decoder.timings[-1]:7.2f} s, "
+        f"ids equal to the loop's {(eager == stock).float().mean().item():.3f}"
+    )
+    cache = tempfile.mkdtemp()
+    try:
+        for label in ("compiled, cold cache", "compiled, warm cache"):
+            out = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--child",
+                    str(frames),
+                    str(batch),
+                    dtype,
+                    cache,
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            run = json.loads(out.strip().splitlines()[-1])
+            print(
+                f"{label:23s} startup {run['timings'][0]:7.2f} s, steady state "
+                f"{sum(run['timings'][1:]) / 2:7.2f} s, ids equal to eager "
+                f"{(torch.tensor(run['output']) == eager).float().mean().item():.3f}"
+            )
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def _as_code_tensor(codes, device):
+    if isinstance(codes, np.ndarray):
+        codes = torch.from_numpy(codes.astype(np.int64))
+    return codes.to(device=device, dtype=torch.long)
+
+
+def _stack_codes(codes_list, device):
+    """
+    codes_list: list of (K, T) arrays/tensors -> (K, B, T) long tensor,
+    which is the layout expected by the xcodec quantizer.
+    """
+    return torch.stack([_as_code_tensor(c, device) for c in codes_list], dim=1)
+
+
+def _same_shape(codes_list):
+    return all(tuple(c.shape) == tuple(codes_list[0].shape) for c in codes_list)
+
+
+def _pad_codes(codes_list, device, bucket_frames):
+    """
+    Extend (K, T) codes to a multiple of bucket_frames by repeating the last
+    frame, so compiled decoders see a handful of static lengths instead of
+    one per song. Returns the padded codes and the original lengths.
+    """
+    lengths = [c.shape[-1] for c in codes_list]
+    if not bucket_frames:
+        return codes_list, lengths
+    padded = []
+    for codes in codes_list:
+        codes = _as_code_tensor(codes, device)
+        extra = -codes.shape[-1] % bucket_frames
+        padded.append(torch.cat([codes, codes[:, -1:].expand(-1, extra)], dim=1))
+    return padded, lengths
+
+
+def _trim(wave, frames, padded_frames):
+    """Keep the samples of the first `frames` of a decoded (1, N) wave."""
+    if frames == padded_frames:
+        return wave
+    return wave[..., : wave.shape[-1] // padded_frames * frames]
+
+
+def reconstruct_stems(codec_model, codes_list, device, bucket_frames=0):
+    """
+    Decode stage-2 codes with xcodec at 16 kHz.
+    Stems with the same length are decoded as one batch. bucket_frames > 0
+    pads the codes to a multiple of that many frames for compiled decoders
+    (see _pad_codes); the padding is cut off the waves again.
+    Returns a list of (1, N) float tensors on cpu.
+    """
+    codes_list, lengths = _pad_codes(codes_list, device, bucket_frames)
+    with torch.no_grad():
+        if _same_shape(codes_list):
+            out = codec_model.decode(_stack_codes(codes_list, device))
+            waves = [w.cpu().reshape(1, -1) for w in out]
+        else:
+            waves = [
+                codec_model.decode(_stack_codes([c], device))[0].cpu().reshape(1, -1)
+                for c in codes_list
+            ]
+    return [_trim(w, n, c.shape[-1]) for w, n, c in zip(waves, lengths, codes_list)]
+
+
+def codes_to_embeddings(codec_model, codes_list, device):
+    """
+    Look up the quantizer embeddings the vocos decoders are conditioned on.
+    Returns a list of (1, D, T) tensors on `device`.
+    """
+    with torch.no_grad():
+        if _same_shape(codes_list):
+            embed = codec_model.get_embed(_stack_codes(codes_list, device))
+            return [e.unsqueeze(0) for e in embed]
+        return [codec_model.get_embed(_stack_codes([c], device)) for c in codes_list]
+
+
+def _run_decoder(decoder, embed, device):
+    if device.type == "cuda":
+        stream = torch.cuda.Stream(device=device)
+        # the embeddings were produced on the default stream
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream), torch.no_grad():
+            out = decoder(embed)
+        stream.synchronize()
+    else:
+        with torch.no_grad():
+            out = decoder(embed)
+    return out.detach().float().cpu().reshape(1, -1)
+
+
+def decode_stems(
+    codec_model, decoders, codes_list, device, concurrent=True, bucket_frames=0
+):
+    """
+    Upsample stage-2 codes to 44.1 kHz waveforms with the vocos decoders.
+
+    decoders: one decoder per entry of codes_list (vocal / instrumental)
+    bucket_frames: as for reconstruct_stems
+    Returns a list of (1, N) float tensors on cpu, aligned with codes_list.
+
+    On cuda the decoders run on separate streams from a small thread pool so the
+    vocal and instrumental decoders overlap; on cpu they run one after another
+    because each decoder already uses every intra-op thread.
+    """
+    device = torch.device(device)
+    codes_list, lengths = _pad_codes(codes_list, device, bucket_frames)
+    embeds = codes_to_embeddings(codec_model, codes_list, device)
+    for decoder in decoders:
+        decoder.eval()
+        decoder.to(device)
+
+    if concurrent and device.type == "cuda" and len(decoders) > 1:
+        with ThreadPoolExecutor(max_workers=len(decoders)) as pool:
+            futures = [
+                pool.submit(_run_decoder, decoder, embed, device)
+                for decoder, embed in zip(decoders, embeds)
+            ]
+            waves = [f.result() for f in futures]
+    else:
+        waves = [
+            _run_decoder(decoder, embed, device)
+            for decoder, embed in zip(decoders, embeds)
+        ]
+    return [_trim(w, n, c.shape[-1]) for w, n, c in zip(waves, lengths, codes_list)]
+
+
+def mix_stems(stems):
+    """Sum equally sized (1, N) stems; trims to the shortest one if they differ."""
+    length = min(s.shape[-1] for s in stems)
+    mix = stems[0][..., :length].clone()
+    for s in stems[1:]:
+        mix += s[..., :length]
+    return mix
@@ -0,0 +1,550 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import shutil
+import struct
+import tempfile
+import warnings
+
+import torch
+from torch import nn
+
+from job_artifact import JobArtifact, save_job
+from quantize import empty_linear, linear_config, quantize_model, QUANTIZED_LINEARS
+
+SNAPSHOT_FORMAT = 1
+# quantization modes whose modules can be snapshotted; int8-dynamic keeps its
+# weights in opaque packed params
+SNAPSHOT_MODES = ("int8", "int4")
+HEADER = "model.json"
+_SOURCE_SUFFIXES = (".json", ".safetensors", ".bin", ".model")
+
+
+def _model_dir(model_path):
+    if os.path.isdir(model_path):
+        return model_path
+    from huggingface_hub import snapshot_download
+    from huggingface_hub.utils import LocalEntryNotFoundError
+
+    try:
+        return snapshot_download(model_path, local_files_only=True)
+    except LocalEntryNotFoundError:
+        return snapshot_download(
+            model_path, allow_patterns=[f"*{s}" for s in _SOURCE_SUFFIXES]
+        )
+
+
+def source_fingerprint(model_path):
+    """
+    sha256 identifying the weights and config of a checkpoint, without reading
+    the weights: hub downloads are symlinks to blobs named by their content
+    hash, local files count by name, size and mtime. json files are hashed.
+    """
+    folder = _model_dir(model_path)
+    h = hashlib.sha256()
+    for root, _, names in sorted(os.walk(folder)):
+        for name in sorted(names):
+            if not name.endswith(_SOURCE_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            target = os.path.realpath(path)
+            if name.endswith(".json"):
+                with open(path, "rb") as f:
+                    identity = hashlib.sha256(f.read()).hexdigest()
+            elif os.path.basename(target) != name:
+                identity = os.path.basename(target)
+            else:
+                st = os.stat(path)
+                identity = f"{st.st_size}:{st.st_mtime_ns}"
+            h.update(f"{os.path.relpath(path, folder)}={identity}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _version(distribution):
+    try:
+        return importlib.metadata.version(distribution)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def snapshot_key(model_path, mode, group_size, dtype, packages=()):
+    """
+    Cache key of a quantized snapshot: source checkpoint and quantization
+    config. The torch version is part of it because the int4 layout is the one
+    of its cpu kernel; `packages` names the distributions whose versions
+    define the layout of the other snapshots (bitsandbytes, mmgp).
+    """
+    payload = {
+        "format": SNAPSHOT_FORMAT,
+        "source": source_fingerprint(model_path),
+        "quantize": mode,
+        "group_size": group_size if mode == "int4" else None,
+        "dtype": str(dtype).replace("torch.", ""),
+        "torch": torch.__version__.split("+")[0],
+    }
+    if packages:
+        payload["packages"] = {name: _version(name) for name in packages}
+    blob = json.dumps(payload, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _as_storable(tensor):
+    # numpy has no bfloat16, the bits travel as int16
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        return tensor.view(torch.int16)
+    return tensor
+
+
+def save_snapshot(model, folder, shard_bytes=2 << 30):
+    """
+    Write every parameter and buffer of a (quantized) causal LM into
+    `folder` as uncompressed job artifacts of about shard_bytes each, plus a
+    json header with the config, the quantized modules and the tensor index.
+    Returns {file name: path}.
+    """
+    os.makedirs(folder, exist_ok=True)
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "config": model.config.to_dict(),
+        "attn_implementation": model.config._attn_implementation,
+        "generation_config": model.generation_config.to_dict(),
+        "modules": {
+            name: linear_config(module)
+            for name, module in model.named_modules()
+            if type(module).__name__ in QUANTIZED_LINEARS
+        },
+        "tensors": {},
+        "aliases": {},
+    }
+    first_name = {}
+    shards = [{}]
+    shard_size = 0
+    named = [(n, t, True) for n, t in model.named_parameters(remove_duplicate=False)]
+    named += [(n, t, False) for n, t in model.named_buffers(remove_duplicate=False)]
+    for name, tensor, parameter in named:
+        if tensor is None:
+            continue
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if key in first_name:
+            # tied weights are stored once
+            header["aliases"][name] = first_name[key]
+            continue
+        first_name[key] = name
+        nbytes = tensor.numel() * tensor.element_size()
+        if shard_size and shard_size + nbytes > shard_bytes:
+            shards.append({})
+            shard_size = 0
+        shards[-1][name] = _as_storable(tensor)
+        shard_size += nbytes
+        header["tensors"][name] = {
+            "shard": len(shards) - 1,
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "parameter": parameter,
+        }
+    files = {}
+    for i, arrays in enumerate(shards):
+        name = f"shard-{i:05d}.yuejob"
+        files[name] = save_job(os.path.join(folder, name), arrays)
+    files[HEADER] = os.path.join(folder, HEADER)
+    with open(files[HEADER], "w", encoding="utf-8") as f:
+        json.dump(header, f)
+    return files
+
+
+def _assign(model, name, tensor, parameter):
+    prefix, _, leaf = name.rpartition(".")
+    module = model.get_submodule(prefix)
+    if parameter:
+        module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[leaf] = tensor
+
+
+def load_snapshot(files, attn_implementation=None):
+    """
+    Rebuild a model written by `save_snapshot` from {file name: path}, with
+    the attention implementation it was saved with unless one is given.
+
+    The model is created on the meta device and every tensor is a read-only
+    view into the memory-mapped shards: loading reads the header only, pages
+    are faulted in from the page cache when a forward first touches them, and
+    processes mapping the same snapshot share them.
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+    with open(files[HEADER], "r", encoding="utf-8") as f:
+        header = json.load(f)
+    config = dict(header["config"])
+    model_type = config.pop("model_type")
+    config = AutoConfig.for_model(model_type, **config)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(
+            config,
+            torch_dtype=config.torch_dtype,
+            attn_implementation=attn_implementation or header["attn_implementation"],
+        )
+    for name, (kind, module_config) in header["modules"].items():
+        prefix, _, leaf = name.rpartition(".")
+        setattr(model.get_submodule(prefix), leaf, empty_linear(kind, module_config))
+
+    artifacts = {}
+    try:
+        with warnings.catch_warnings():
+            # tensors over a read-only map; nothing writes to weights
+            warnings.filterwarnings("ignore", message=".*not writable.*")
+            for name, entry in header["tensors"].items():
+                shard = f"shard-{entry['shard']:05d}.yuejob"
+                if shard not in artifacts:
+                    artifacts[shard] = JobArtifact(files[shard])
+                tensor = torch.from_numpy(artifacts[shard][name])
+                dtype = getattr(torch, entry["dtype"])
+                if tensor.dtype != dtype:
+                    tensor = tensor.view(dtype)
+                _assign(model, name, tensor, entry["parameter"])
+    finally:
+        # the maps stay alive as long as the tensors viewing them
+        for artifact in artifacts.values():
+            artifact.close()
+    for name, target in header["aliases"].items():
+        prefix, _, leaf = target.rpartition(".")
+        module = model.get_submodule(prefix)
+        tensor = module._parameters.get(leaf, module._buffers.get(leaf))
+        _assign(model, name, tensor.data, leaf in module._parameters)
+    left = [n for n, t in model.state_dict().items() if t.device.type == "meta"]
+    if left:
+        raise ValueError(f"snapshot {files[HEADER]} misses {left[:5]}")
+    model.generation_config = GenerationConfig.from_dict(header["generation_config"])
+    # lets serving.py hand the files, not the tensors, to worker processes
+    model.snapshot_files = dict(files)
+    return model.eval()
+
+
+_SAFETENSORS_DTYPES = {
+    "BF16": torch.bfloat16,
+    "F16": torch.float16,
+    "F32": torch.float32,
+    "F64": torch.float64,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def _safetensors_views(path):
+    """{name: read-only tensor} viewing a memory-mapped .safetensors file."""
+    import numpy as np
+
+    with open(path, "rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=8 + length)
+    views = {}
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message=".*not writable.*")
+        for name, entry in header.items():
+            if name == "__metadata__":
+                continue
+            start, end = entry["data_offsets"]
+            tensor = torch.from_numpy(data[start:end])
+            views[name] = tensor.view(_SAFETENSORS_DTYPES[entry["dtype"]]).reshape(
+                entry["shape"]
+            )
+    return views
+
+
+def _rebuild_computed_buffers(model, config):
+    # buffers computed at construction (rotary frequencies) are not stored, a
+    # model built on the meta device gets those modules built again
+    for name, module in list(model.named_modules()):
+        meta = [b for b in module._buffers.values() if b is not None and b.is_meta]
+        if meta and not module._parameters:
+            prefix, _, leaf = name.rpartition(".")
+            setattr(model.get_submodule(prefix), leaf, type(module)(config=config))
+
+
+def map_checkpoint(model_path, dtype, attn_implementation="sdpa"):
+    """
+    A causal LM whose weights are read-only views into the memory-mapped
+    .safetensors files of a Hugging Face checkpoint, as load_snapshot does
+    for snapshots: nothing is read until a forward touches it, and a host
+    short of RAM pages weights in and out of the page cache instead of
+    holding the model. Tensors stored in another dtype than `dtype` stay so
+    in the decoder blocks (layer_stream.py converts them as it fetches them)
+    and are converted everywhere else.
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+    folder = _model_dir(model_path)
+    config = AutoConfig.from_pretrained(folder)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(
+            config, torch_dtype=dtype, attn_implementation=attn_implementation
+        )
+    parameters = {n for n, _ in model.named_parameters(remove_duplicate=False)}
+    buffers = {n for n, _ in model.named_buffers(remove_duplicate=False)}
+    blocks = model.get_decoder().layers
+    block_prefix = [n for n, m in model.named_modules() if m is blocks][0] + "."
+    names = sorted(n for n in os.listdir(folder) if n.endswith(".safetensors"))
+    if not names:
+        raise ValueError(f"{model_path}: no .safetensors files to map")
+    for name in names:
+        for key, tensor in _safetensors_views(os.path.join(folder, name)).items():
+            if key not in parameters and key not in buffers:
+                continue
+            if tensor.is_floating_point() and tensor.dtype != dtype:
+                if not key.startswith(block_prefix):
+                    tensor = tensor.to(dtype)
+            _assign(model, key, tensor, key in parameters)
+    if getattr(config, "tie_word_embeddings", False):
+        model.tie_weights()
+    _rebuild_computed_buffers(model, config)
+    left = [n for n, t in model.state_dict().items() if t.device.type == "meta"]
+    if left:
+        raise ValueError(f"{model_path}: checkpoint misses {left[:5]}")
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(folder)
+    except OSError:
+        pass
+    model.mapped_files = [os.path.join(folder, name) for name in names]
+    return model.eval()
+
+
+def _entry_files(manifest):
+    return {
+        name: os.path.join(manifest["dir"], stored)
+        for name, stored in manifest["files"].items()
+    }
+
+
+def _store(cache, key, save, metadata):
+    """
+    Put the files save(folder) writes ({name: path}) into `cache` under `key`.
+    Returns the manifest of the entry, None when it was evicted right away
+    (cache smaller than the snapshot).
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=".snapshot-", dir=cache.root)
+    try:
+        # written for the cache only: renamed into the entry, not copied, and
+        # no other name links to them
+        cache.put(key, save(tmp_dir), metadata, move=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return cache.get(key)
+
+
+def quantized_model(cache, model_path, load, mode, group_size, dtype, **kwargs):
+    """
+    Quantized model of `model_path`, from its snapshot in `cache` (a
+    ResultCache) when one exists. Otherwise `load()` builds the full-precision
+    model, which is quantized and snapshotted, and the snapshot is mapped as on
+    later runs.
+
+    Returns (model, hit). kwargs go to load_snapshot.
+    """
+    key = snapshot_key(model_path, mode, group_size, dtype)
+    manifest = cache.get(key)
+    if manifest is not None:
+        return load_snapshot(_entry_files(manifest), **kwargs), True
+    model = quantize_model(load(), mode, group_size)
+    manifest = _store(
+        cache,
+        key,
+        lambda folder: save_snapshot(model, folder),
+        {"model": model_path, "quantize": mode},
+    )
+    if manifest is None:
+        return model, False
+    del model
+    # run from the map as later processes will, the quantized copy is dropped
+    return load_snapshot(_entry_files(manifest), **kwargs), False
+
+
+def bnb_int8_model(cache, model_path, load, dtype, **kwargs):
+    """
+    bitsandbytes int8 model of `model_path` (the int8 stage-1 load on cuda),
+    from its snapshot in `cache` when one exists. Otherwise `load()` loads and
+    quantizes it and save_pretrained writes the int8 weights and their scales
+    as the snapshot. A hit is a from_pretrained of those, with the
+    quantization config they were saved with: safetensors are memory-mapped
+    and go to the gpu as they are, nothing is quantized again.
+
+    Returns (model, hit). kwargs go to from_pretrained.
+    """
+    from transformers import AutoModelForCausalLM
+
+    key = snapshot_key(
+        model_path, "bnb-int8", None, dtype, packages=("bitsandbytes", "transformers")
+    )
+    if cache.get(key) is not None:
+        # from_pretrained wants the saved file names, links in a private
+        # folder that only this read sees carry them
+        folder = tempfile.mkdtemp(prefix=".snapshot-", dir=cache.root)
+        try:
+            if cache.restore(key, folder, link=True) is not None:
+                return AutoModelForCausalLM.from_pretrained(folder, **kwargs), True
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    model = load()
+
+    def save(folder):
+        model.save_pretrained(folder, safe_serialization=True)
+        return {name: os.path.join(folder, name) for name in os.listdir(folder)}
+
+    _store(cache, key, save, {"model": model_path, "quantize": "bnb-int8"})
+    return model, False
+
+
+MMGP_SNAPSHOT = "model.safetensors"
+
+
+def mmgp_quantized_model(cache, model_path, load, dtype, attn_implementation="sdpa"):
+    """
+    `model_path` quantized the way mmgp's offload profiles 3-5 quantize the
+    transformer (optimum-quanto qint8), from its snapshot in `cache` when one
+    exists. Otherwise `load()` loads the full-precision model, which mmgp
+    quantizes in place and writes with offload.save_model. A hit builds the
+    model on the meta device and offload.load_model_data maps the snapshot
+    into it, without reading the full-precision weights.
+
+    Either way the model carries mmgp's quantization map, so offload.profile
+    does not quantize it again. Returns (model, hit).
+    """
+    from mmgp import offload
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+    key = snapshot_key(
+        model_path, "mmgp-qint8", None, dtype, packages=("mmgp", "optimum-quanto")
+    )
+    path = cache.path(key, MMGP_SNAPSHOT)
+    if path is not None:
+        folder = _model_dir(model_path)
+        config = AutoConfig.from_pretrained(folder)
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(
+                config, torch_dtype=dtype, attn_implementation=attn_implementation
+            )
+        _rebuild_computed_buffers(model, config)
+        # requantizes the modules from the stored map, then assigns the
+        # tensors of the memory-mapped file
+        offload.load_model_data(model, path)
+        model.tie_weights()
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(folder)
+        except OSError:
+            pass
+        return model.eval(), True
+    model = load()
+
+    def save(folder):
+        path = os.path.join(folder, MMGP_SNAPSHOT)
+        # do_quantize quantizes the model in place before writing it
+        offload.save_model(model, path, do_quantize=True)
+        return {MMGP_SNAPSHOT: path}
+
+    _store(cache, key, save, {"model": model_path, "quantize": "mmgp-qint8"})
+    return model, False
+
+
+def _rss():
+    """(anonymous, file-backed) resident MiB of this process, Linux."""
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("RssAnon", "RssFile", "VmHWM")):
+                key, value = line.split(":")
+                values[key] = int(value.split()[0]) / 1024
+    return values
+
+
+# benchmark: python weight_snapshot.py [int8|int4] [layers]
+# cold start (load + quantize + snapshot) vs warm start (map the snapshot), and
+# peak memory of each, on a scaled down stage-1 LLM saved as a checkpoint
+if __name__ == "__main__":
+    import subprocess
+    import sys
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        # one load in a fresh process: prints seconds and memory as json
+        from transformers import AutoModelForCausalLM
+
+        from result_cache import ResultCache
+
+        _, _, checkpoint, cache_root, mode = sys.argv
+        t0 = time.perf_counter()
+        model, hit = quantized_model(
+            ResultCache(cache_root),
+            checkpoint,
+            lambda: AutoModelForCausalLM.from_pretrained(
+                checkpoint, torch_dtype=torch.bfloat16
+            ),
+            mode,
+            128,
+            torch.bfloat16,
+        )
+        load_s = time.perf_counter() - t0
+        after_load = _rss()
+        with torch.no_grad():
+            logits = model(torch.arange(64).unsqueeze(0)).logits[0, -1].float()
+        print(
+            json.dumps(
+                {
+                    "hit": hit,
+                    "load_s": load_s,
+                    "after_load": after_load,
+                    "after_forward": _rss(),
+                    "logits": logits[:1000].tolist(),
+                }
+            )
+        )
+        sys.exit(0)
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else "int8"
+    layers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    work = tempfile.mkdtemp()
+    try:
+        torch.manual_seed(0)
+        config = LlamaConfig(
+            vocab_size=83734,
+            hidden_size=1024,
+            intermediate_size=2816,
+            num_hidden_layers=layers,
+            num_attention_heads=8,
+            num_key_value_heads=8,
+        )
+        checkpoint = os.path.join(work, "checkpoint")
+        LlamaForCausalLM(config).to(torch.bfloat16).save_pretrained(checkpoint)
+        size = sum(
+            os.path.getsize(os.path.join(checkpoint, n)) for n in os.listdir(checkpoint)
+        )
+        print(f"bf16 checkpoint: {size / 2**20:.0f} MiB, quantize {mode}")
+        runs = []
+        for label in ("cold (load, quantize, snapshot)", "warm (map snapshot)"):
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", checkpoint, work, mode],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            run = json.loads(out.strip().splitlines()[-1])
+            runs.append(run)
+            print(
+                f"{label:32s} {run['load_s']:6.2f} s, peak RSS "
+                f"{run['after_forward']['VmHWM']:6.0f} MiB; after load "
+                f"{run['after_load']['RssAnon']:5.0f} MiB anon "
+                f"{run['after_load']['RssFile']:5.0f} MiB file, after a forward "
+                f"{run['after_forward']['RssAnon']:5.0f} MiB anon "
+                f"{run['after_forward']['RssFile']:5.0f} MiB file"
+            )
+        assert not runs[0]["hit"] and runs[1]["hit"]
+        same = runs[0]["logits"] == runs[1]["logits"]
+        print(f"snapshot logits identical to the freshly quantized model: {same}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)